@@ -50,6 +50,7 @@ parser.add_argument("--input-directory", type=str, default=None, help="Set the C
 parser.add_argument("--auto-launch", action="store_true", help="Automatically launch ComfyUI in the default browser.")
 parser.add_argument("--disable-auto-launch", action="store_true", help="Disable auto launching the browser.")
 parser.add_argument("--cuda-device", type=int, default=None, metavar="DEVICE_ID", help="Set the id of the cuda device this instance will use.")
+parser.add_argument("--worker-devices", type=int, nargs="+", default=None, metavar="DEVICE_ID", help="Run one prompt worker per listed device id, all pulling from the same queue. Each worker keeps its own caches and loads models on its own device.")
 cm_group = parser.add_mutually_exclusive_group()
 cm_group.add_argument("--cuda-malloc", action="store_true", help="Enable cudaMallocAsync (enabled by default for torch 2.0 and up).")
 cm_group.add_argument("--disable-cuda-malloc", action="store_true", help="Disable cudaMallocAsync.")
@@ -102,8 +103,30 @@ parser.add_argument("--preview-size", type=int, default=512, help="Sets the maxi
 cache_group = parser.add_mutually_exclusive_group()
 cache_group.add_argument("--cache-classic", action="store_true", help="Use the old style (aggressive) caching.")
 cache_group.add_argument("--cache-lru", type=int, default=0, help="Use LRU caching with a maximum of N node results cached. May use more RAM/VRAM.")
+cache_group.add_argument("--cache-ram-gb", type=float, default=0, help="Use LRU caching that evicts node results by their estimated size to keep the cache under N GB of RAM. Old results are also evicted when the system is low on free RAM.")
 cache_group.add_argument("--cache-none", action="store_true", help="Reduced RAM/VRAM usage at the expense of executing every node for each run.")
 
+parser.add_argument("--disk-cache-directory", type=str, default=None, help="Persist the outputs of deterministic nodes (text encoding, VAE encoding...) in this directory so they survive restarts.")
+parser.add_argument("--disk-cache-size-gb", type=float, default=10.0, help="Maximum size of the --disk-cache-directory in GB. The least recently used entries are deleted first.")
+parser.add_argument("--conditioning-cache-gb", type=float, default=0, help="Keep up to N GB of text encoder outputs in RAM, by model, LoRAs, clip options and tokens, so prompts that were encoded before aren't encoded again, whatever the workflow.")
+parser.add_argument("--lora-cache-gb", type=float, default=0, help="Keep up to N GB of weights with LoRAs merged in RAM so switching back to a LoRA combination that was used before doesn't recompute them.")
+parser.add_argument("--lora-cache-directory", type=str, default=None, help="Also store merged LoRA weights in this directory so they survive restarts.")
+parser.add_argument("--lora-cache-disk-gb", type=float, default=20.0, help="Maximum size of the --lora-cache-directory in GB.")
+parser.add_argument("--patched-variants", type=int, default=0, metavar="N", help="Keep the patched weights of up to N other LoRA stacks of a loaded model in vram so switching between clones of the model with different LoRAs is a pointer swap. Only the patched weights are duplicated.")
+parser.add_argument("--prefetch-models-gb", type=float, default=0, help="Read the checkpoints, LoRAs, VAEs... of the next queued prompts into up to N GB of RAM while the current prompt runs.")
+parser.add_argument("--prefetch-lookahead", type=int, default=1, metavar="N", help="Number of queued prompts --prefetch-models-gb looks at.")
+
+parser.add_argument("--execution-threads", type=int, default=1, metavar="N", help="Execute independent branches of a workflow on N threads. Nodes that declare themselves as CPU or IO bound (loading LoRAs or images, resizing images...) run alongside the other nodes, nodes using the GPU still run one at a time.")
+parser.add_argument("--microbatch-prompts", type=int, default=0, metavar="N", help="Execute up to N queued prompts that only differ in their seeds and texts together, their KSampler nodes sampling as a single batch.")
+parser.add_argument("--microbatch-window", type=float, default=50.0, metavar="MS", help="How long a prompt waits for other prompts to batch with when --microbatch-prompts is set, in milliseconds.")
+parser.add_argument("--history-max-items", type=int, default=10000, metavar="N", help="Maximum number of executed prompts kept in the history.")
+parser.add_argument("--history-max-mb", type=float, default=None, metavar="MB", help="Also limit the history by the estimated size of its entries in megabytes.")
+parser.add_argument("--persist-queue", action="store_true", help="Keep the queue and the history in a SQLite database so they survive restarts. Pending prompts are queued again on startup.")
+parser.add_argument("--queue-database", type=str, default=None, help="Path of the database used by --persist-queue. Defaults to queue.db in the user directory.")
+parser.add_argument("--queue-fair-share", action="store_true", help="Within a priority class, take prompts round robin between client ids instead of in submission order.")
+parser.add_argument("--max-in-flight-per-client", type=int, default=0, metavar="N", help="Maximum number of prompts of one client id that can run at the same time, 0 for no limit.")
+parser.add_argument("--queue-model-affinity", type=int, default=0, metavar="WINDOW", help="Look at the next WINDOW queued prompts and run the ones using the same checkpoints, LoRAs... as the last prompt first to avoid swapping models. A prompt is never passed over more than WINDOW times.")
+
 attn_group = parser.add_mutually_exclusive_group()
 attn_group.add_argument("--use-split-cross-attention", action="store_true", help="Use the split cross attention optimization. Ignored when xformers is used.")
 attn_group.add_argument("--use-quad-cross-attention", action="store_true", help="Use the sub-quadratic cross attention optimization . Ignored when xformers is used.")
@@ -132,6 +155,13 @@ parser.add_argument("--reserve-vram", type=float, default=None, help="Set the am
 parser.add_argument("--default-hashing-function", type=str, choices=['md5', 'sha1', 'sha256', 'sha512'], default='sha256', help="Allows you to choose the hash function to use for duplicate filename / contents comparison. Default is sha256.")
 
 parser.add_argument("--disable-smart-memory", action="store_true", help="Force ComfyUI to agressively offload to regular ram instead of keeping models in vram when it can.")
+parser.add_argument("--eviction-policy", type=str, default="default", choices=["default", "cost"], help="Which models to unload first when vram is needed. cost: the ones that are the cheapest to load again given their measured load time and how often they are used.")
+parser.add_argument("--host-ram-tier-gb", type=float, default=0, help="Keep the weights of up to N GB of models unloaded from vram in pinned memory so loading them again uses fast asynchronous copies.")
+parser.add_argument("--step-cache", action="store_true", help="Skip the uncond model evaluation of sampling steps late in the schedule when the cond prediction barely changed, reusing the last cond/uncond difference. The thresholds depend on the model type. Faster, at some quality cost.")
+parser.add_argument("--measured-memory", action="store_true", help="Measure the peak vram used by the diffusion model on each input shape the first time it runs and use these measurements instead of the static estimate to decide how many conds are batched together.")
+parser.add_argument("--lowvram-stream-layers", type=int, default=0, metavar="N", help="When a model only partially fits in vram, cast the weights of the next N offloaded layers on a separate stream while the current layer runs.")
+parser.add_argument("--disable-mmap", action="store_true", help="Read safetensors files into memory when loading them instead of memory mapping them.")
+parser.add_argument("--load-threads", type=int, default=0, metavar="N", help="Read safetensors files with N threads reading chunks of the file in parallel instead of memory mapping them. Faster on NVMe and network storage.")
 parser.add_argument("--deterministic", action="store_true", help="Make pytorch use slower deterministic algorithms when it can. Note that this might not make images deterministic in all cases.")
 
 class PerformanceFeature(enum.Enum):
@@ -231,6 +231,23 @@ class ComfyNodeABC(ABC):
     """Flags a node as deprecated, indicating to users that they should find alternatives to this node."""
     API_NODE: Optional[bool]
     """Flags a node as an API node."""
+    EXECUTION_RESOURCE: Literal["cpu", "io", "gpu"]
+    """What the node mostly spends its time on, used when independent branches are executed in parallel (``--execution-threads``).
+
+    * ``"cpu"`` and ``"io"`` nodes may run at the same time as any other node, so they must not load models or use the GPU.
+    * ``"gpu"`` nodes are executed one at a time.  This is the default for nodes that don't set it.
+    """
+    DISK_CACHEABLE: bool
+    """Flags the outputs of this node as safe to persist in the disk cache (``--disk-cache-directory``).
+
+    Only set this on deterministic nodes whose outputs are made of tensors, lists, tuples, dicts and plain values.
+    Outputs containing anything else are silently kept in memory only.
+    """
+    DISK_CACHE_VERSION: int
+    """Bump this when a change to code outside of the module of the node changes its outputs, so that the outputs persisted in the disk cache are dropped.
+
+    Changes to the files named by the inputs of the node or to the source file of its module are detected without it.
+    """
 
     @classmethod
     @abstractmethod
@@ -0,0 +1,126 @@
+import collections
+import hashlib
+import logging
+import struct
+import threading
+import uuid
+
+import torch
+
+from comfy.cli_args import args
+from comfy.patched_weight_cache import tensor_digest
+
+
+def _encode(obj, h):
+    if obj is None or isinstance(obj, (bool, int, str)):
+        h.update("{}:{!r};".format(type(obj).__name__, obj).encode())
+    elif isinstance(obj, float):
+        h.update(b"f" + struct.pack("<d", obj))
+    elif isinstance(obj, torch.Tensor):
+        h.update(b"t" + tensor_digest(obj))
+    elif isinstance(obj, (tuple, list)):
+        h.update(b"(%d" % len(obj))
+        for x in obj:
+            if not _encode(x, h):
+                return False
+        h.update(b")")
+    elif isinstance(obj, dict):
+        h.update(b"{%d" % len(obj))
+        for k in sorted(obj):
+            if not isinstance(k, str) or not _encode(k, h) or not _encode(obj[k], h):
+                return False
+        h.update(b"}")
+    else:
+        return False
+    return True
+
+
+def model_cache_id(model):
+    """An id of a text encoder model that isn't reused by other models like id() can be."""
+    cache_id = getattr(model, "comfy_conditioning_cache_id", None)
+    if cache_id is None:
+        cache_id = model.comfy_conditioning_cache_id = uuid.uuid4().hex
+    return cache_id
+
+
+def conditioning_key(model, patches_uuid, options, tokens):
+    """
+    Digest of what the output of encode_token_weights depends on: the text encoder model, the
+    patches (LoRAs) applied to it, the clip options and the tokens with their weights (embeddings
+    included). None if the tokens contain something that can't be hashed.
+    """
+    h = hashlib.sha256()
+    h.update("{}:{}:".format(model_cache_id(model), patches_uuid).encode())
+    if not _encode(options, h) or not _encode(tokens, h):
+        return None
+    return h.digest()
+
+
+def _nbytes(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sum(_nbytes(x) for x in obj)
+    if isinstance(obj, dict):
+        return sum(_nbytes(x) for x in obj.values())
+    return 0
+
+
+class ConditioningCache:
+    """
+    LRU cache of the outputs of the text encoders, by content rather than by node, so prompts that
+    keep coming back (negative prompts, style strings) in any workflow are only encoded once and a
+    hit doesn't even load the text encoder. Like the outputs of the node cache, the cached tensors
+    are shared and must not be modified in place.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cache_key):
+        with self.lock:
+            out = self.entries.get(cache_key, None)
+            if out is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(cache_key)
+            self.hits += 1
+            return out[0]
+
+    def set(self, cache_key, value):
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if cache_key in self.entries:
+                return
+            self.entries[cache_key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "total_bytes": self.total_bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups > 0 else None}
+
+
+_cache = None
+_cache_initialized = False
+
+
+def get_cache():
+    """The cache configured with --conditioning-cache-gb, or None when disabled."""
+    global _cache, _cache_initialized
+    if not _cache_initialized:
+        _cache_initialized = True
+        if args.conditioning_cache_gb > 0:
+            _cache = ConditioningCache(int(args.conditioning_cache_gb * (1024 ** 3)))
+            logging.info("Caching text encoder outputs: {} GB of RAM".format(args.conditioning_cache_gb))
+    return _cache
@@ -0,0 +1,208 @@
+import collections
+import itertools
+import logging
+import threading
+import weakref
+
+import torch
+
+from comfy.cli_args import args
+import comfy.model_management
+
+
+class HostTier:
+    """
+    Host RAM tier for the weights of unloaded models. Weights moved off the gpu are copied into
+    pinned memory (when pin_memory is set) for up to max_bytes, the models unloaded least recently
+    being moved back to ordinary pageable memory first. Loading modules back uses non blocking copies
+    on a dedicated cuda stream that the compute stream waits for, so the host doesn't block on the
+    transfers and everything reading the weights afterwards (patching, casts, forward) sees them
+    complete. Without cuda the same bookkeeping runs with synchronous copies.
+    """
+    def __init__(self, max_bytes, pin_memory=False):
+        self.max_bytes = max_bytes
+        self.pin_memory = pin_memory
+        self.lock = threading.RLock()
+        self.owners = collections.OrderedDict()  # id(owner module) -> weakref to it, least recently unloaded first
+        self.owner_sizes = {}  # id(owner module) -> bytes of its weights in the tier
+        self.bytes = 0  # Running total of owner_sizes, so offloading a module doesn't walk every model
+        self.streams = {}
+
+    def in_tier(self, t):
+        return t.device.type == "cpu" and (t.is_pinned() or not self.pin_memory)
+
+    def owner_bytes(self, owner):
+        total = 0
+        for t in itertools.chain(owner.parameters(), owner.buffers()):
+            if self.in_tier(t):
+                total += t.nbytes
+        return total
+
+    def _live_owners(self):
+        owners = []
+        for key, ref in list(self.owners.items()):
+            owner = ref()
+            if owner is None:
+                self.owners.pop(key)
+                self.bytes -= self.owner_sizes.pop(key, 0)
+            else:
+                owners.append(owner)
+        return owners
+
+    @property
+    def total_bytes(self):
+        with self.lock:
+            self._live_owners()
+            return self.bytes
+
+    def _add_bytes(self, owner_key, size):
+        self.owner_sizes[owner_key] = self.owner_sizes.get(owner_key, 0) + size
+        self.bytes += size
+
+    def _release_owner(self, owner_key):
+        """Removes an owner from the tier, moving its pinned weights back to pageable memory. Returns the bytes freed."""
+        ref = self.owners.pop(owner_key, None)
+        freed = self.owner_sizes.pop(owner_key, 0)
+        self.bytes -= freed
+        owner = ref() if ref is not None else None
+        if owner is None:
+            return freed
+
+        def unpin(t):
+            if t.device.type == "cpu" and t.is_pinned():
+                return torch.empty_like(t).copy_(t)
+            return t
+        if self.pin_memory:
+            owner._apply(unpin)
+        return freed
+
+    def _make_room(self, size, owner_key):
+        """Releases the least recently unloaded other owners until size more bytes fit. Returns False if they can't."""
+        while self.bytes + size > self.max_bytes:
+            victim = next((k for k in self.owners if k != owner_key), None)
+            if victim is None:
+                return False
+            self._release_owner(victim)
+        return True
+
+    def offload_module(self, module, owner=None):
+        """Moves the weights of module to the cpu, keeping as many of them as the budget allows in the tier."""
+        if owner is None:
+            owner = module
+        owner_key = id(owner)
+        with self.lock:
+            self._live_owners()
+            if self.owners.pop(owner_key, None) is None:
+                # Weights of a new owner that are already in the tier (on the cpu) are counted once here
+                self._add_bytes(owner_key, self.owner_bytes(owner))
+            self.owners[owner_key] = weakref.ref(owner)
+            copied = set()
+
+            def offload(t):
+                if self.in_tier(t):
+                    return t
+                if not self._make_room(t.nbytes, owner_key):
+                    return t.to("cpu")
+                try:
+                    out = torch.empty(t.shape, dtype=t.dtype, pin_memory=self.pin_memory)
+                except RuntimeError as e:
+                    logging.debug("Could not allocate pinned memory: {}".format(e))
+                    return t.to("cpu")
+                out.copy_(t, non_blocking=self.pin_memory)
+                copied.add(t.device)
+                self._add_bytes(owner_key, t.nbytes)
+                return out
+            module._apply(offload)
+            for device in copied:
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+            # Without pinned memory every weight on the cpu is in the tier, only whole models can be let go
+            self._make_room(0, owner_key)
+
+    def _stream(self, device):
+        if device.type != "cuda" or not self.pin_memory:
+            return None
+        stream = self.streams.get(device, None)
+        if stream is None:
+            stream = self.streams[device] = torch.cuda.Stream(device)
+        return stream
+
+    def _loaded(self, modules, device, owner):
+        """Takes the weights of modules that are about to leave the tier for device off the size of owner."""
+        if owner is None or device.type == "cpu":
+            return
+        owner_key = id(owner)
+        with self.lock:
+            if owner_key not in self.owner_sizes:
+                return
+            size = 0
+            for m in modules:
+                size += self.owner_bytes(m)
+            size = min(size, self.owner_sizes[owner_key])
+            self._add_bytes(owner_key, -size)
+
+    def load_modules(self, modules, device, owner=None):
+        """Moves modules (of the model owner) to device in order, asynchronously when a copy stream is available."""
+        self._loaded(modules, device, owner)
+        stream = self._stream(device)
+        if stream is None:
+            for m in modules:
+                m.to(device)
+            return
+
+        compute_stream = torch.cuda.current_stream(device)
+        # The weights may have just been written (patched) on the compute stream
+        stream.wait_stream(compute_stream)
+
+        def load(t):
+            if t.device == device:
+                return t
+            with torch.cuda.stream(stream):
+                out = t.to(device, non_blocking=t.is_pinned())
+            out.record_stream(compute_stream)
+            return out
+
+        for m in modules:
+            m._apply(load)
+        # Weights are read outside of the forward of their module too (lora patching, casts), so
+        # everything queued on the compute stream from now on waits for all the copies
+        compute_stream.wait_stream(stream)
+
+    def get_stats(self):
+        with self.lock:
+            return {"total_bytes": self.total_bytes, "max_bytes": self.max_bytes, "models": len(self._live_owners()), "pinned": self.pin_memory}
+
+
+_tier = None
+_tier_initialized = False
+
+
+def get_tier():
+    """The tier configured with --host-ram-tier-gb, or None when disabled."""
+    global _tier, _tier_initialized
+    if not _tier_initialized:
+        _tier_initialized = True
+        if args.host_ram_tier_gb > 0:
+            pin_memory = comfy.model_management.get_torch_device().type == "cuda"
+            _tier = HostTier(int(args.host_ram_tier_gb * (1024 ** 3)), pin_memory=pin_memory)
+            logging.info("Host RAM tier for unloaded models: {} GB, pinned: {}".format(args.host_ram_tier_gb, pin_memory))
+    return _tier
+
+
+def offload(module, device, owner=None):
+    """module.to(device), through the host RAM tier when device is the cpu."""
+    tier = get_tier()
+    if tier is None or torch.device(device).type != "cpu":
+        module.to(device)
+    else:
+        tier.offload_module(module, owner=owner)
+
+
+def load(modules, device, owner=None):
+    """m.to(device) for each of modules (of the model owner), through the host RAM tier when it is enabled."""
+    tier = get_tier()
+    if tier is None or device is None:
+        for m in modules:
+            m.to(device)
+    else:
+        tier.load_modules(modules, torch.device(device), owner=owner)
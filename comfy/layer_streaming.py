@@ -0,0 +1,111 @@
+import collections
+
+import torch
+
+import comfy.model_management
+
+
+def _tensor_version(t):
+    try:
+        return t._version
+    except RuntimeError:
+        # Inference tensors don't track in place changes
+        return None
+
+
+def _weight_state(s):
+    # Changes when the weights or their patches (hooks, lowvram patches) change
+    state = []
+    for name in ("weight", "bias"):
+        t = getattr(s, name, None)
+        if t is not None:
+            state.append((t.data_ptr(), _tensor_version(t)))
+        functions = getattr(s, "{}_function".format(name), [])
+        state.append(tuple(id(f) for f in functions))
+    return tuple(state)
+
+
+class LayerStreamer:
+    """
+    Prefetches the weights of the lowvram modules of a partially loaded model. The first forward pass
+    records the order the modules cast their weights in; after that, every time a module casts its
+    weights the ones of the next `ahead` modules are cast (with their LowVramPatch applied) on a side
+    cuda stream, so the copies overlap with the compute of the current layer. At most `ahead` prefetched
+    layers are kept. Without cuda streams the prefetch is done synchronously, which keeps the same code
+    path but gains nothing.
+    """
+    def __init__(self, device, ahead=1):
+        if device.type == "cuda" and device.index is None:
+            device = torch.device("cuda", torch.cuda.current_device())
+        self.device = device
+        self.ahead = max(1, ahead)
+        self.order = []
+        self.position = {}
+        self.recording = True
+        self.cast_args = {}  # module -> (dtype, bias_dtype) it was last cast with
+        self.buffer = collections.OrderedDict()  # module -> (cast args, weight state, weight, bias, event)
+        self.hits = 0
+        self.misses = 0
+        self.stream = None
+        if device.type == "cuda" and comfy.model_management.device_supports_non_blocking(device):
+            self.stream = torch.cuda.Stream(device)
+
+    def cast(self, s, dtype, device, bias_dtype, cast_function):
+        """
+        Returns the (weight, bias) of s cast by cast_function(s, dtype, device, bias_dtype, non_blocking)
+        from the prefetch buffer, or None if they weren't prefetched.
+        """
+        if device != self.device:
+            return None
+        cast_args = (dtype, bias_dtype)
+        self.cast_args[s] = cast_args
+        if self.recording:
+            if s not in self.position:
+                self.position[s] = len(self.order)
+                self.order.append(s)
+                return None
+            # A module is cast again: the first pass is over
+            self.recording = False
+
+        position = self.position.get(s, None)
+        if position is None:
+            return None
+        entry = self.buffer.pop(s, None)
+        self._prefetch(position, cast_function)
+
+        if entry is None or entry[0] != cast_args or entry[1] != _weight_state(s):
+            self.misses += 1
+            return None
+        self.hits += 1
+        weight, bias, event = entry[2:]
+        if event is not None:
+            compute_stream = torch.cuda.current_stream(self.device)
+            compute_stream.wait_event(event)
+            weight.record_stream(compute_stream)
+            if bias is not None:
+                bias.record_stream(compute_stream)
+        return weight, bias
+
+    def _prefetch(self, position, cast_function):
+        for i in range(1, self.ahead + 1):
+            m = self.order[(position + i) % len(self.order)]
+            if m in self.buffer or m not in self.cast_args:
+                continue
+            while len(self.buffer) >= self.ahead:
+                self.buffer.popitem(last=False)
+            dtype, bias_dtype = self.cast_args[m]
+            state = _weight_state(m)
+            if self.stream is not None:
+                # Patch weights may have just been written on the compute stream
+                self.stream.wait_stream(torch.cuda.current_stream(self.device))
+                with torch.cuda.stream(self.stream):
+                    weight, bias = cast_function(m, dtype, self.device, bias_dtype, True)
+                    event = torch.cuda.Event()
+                    event.record(self.stream)
+            else:
+                weight, bias = cast_function(m, dtype, self.device, bias_dtype, False)
+                event = None
+            self.buffer[m] = ((dtype, bias_dtype), state, weight, bias, event)
+
+    def clear(self):
+        self.buffer.clear()
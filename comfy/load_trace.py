@@ -0,0 +1,139 @@
+"""
+Timing and byte counts of the phases of model loading (file reads, casts, LoRA patching, device
+transfers...), recorded per prompt and exported in the Chrome trace event format, which
+chrome://tracing and https://ui.perfetto.dev can open.
+"""
+import collections
+import contextlib
+import functools
+import os
+import threading
+import time
+
+# Traces of the most recent prompts that are kept
+MAX_TRACES = 64
+# Events recorded per prompt at most, the ones after that are only counted
+MAX_EVENTS = 200000
+
+_local = threading.local()
+_traces = collections.OrderedDict()  # prompt id -> PromptTrace
+_traces_lock = threading.Lock()
+
+
+class PromptTrace:
+    def __init__(self, prompt_id):
+        self.prompt_id = prompt_id
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        self.events = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def add(self, name, start, end, args):
+        with self.lock:
+            if len(self.events) >= MAX_EVENTS:
+                self.dropped += 1
+                return
+            self.events.append((name, start, end, threading.get_ident(), args))
+
+    def summary(self):
+        """Total time and bytes of every phase."""
+        out = {}
+        with self.lock:
+            for name, start, end, _, args in self.events:
+                phase = out.setdefault(name, {"count": 0, "time": 0.0, "bytes": 0})
+                phase["count"] += 1
+                phase["time"] += end - start
+                phase["bytes"] += args.get("bytes", 0)
+        return out
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        events = []
+        with self.lock:
+            for name, start, end, tid, args in self.events:
+                events.append({"name": name, "cat": "model_load", "ph": "X", "pid": pid, "tid": tid,
+                               "ts": (start - self.start) * 1e6, "dur": (end - start) * 1e6, "args": args})
+            dropped = self.dropped
+        return {"traceEvents": events, "displayTimeUnit": "ms",
+                "otherData": {"prompt_id": self.prompt_id, "start_time": self.wall_start, "dropped_events": dropped, "summary": self.summary()}}
+
+
+@contextlib.contextmanager
+def prompt_trace(prompt_id):
+    """Records the spans of the current thread into the trace of prompt_id while in the context."""
+    with _traces_lock:
+        trace = _traces.get(prompt_id, None)
+        if trace is None:
+            trace = _traces[prompt_id] = PromptTrace(prompt_id)
+            while len(_traces) > MAX_TRACES:
+                _traces.popitem(last=False)
+    previous = getattr(_local, "trace", None)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def get_trace(prompt_id):
+    with _traces_lock:
+        return _traces.get(prompt_id, None)
+
+
+class span:
+    """
+    Times a phase of model loading into the trace of the prompt being executed by the thread, if any:
+
+        with span("lora_patch", key=key) as s:
+            ...
+            s.set(bytes=weight.nbytes)
+    """
+    __slots__ = ("name", "args", "trace", "start")
+
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+        self.trace = getattr(_local, "trace", None)
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        if self.trace is not None:
+            _span_stack().append(self)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.add(self.name, self.start, time.perf_counter(), self.args)
+            _span_stack().pop()
+        return False
+
+
+def _span_stack():
+    stack = getattr(_local, "spans", None)
+    if stack is None:
+        stack = _local.spans = []
+    return stack
+
+
+def annotate(**args):
+    """Adds args (like bytes=...) to the innermost span of the thread."""
+    if getattr(_local, "trace", None) is None:
+        return
+    stack = _span_stack()
+    if len(stack) > 0:
+        stack[-1].set(**args)
+
+
+def traced(name):
+    """Decorator recording every call of a function as a span."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -379,3 +379,113 @@ def calculate_weight(patches, weight, key, intermediate_dtype=torch.float32, ori
             weight = old_weight
 
     return weight
+
+# Upper bound on the float32 weights (and as much again for the low rank products) patched together by one batch
+BATCHED_PATCH_MAX_BYTES = 128 * 1024 * 1024
+
+
+def _stack_factors(tensors, device, dtype):
+    return comfy.model_management.cast_to_device(torch.stack([t.flatten(start_dim=1) for t in tensors]), device, dtype)
+
+
+def batched_patch_signature(patches, weight):
+    """
+    Key used to group weights that calculate_weights_batched can patch together: the weight shape and the
+    type and factor shapes of every patch. Returns None for patches it can't batch (dora, conv/cp
+    decompositions, offsets, custom functions and anything that isn't a lora, loha or lokr).
+    """
+    signature = [tuple(weight.shape), weight.device]
+    for strength, v, strength_model, offset, function in patches:
+        if offset is not None or function is not None:
+            return None
+        w = v.weights if isinstance(v, weight_adapter.WeightAdapterBase) else None
+        if type(v) is weight_adapter.LoRAAdapter:
+            if w[3] is not None or w[4] is not None or w[5] is not None:
+                return None
+            factors = (w[0], w[1])
+            numel = w[0].shape[0] * w[1][0].numel()
+        elif type(v) is weight_adapter.LoHaAdapter:
+            if w[5] is not None or w[7] is not None:
+                return None
+            factors = (w[0], w[1], w[3], w[4])
+            if any(t.ndim != 2 for t in factors):
+                return None
+            numel = w[0].shape[0] * w[1].shape[1]
+        elif type(v) is weight_adapter.LoKrAdapter:
+            if w[7] is not None or w[8] is not None:
+                return None
+            factors = tuple(t for t in w[:2] + w[3:7] if t is not None)
+            if any(t.ndim != 2 for t in factors):
+                return None
+            w1_shape = (w[3].shape[0], w[4].shape[1]) if w[0] is None else w[0].shape
+            w2_shape = (w[5].shape[0], w[6].shape[1]) if w[1] is None else w[1].shape
+            numel = w1_shape[0] * w1_shape[1] * w2_shape[0] * w2_shape[1]
+            signature.append((w[0] is None, w[1] is None))
+        else:
+            return None
+        if numel != weight.numel() or len(set((t.device, t.dtype) for t in factors)) != 1:
+            return None
+        signature.append((type(v).__name__, factors[0].device, factors[0].dtype) + tuple(tuple(t.shape) for t in factors))
+    return tuple(signature)
+
+
+def _batched_lokr_factor(adapters, full, a, b, device, dtype):
+    if adapters[0].weights[full] is not None:
+        return _stack_factors([v.weights[full] for v in adapters], device, dtype)
+    return torch.bmm(_stack_factors([v.weights[a] for v in adapters], device, dtype),
+                     _stack_factors([v.weights[b] for v in adapters], device, dtype))
+
+
+def _batched_diff(adapters, device, dtype):
+    """The (batch, rows, columns) products of a list of adapters with the same signature and their alphas."""
+    kind = type(adapters[0])
+    if kind is weight_adapter.LoRAAdapter:
+        rank = adapters[0].weights[1].shape[0]
+        diff = torch.bmm(_stack_factors([v.weights[0] for v in adapters], device, dtype),
+                         _stack_factors([v.weights[1] for v in adapters], device, dtype))
+    elif kind is weight_adapter.LoHaAdapter:
+        rank = adapters[0].weights[1].shape[0]
+        diff = torch.bmm(_stack_factors([v.weights[0] for v in adapters], device, dtype),
+                         _stack_factors([v.weights[1] for v in adapters], device, dtype))
+        diff *= torch.bmm(_stack_factors([v.weights[3] for v in adapters], device, dtype),
+                          _stack_factors([v.weights[4] for v in adapters], device, dtype))
+    else:
+        w = adapters[0].weights
+        rank = w[6].shape[0] if w[1] is None else (w[4].shape[0] if w[0] is None else None)
+        w1 = _batched_lokr_factor(adapters, 0, 3, 4, device, dtype)
+        w2 = _batched_lokr_factor(adapters, 1, 5, 6, device, dtype)
+        # Batched kronecker product
+        batch = w1.shape[0]
+        diff = (w1[:, :, None, :, None] * w2[:, None, :, None, :]).reshape(batch, w1.shape[1] * w2.shape[1], w1.shape[2] * w2.shape[2])
+
+    alphas = []
+    for v in adapters:
+        if v.weights[2] is not None and rank is not None:
+            alphas.append(v.weights[2] / rank)
+        else:
+            alphas.append(1.0)
+    return diff, alphas
+
+
+def calculate_weights_batched(items, intermediate_dtype=torch.float32):
+    """
+    Same as calling calculate_weight(patches, weight, key) for each (patches, weight, key) of items, when
+    all of them have the same batched_patch_signature: the low rank products of every key are computed
+    with one batched matmul per patch and added in place to the weights. Returns the patched weights.
+    """
+    weights = [weight for _, weight, _ in items]
+    device = weights[0].device
+    for i in range(len(items[0][0])):
+        adapters = [patches[i][1] for patches, _, _ in items]
+        try:
+            diff, alphas = _batched_diff(adapters, device, intermediate_dtype)
+        except Exception as e:
+            logging.error("ERROR batched {} {} {}".format(type(adapters[0]).__name__, items[0][2], e))
+            continue
+        for j, (patches, weight, key) in enumerate(items):
+            strength, strength_model = patches[i][0], patches[i][2]
+            if strength_model != 1.0:
+                weight *= strength_model
+            weight.add_(diff[j].reshape(weight.shape).to(weight.dtype), alpha=strength * alphas[j])
+        del diff
+    return weights
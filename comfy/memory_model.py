@@ -0,0 +1,118 @@
+"""
+Measured memory model of a diffusion model. The peak memory allocated while the model runs on an
+input shape is recorded the first time that shape is sampled, and later estimates for that shape or
+other batch sizes of it (fitted on the measured ones) use these measurements instead of the static
+memory_usage_factor formula. Other shapes keep the static formula: attention memory doesn't grow
+linearly with the number of tokens so scaling a measurement would underestimate it. The number of
+conds _calc_cond_batch batches together is also remembered for a few steps so the free memory isn't
+queried on every step.
+"""
+import threading
+
+import torch
+
+# Safety margin applied on the measured peaks
+MEASURED_MARGIN = 1.1
+# Margin of the static memory_required estimate
+STATIC_MARGIN = 1.5
+# Number of times a batch size decision is reused before the free memory is checked again
+DECISION_STEPS = 8
+
+
+def _split(input_shape, variant):
+    return int(input_shape[0]), (tuple(int(x) for x in input_shape[1:]), variant)
+
+
+class MemoryModel:
+    def __init__(self):
+        self.samples = {}  # (input shape without batch, variant) -> {batch size: peak bytes}
+        self.decisions = {}  # key -> [batch size, remaining uses]
+        self.lock = threading.Lock()
+        self.measured = 0
+        self.decisions_reused = 0
+
+    def record(self, input_shape, peak, variant=None):
+        batch, key = _split(input_shape, variant)
+        with self.lock:
+            curve = self.samples.setdefault(key, {})
+            curve[batch] = max(curve.get(batch, 0), peak)
+            self.decisions.clear()
+            self.measured += 1
+
+    def needs_measure(self, input_shape, variant=None):
+        batch, key = _split(input_shape, variant)
+        with self.lock:
+            return batch not in self.samples.get(key, {})
+
+    def estimate(self, input_shape, variant=None):
+        """Peak memory of running the model on input_shape in bytes, None if that shape wasn't measured at any batch size."""
+        batch, key = _split(input_shape, variant)
+        with self.lock:
+            curve = self.samples.get(key, None)
+            if not curve:
+                return None
+            if batch in curve:
+                return curve[batch]
+            low, high = min(curve), max(curve)
+            if low != high:
+                # Activations grow linearly with the batch on top of a fixed part
+                slope = max(curve[high] - curve[low], 0) / (high - low)
+                return max(curve[low] + slope * (batch - low), 0)
+            return curve[low] * batch / low
+
+    def cached_batch(self, key):
+        with self.lock:
+            decision = self.decisions.get(key, None)
+            if decision is None:
+                return None
+            decision[1] -= 1
+            if decision[1] <= 0:
+                del self.decisions[key]
+            self.decisions_reused += 1
+            return decision[0]
+
+    def cache_batch(self, key, batch):
+        with self.lock:
+            self.decisions[key] = [batch, DECISION_STEPS]
+
+    def get_stats(self):
+        with self.lock:
+            return {"shapes": len(self.samples), "measured": self.measured, "decisions_reused": self.decisions_reused}
+
+
+def batch_fits(model, input_shape, free_memory, variant=None):
+    """If running model on input_shape fits in free_memory, with the tighter margin when its shape was measured."""
+    memory_model = getattr(model, "memory_model", None)
+    if memory_model is not None:
+        estimate = memory_model.estimate(input_shape, variant)
+        if estimate is not None:
+            return estimate * MEASURED_MARGIN < free_memory
+    return model.memory_required(input_shape) * STATIC_MARGIN < free_memory
+
+
+class measure_peak:
+    """
+    Records the peak memory allocated on device while in the context into memory_model, when it is a
+    cuda device and input_shape wasn't measured yet.
+    """
+    def __init__(self, memory_model, device, input_shape, variant=None):
+        self.active = (memory_model is not None and device.type == "cuda" and torch.cuda.is_available()
+                       and memory_model.needs_measure(input_shape, variant))
+        self.memory_model = memory_model
+        self.device = device
+        self.input_shape = input_shape
+        self.variant = variant
+
+    def __enter__(self):
+        if self.active:
+            torch.cuda.synchronize(self.device)
+            self.base = torch.cuda.memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if self.active and exc_type is None:
+            torch.cuda.synchronize(self.device)
+            peak = torch.cuda.max_memory_allocated(self.device) - self.base
+            self.memory_model.record(self.input_shape, max(peak, 0), self.variant)
+        return False
@@ -40,12 +40,14 @@ import comfy.ldm.hunyuan3d.model
 import comfy.ldm.hidream.model
 
 import comfy.model_management
+import comfy.memory_model
 import comfy.patcher_extension
 import comfy.conds
 import comfy.ops
 from enum import Enum
 from . import utils
 import comfy.latent_formats
+from comfy.cli_args import args
 import math
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
@@ -133,6 +135,7 @@ class BaseModel(torch.nn.Module):
         logging.info("model_type {}".format(model_type.name))
         logging.debug("adm {}".format(self.adm_channels))
         self.memory_usage_factor = model_config.memory_usage_factor
+        self.memory_model = comfy.memory_model.MemoryModel() if args.measured_memory else None
 
     def apply_model(self, x, t, c_concat=None, c_crossattn=None, control=None, transformer_options={}, **kwargs):
         return comfy.patcher_extension.WrapperExecutor.new_class_executor(
@@ -324,6 +327,10 @@ class BaseModel(torch.nn.Module):
         return self.model_sampling.noise_scaling(sigma.reshape([sigma.shape[0]] + [1] * (len(noise.shape) - 1)), noise, latent_image)
 
     def memory_required(self, input_shape):
+        if self.memory_model is not None:
+            measured = self.memory_model.estimate(input_shape)
+            if measured is not None:
+                return measured
         if comfy.model_management.xformers_enabled() or comfy.model_management.pytorch_attention_flash_attention():
             dtype = self.get_dtype()
             if self.manual_cast_dtype is not None:
@@ -20,11 +20,14 @@ import psutil
 import logging
 from enum import Enum
 from comfy.cli_args import args, PerformanceFeature
+import comfy.load_trace
 import torch
 import sys
 import platform
 import weakref
 import gc
+import threading
+import time
 
 class VRAMState(Enum):
     DISABLED = 0    #No vram present: no need to move models to vram
@@ -151,9 +154,23 @@ def is_mlu():
         return True
     return False
 
+thread_torch_device = threading.local()
+
+def set_thread_torch_device(device):
+    """
+    Makes get_torch_device() return device for the calling thread. Used to bind prompt workers
+    to their own GPU when running more than one of them.
+    """
+    thread_torch_device.device = device
+    if device is not None and device.type == "cuda":
+        torch.cuda.set_device(device)
+
 def get_torch_device():
     global directml_enabled
     global cpu_state
+    device = getattr(thread_torch_device, "device", None)
+    if device is not None:
+        return device
     if directml_enabled:
         global directml_device
         return directml_device
@@ -385,6 +402,8 @@ except:
 
 
 current_loaded_models = []
+# Protects current_loaded_models when prompts are executed by more than one worker thread
+model_management_lock = threading.RLock()
 
 def module_size(module):
     module_mem = 0
@@ -497,6 +516,124 @@ def offloaded_memory(loaded_models, device):
             offloaded_mem += m.model_offloaded_memory()
     return offloaded_mem
 
+# Used when no load of a model was measured yet
+DEFAULT_LOAD_BYTES_PER_SECOND = 1024 * 1024 * 1024
+
+class ModelStats:
+    """How long a model took to load and how often it is used, kept for as long as the model exists."""
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0  # Requested while already loaded
+        self.misses = 0  # Requested and (partially) loaded
+        self.load_time = 0.0
+        self.loaded_bytes = 0
+        self.last_load_time = None
+        self.last_used = None
+        self.uses = 0.0  # Number of uses decayed with USE_HALF_LIFE
+
+    def used(self, now, half_life):
+        self.uses = self.frequency(now, half_life) + 1.0
+        self.last_used = now
+
+    def frequency(self, now, half_life):
+        if self.last_used is None:
+            return 0.0
+        return self.uses * 0.5 ** (max(0.0, now - self.last_used) / half_life)
+
+    def reload_time(self, size):
+        """Estimated time to load size bytes of this model, from its measured loads."""
+        if self.loaded_bytes > 0 and self.load_time > 0:
+            return self.load_time * size / self.loaded_bytes
+        with model_stats_lock:
+            all_stats = list(model_stats.values())
+        total_time = sum(s.load_time for s in all_stats)
+        total_bytes = sum(s.loaded_bytes for s in all_stats)
+        if total_bytes > 0 and total_time > 0:
+            return total_time * size / total_bytes
+        return size / DEFAULT_LOAD_BYTES_PER_SECOND
+
+USE_HALF_LIFE = 600.0
+# Maps the torch module of a model (shared by the clones of its ModelPatcher) -> ModelStats
+model_stats = weakref.WeakKeyDictionary()
+# Only guards model_stats itself so the stats can be read without waiting for model_management_lock
+model_stats_lock = threading.Lock()
+
+def get_model_stats(model):
+    real_model = getattr(model, "model", model)
+    try:
+        with model_stats_lock:
+            stats = model_stats.get(real_model, None)
+            if stats is None:
+                stats = model_stats[real_model] = ModelStats(real_model.__class__.__name__)
+    except TypeError:
+        return ModelStats(real_model.__class__.__name__)
+    return stats
+
+def model_stats_summary():
+    """
+    The stats of every model that still exists, for /system_stats. Called from the event loop of the
+    server so it doesn't take model_management_lock, which is held during whole model loads: it works
+    on copies of the list of loaded models and of the stats.
+    """
+    loaded = {}
+    for m in list(current_loaded_models):
+        patcher = m.model
+        if patcher is not None:
+            loaded[id(patcher.model)] = (m, patcher)
+    with model_stats_lock:
+        stats_items = list(model_stats.items())
+    out = []
+    now = time.time()
+    for real_model, stats in stats_items:
+        m, patcher = loaded.get(id(real_model), (None, None))
+        size = module_size(real_model) if m is None else patcher.model_size()
+        out.append({
+            "name": stats.name,
+            "size": size,
+            "loaded": m is not None,
+            "loaded_memory": 0 if m is None else patcher.loaded_size(),
+            "device": None if m is None else str(m.device),
+            "hits": stats.hits,
+            "misses": stats.misses,
+            "load_time": stats.load_time,
+            "last_load_time": stats.last_load_time,
+            "estimated_load_time": stats.reload_time(size),
+            "uses": stats.frequency(now, USE_HALF_LIFE),
+        })
+    return out
+
+class EvictionPolicy:
+    """Decides which models free_memory unloads first: the ones with the lowest sort_key."""
+    def sort_key(self, loaded_model):
+        raise NotImplementedError
+
+class DefaultEvictionPolicy(EvictionPolicy):
+    """Partially offloaded models first, then the least referenced ones, then the smallest."""
+    def sort_key(self, loaded_model):
+        return (-loaded_model.model_offloaded_memory(), sys.getrefcount(loaded_model.model), loaded_model.model_memory())
+
+class CostAwareEvictionPolicy(EvictionPolicy):
+    """
+    Unloads the models that are cheapest to bring back per byte of memory they free first: their
+    measured load time times how often they were used recently, over their loaded size.
+    """
+    def __init__(self, half_life=USE_HALF_LIFE):
+        self.half_life = half_life
+
+    def sort_key(self, loaded_model):
+        stats = get_model_stats(loaded_model.model)
+        now = time.time()
+        size = loaded_model.model_memory()
+        cost = stats.reload_time(size) * max(stats.frequency(now, self.half_life), 1e-6)
+        return (cost / max(1, loaded_model.model_loaded_memory()), stats.last_used or 0.0)
+
+EVICTION_POLICIES = {"default": DefaultEvictionPolicy, "cost": CostAwareEvictionPolicy}
+eviction_policy = EVICTION_POLICIES[args.eviction_policy]()
+
+def set_eviction_policy(policy):
+    global eviction_policy
+    eviction_policy = policy
+
 WINDOWS = any(platform.win32_ver())
 
 EXTRA_RESERVED_VRAM = 400 * 1024 * 1024
@@ -514,117 +651,153 @@ def minimum_inference_memory():
     return (1024 * 1024 * 1024) * 0.8 + extra_reserved_memory()
 
 def free_memory(memory_required, device, keep_loaded=[]):
-    cleanup_models_gc()
-    unloaded_model = []
-    can_unload = []
-    unloaded_models = []
-
-    for i in range(len(current_loaded_models) -1, -1, -1):
-        shift_model = current_loaded_models[i]
-        if shift_model.device == device:
-            if shift_model not in keep_loaded and not shift_model.is_dead():
-                can_unload.append((-shift_model.model_offloaded_memory(), sys.getrefcount(shift_model.model), shift_model.model_memory(), i))
-                shift_model.currently_used = False
-
-    for x in sorted(can_unload):
-        i = x[-1]
-        memory_to_free = None
-        if not DISABLE_SMART_MEMORY:
-            free_mem = get_free_memory(device)
-            if free_mem > memory_required:
-                break
-            memory_to_free = memory_required - free_mem
-        logging.debug(f"Unloading {current_loaded_models[i].model.model.__class__.__name__}")
-        if current_loaded_models[i].model_unload(memory_to_free):
-            unloaded_model.append(i)
-
-    for i in sorted(unloaded_model, reverse=True):
-        unloaded_models.append(current_loaded_models.pop(i))
-
-    if len(unloaded_model) > 0:
-        soft_empty_cache()
-    else:
-        if vram_state != VRAMState.HIGH_VRAM:
-            mem_free_total, mem_free_torch = get_free_memory(device, torch_free_too=True)
-            if mem_free_torch > mem_free_total * 0.25:
+    with model_management_lock:
+        cleanup_models_gc()
+        unloaded_model = []
+        can_unload = []
+        unloaded_models = []
+
+        for i in range(len(current_loaded_models) -1, -1, -1):
+            shift_model = current_loaded_models[i]
+            if shift_model.device == device:
+                if shift_model not in keep_loaded and not shift_model.is_dead():
+                    can_unload.append(eviction_policy.sort_key(shift_model) + (i,))
+                    shift_model.currently_used = False
+
+        with comfy.load_trace.span("free_memory", device=str(device), memory_required=memory_required) as trace_span:
+            # The patched weights kept by --patched-variants aren't part of the loaded weights, they go first
+            freed_variants = 0
+            for shift_model in current_loaded_models:
+                if shift_model.device != device or shift_model.model is None:
+                    continue
+                memory_to_free = None
+                if not DISABLE_SMART_MEMORY:
+                    free_mem = get_free_memory(device)
+                    if free_mem > memory_required:
+                        break
+                    memory_to_free = memory_required - free_mem
+                freed_variants += shift_model.model.free_patched_variants(memory_to_free)
+            if freed_variants > 0:
                 soft_empty_cache()
-    return unloaded_models
+                trace_span.set(bytes=freed_variants)
+
+            for x in sorted(can_unload):
+                i = x[-1]
+                memory_to_free = None
+                if not DISABLE_SMART_MEMORY:
+                    free_mem = get_free_memory(device)
+                    if free_mem > memory_required:
+                        break
+                    memory_to_free = memory_required - free_mem
+                logging.debug(f"Unloading {current_loaded_models[i].model.model.__class__.__name__}")
+                loaded_memory = current_loaded_models[i].model_loaded_memory()
+                if current_loaded_models[i].model_unload(memory_to_free):
+                    unloaded_model.append(i)
+                trace_span.set(bytes=trace_span.args.get("bytes", 0) + loaded_memory - current_loaded_models[i].model_loaded_memory())
+
+        for i in sorted(unloaded_model, reverse=True):
+            unloaded_models.append(current_loaded_models.pop(i))
+
+        if len(unloaded_model) > 0:
+            soft_empty_cache()
+        else:
+            if vram_state != VRAMState.HIGH_VRAM:
+                mem_free_total, mem_free_torch = get_free_memory(device, torch_free_too=True)
+                if mem_free_torch > mem_free_total * 0.25:
+                    soft_empty_cache()
+        return unloaded_models
 
 def load_models_gpu(models, memory_required=0, force_patch_weights=False, minimum_memory_required=None, force_full_load=False):
-    cleanup_models_gc()
-    global vram_state
-
-    inference_memory = minimum_inference_memory()
-    extra_mem = max(inference_memory, memory_required + extra_reserved_memory())
-    if minimum_memory_required is None:
-        minimum_memory_required = extra_mem
-    else:
-        minimum_memory_required = max(inference_memory, minimum_memory_required + extra_reserved_memory())
-
-    models = set(models)
+    with model_management_lock:
+        cleanup_models_gc()
+        global vram_state
+
+        inference_memory = minimum_inference_memory()
+        extra_mem = max(inference_memory, memory_required + extra_reserved_memory())
+        if minimum_memory_required is None:
+            minimum_memory_required = extra_mem
+        else:
+            minimum_memory_required = max(inference_memory, minimum_memory_required + extra_reserved_memory())
 
-    models_to_load = []
+        models = set(models)
 
-    for x in models:
-        loaded_model = LoadedModel(x)
-        try:
-            loaded_model_index = current_loaded_models.index(loaded_model)
-        except:
-            loaded_model_index = None
+        models_to_load = []
 
-        if loaded_model_index is not None:
-            loaded = current_loaded_models[loaded_model_index]
-            loaded.currently_used = True
-            models_to_load.append(loaded)
-        else:
-            if hasattr(x, "model"):
-                logging.info(f"Requested to load {x.model.__class__.__name__}")
-            models_to_load.append(loaded_model)
+        for x in models:
+            loaded_model = LoadedModel(x)
+            try:
+                loaded_model_index = current_loaded_models.index(loaded_model)
+            except:
+                loaded_model_index = None
 
-    for loaded_model in models_to_load:
-        to_unload = []
-        for i in range(len(current_loaded_models)):
-            if loaded_model.model.is_clone(current_loaded_models[i].model):
-                to_unload = [i] + to_unload
-        for i in to_unload:
-            current_loaded_models.pop(i).model.detach(unpatch_all=False)
-
-    total_memory_required = {}
-    for loaded_model in models_to_load:
-        total_memory_required[loaded_model.device] = total_memory_required.get(loaded_model.device, 0) + loaded_model.model_memory_required(loaded_model.device)
-
-    for device in total_memory_required:
-        if device != torch.device("cpu"):
-            free_memory(total_memory_required[device] * 1.1 + extra_mem, device)
-
-    for device in total_memory_required:
-        if device != torch.device("cpu"):
-            free_mem = get_free_memory(device)
-            if free_mem < minimum_memory_required:
-                models_l = free_memory(minimum_memory_required, device)
-                logging.info("{} models unloaded.".format(len(models_l)))
-
-    for loaded_model in models_to_load:
-        model = loaded_model.model
-        torch_dev = model.load_device
-        if is_device_cpu(torch_dev):
-            vram_set_state = VRAMState.DISABLED
-        else:
-            vram_set_state = vram_state
-        lowvram_model_memory = 0
-        if lowvram_available and (vram_set_state == VRAMState.LOW_VRAM or vram_set_state == VRAMState.NORMAL_VRAM) and not force_full_load:
-            loaded_memory = loaded_model.model_loaded_memory()
-            current_free_mem = get_free_memory(torch_dev) + loaded_memory
+            if loaded_model_index is not None:
+                loaded = current_loaded_models[loaded_model_index]
+                loaded.currently_used = True
+                models_to_load.append(loaded)
+            else:
+                if hasattr(x, "model"):
+                    logging.info(f"Requested to load {x.model.__class__.__name__}")
+                models_to_load.append(loaded_model)
+
+        for loaded_model in models_to_load:
+            to_unload = []
+            for i in range(len(current_loaded_models)):
+                if loaded_model.model.is_clone(current_loaded_models[i].model):
+                    to_unload = [i] + to_unload
+            for i in to_unload:
+                current_loaded_models.pop(i).model.detach(unpatch_all=False)
+
+        total_memory_required = {}
+        for loaded_model in models_to_load:
+            total_memory_required[loaded_model.device] = total_memory_required.get(loaded_model.device, 0) + loaded_model.model_memory_required(loaded_model.device)
+
+        for device in total_memory_required:
+            if device != torch.device("cpu"):
+                free_memory(total_memory_required[device] * 1.1 + extra_mem, device)
+
+        for device in total_memory_required:
+            if device != torch.device("cpu"):
+                free_mem = get_free_memory(device)
+                if free_mem < minimum_memory_required:
+                    models_l = free_memory(minimum_memory_required, device)
+                    logging.info("{} models unloaded.".format(len(models_l)))
+
+        for loaded_model in models_to_load:
+            model = loaded_model.model
+            torch_dev = model.load_device
+            if is_device_cpu(torch_dev):
+                vram_set_state = VRAMState.DISABLED
+            else:
+                vram_set_state = vram_state
+            lowvram_model_memory = 0
+            if lowvram_available and (vram_set_state == VRAMState.LOW_VRAM or vram_set_state == VRAMState.NORMAL_VRAM) and not force_full_load:
+                loaded_memory = loaded_model.model_loaded_memory()
+                current_free_mem = get_free_memory(torch_dev) + loaded_memory
 
-            lowvram_model_memory = max(128 * 1024 * 1024, (current_free_mem - minimum_memory_required), min(current_free_mem * MIN_WEIGHT_MEMORY_RATIO, current_free_mem - minimum_inference_memory()))
-            lowvram_model_memory = max(0.1, lowvram_model_memory - loaded_memory)
+                lowvram_model_memory = max(128 * 1024 * 1024, (current_free_mem - minimum_memory_required), min(current_free_mem * MIN_WEIGHT_MEMORY_RATIO, current_free_mem - minimum_inference_memory()))
+                lowvram_model_memory = max(0.1, lowvram_model_memory - loaded_memory)
 
-        if vram_set_state == VRAMState.NO_VRAM:
-            lowvram_model_memory = 0.1
+            if vram_set_state == VRAMState.NO_VRAM:
+                lowvram_model_memory = 0.1
 
-        loaded_model.model_load(lowvram_model_memory, force_patch_weights=force_patch_weights)
-        current_loaded_models.insert(0, loaded_model)
-    return
+            stats = get_model_stats(model)
+            stats.used(time.time(), USE_HALF_LIFE)
+            loaded_memory = loaded_model.model_loaded_memory()
+            start = time.perf_counter()
+            with comfy.load_trace.span("model_load", model=stats.name, lowvram_model_memory=lowvram_model_memory) as trace_span:
+                loaded_model.model_load(lowvram_model_memory, force_patch_weights=force_patch_weights)
+                loaded_bytes = loaded_model.model_loaded_memory() - loaded_memory
+                trace_span.set(bytes=loaded_bytes)
+            load_time = time.perf_counter() - start
+            if loaded_bytes > 0:
+                stats.misses += 1
+                stats.load_time += load_time
+                stats.loaded_bytes += loaded_bytes
+                stats.last_load_time = load_time
+            else:
+                stats.hits += 1
+            current_loaded_models.insert(0, loaded_model)
+        return
 
 def load_model_gpu(model):
     return load_models_gpu([model])
@@ -641,34 +814,36 @@ def loaded_models(only_currently_used=False):
 
 
 def cleanup_models_gc():
-    do_gc = False
-    for i in range(len(current_loaded_models)):
-        cur = current_loaded_models[i]
-        if cur.is_dead():
-            logging.info("Potential memory leak detected with model {}, doing a full garbage collect, for maximum performance avoid circular references in the model code.".format(cur.real_model().__class__.__name__))
-            do_gc = True
-            break
-
-    if do_gc:
-        gc.collect()
-        soft_empty_cache()
-
+    with model_management_lock:
+        do_gc = False
         for i in range(len(current_loaded_models)):
             cur = current_loaded_models[i]
             if cur.is_dead():
-                logging.warning("WARNING, memory leak with model {}. Please make sure it is not being referenced from somewhere.".format(cur.real_model().__class__.__name__))
+                logging.info("Potential memory leak detected with model {}, doing a full garbage collect, for maximum performance avoid circular references in the model code.".format(cur.real_model().__class__.__name__))
+                do_gc = True
+                break
+
+        if do_gc:
+            gc.collect()
+            soft_empty_cache()
+
+            for i in range(len(current_loaded_models)):
+                cur = current_loaded_models[i]
+                if cur.is_dead():
+                    logging.warning("WARNING, memory leak with model {}. Please make sure it is not being referenced from somewhere.".format(cur.real_model().__class__.__name__))
 
 
 
 def cleanup_models():
-    to_delete = []
-    for i in range(len(current_loaded_models)):
-        if current_loaded_models[i].real_model() is None:
-            to_delete = [i] + to_delete
+    with model_management_lock:
+        to_delete = []
+        for i in range(len(current_loaded_models)):
+            if current_loaded_models[i].real_model() is None:
+                to_delete = [i] + to_delete
 
-    for i in to_delete:
-        x = current_loaded_models.pop(i)
-        del x
+        for i in to_delete:
+            x = current_loaded_models.pop(i)
+            del x
 
 def dtype_size(dtype):
     dtype_size = 4
@@ -1248,27 +1423,71 @@ def soft_empty_cache(force=False):
 def unload_all_models():
     free_memory(1e30, get_torch_device())
 
+def unload_unused_models(device):
+    """
+    Unloads the models of device except the currently used ones, for prompt workers sharing a
+    device: another worker may still be sampling with them.
+    """
+    with model_management_lock:
+        free_memory(1e30, device, keep_loaded=[m for m in current_loaded_models if m.currently_used])
 
-#TODO: might be cleaner to put this somewhere else
-import threading
 
+#TODO: might be cleaner to put this somewhere else
 class InterruptProcessingException(Exception):
     pass
 
 interrupt_processing_mutex = threading.RLock()
 
 interrupt_processing = False
+# Prompts interrupted on their own, so that with several prompt workers only the thread executing
+# them stops. The prompt ids a thread executes are set with set_thread_interrupt_scope, along with an
+# optional threading.Event its execution sets to cancel the nodes still running.
+interrupted_prompts = set()
+thread_interrupt_scope = threading.local()
+
 def interrupt_current_processing(value=True):
     global interrupt_processing
     global interrupt_processing_mutex
     with interrupt_processing_mutex:
         interrupt_processing = value
 
+def interrupt_prompt(prompt_id):
+    with interrupt_processing_mutex:
+        interrupted_prompts.add(prompt_id)
+
+def get_interrupted_prompts(prompt_ids):
+    with interrupt_processing_mutex:
+        return interrupted_prompts.intersection(prompt_ids)
+
+def clear_prompt_interrupts(prompt_ids):
+    with interrupt_processing_mutex:
+        interrupted_prompts.difference_update(prompt_ids)
+
+def get_thread_interrupt_scope():
+    return getattr(thread_interrupt_scope, "prompt_ids", ())
+
+def set_thread_interrupt_scope(prompt_ids):
+    """Makes the interrupt checks of the calling thread also stop on interrupt_prompt of one of prompt_ids."""
+    thread_interrupt_scope.prompt_ids = tuple(prompt_ids)
+
+def get_thread_cancel_event():
+    return getattr(thread_interrupt_scope, "cancelled", None)
+
+def set_thread_cancel_event(cancelled):
+    """Makes the interrupt checks of the calling thread also stop once the threading.Event cancelled is set."""
+    thread_interrupt_scope.cancelled = cancelled
+
+def _scope_interrupted():
+    cancelled = get_thread_cancel_event()
+    if cancelled is not None and cancelled.is_set():
+        return True
+    return not interrupted_prompts.isdisjoint(get_thread_interrupt_scope())
+
 def processing_interrupted():
     global interrupt_processing
     global interrupt_processing_mutex
     with interrupt_processing_mutex:
-        return interrupt_processing
+        return interrupt_processing or _scope_interrupted()
 
 def throw_exception_if_processing_interrupted():
     global interrupt_processing
@@ -1277,3 +1496,6 @@ def throw_exception_if_processing_interrupted():
         if interrupt_processing:
             interrupt_processing = False
             raise InterruptProcessingException()
+        # Not cleared: every thread executing nodes of the prompt has to stop
+        if _scope_interrupted():
+            raise InterruptProcessingException()
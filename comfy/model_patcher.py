@@ -24,6 +24,7 @@ import inspect
 import logging
 import uuid
 import collections
+import itertools
 import math
 
 import comfy.utils
@@ -31,7 +32,12 @@ import comfy.float
 import comfy.model_management
 import comfy.lora
 import comfy.hooks
+import comfy.patched_weight_cache
+import comfy.host_tier
+import comfy.layer_streaming
+import comfy.load_trace
 import comfy.patcher_extension
+from comfy.cli_args import args
 from comfy.patcher_extension import CallbacksMP, WrappersMP, PatcherInjection
 from comfy.comfy_types import UnetWrapperFunction
 
@@ -103,6 +109,13 @@ def wipe_lowvram_weight(m):
     if hasattr(m, "bias_function"):
         m.bias_function = []
 
+    wipe_layer_streamer(m)
+
+def wipe_layer_streamer(m):
+    if getattr(m, "comfy_layer_streamer", None) is not None:
+        m.comfy_layer_streamer.clear()
+        m.comfy_layer_streamer = None
+
 def move_weight_functions(m, device):
     if device is None:
         return 0
@@ -541,33 +554,125 @@ class ModelPatcher:
                         sd.pop(k)
             return sd
 
+    def patched_weight_cache_key(self, key, dtype):
+        # The base weights of a model never change (patches are always reverted) so their digests are
+        # only computed the first time a key gets patched
+        digests = getattr(self.model, "base_weight_digests", None)
+        if digests is None:
+            digests = self.model.base_weight_digests = {}
+        base_digest = digests.get(key, None)
+        if base_digest is None:
+            base_digest = digests[key] = comfy.patched_weight_cache.tensor_digest(self.backup[key].weight)
+        return comfy.patched_weight_cache.patched_weight_key(key, base_digest, self.patches[key], dtype)
+
+    def _backup_weight(self, key, weight, inplace_update):
+        if key not in self.backup:
+            self.backup[key] = collections.namedtuple('Dimension', ['weight', 'inplace_update'])(weight.to(device=self.offload_device, copy=inplace_update), inplace_update)
+
+    def _set_patched_weight(self, key, out_weight, inplace_update):
+        if inplace_update:
+            comfy.utils.copy_to_param(self.model, key, out_weight)
+        else:
+            comfy.utils.set_attr_param(self.model, key, out_weight)
+
+    def _load_cached_patched_weight(self, key, weight, device_to, inplace_update):
+        """Returns (True, None) if the patched weight was set from the cache, (False, cache_key) otherwise."""
+        weight_cache = comfy.patched_weight_cache.get_cache()
+        if weight_cache is None:
+            return False, None
+        cache_key = self.patched_weight_cache_key(key, weight.dtype)
+        if cache_key is None:
+            return False, None
+        out_weight = weight_cache.get(cache_key)
+        if out_weight is None:
+            return False, cache_key
+        with comfy.load_trace.span("patched_weight_cache_hit", key=key, bytes=out_weight.nbytes):
+            out_weight = out_weight.to(device_to if device_to is not None else weight.device, copy=True)
+            self._set_patched_weight(key, out_weight, inplace_update)
+        return True, None
+
+    def _patch_temp_weight(self, weight, device_to, convert_func):
+        with comfy.load_trace.span("cast_to_float32", bytes=weight.nbytes):
+            if device_to is not None:
+                temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
+            else:
+                temp_weight = weight.to(torch.float32, copy=True)
+            if convert_func is not None:
+                temp_weight = convert_func(temp_weight, inplace=True)
+        return temp_weight
+
+    def _store_patched_weight(self, key, out_weight, weight, cache_key, inplace_update):
+        with comfy.load_trace.span("cast_to_weight_dtype", bytes=out_weight.nbytes):
+            out_weight = comfy.float.stochastic_rounding(out_weight, weight.dtype, seed=string_to_seed(key))
+        if cache_key is not None:
+            comfy.patched_weight_cache.get_cache().set(cache_key, out_weight)
+        self._set_patched_weight(key, out_weight, inplace_update)
+
     def patch_weight_to_device(self, key, device_to=None, inplace_update=False):
         if key not in self.patches:
             return
 
         weight, set_func, convert_func = get_key_weight(self.model, key)
         inplace_update = self.weight_inplace_update or inplace_update
+        self._backup_weight(key, weight, inplace_update)
 
-        if key not in self.backup:
-            self.backup[key] = collections.namedtuple('Dimension', ['weight', 'inplace_update'])(weight.to(device=self.offload_device, copy=inplace_update), inplace_update)
-
-        if device_to is not None:
-            temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
-        else:
-            temp_weight = weight.to(torch.float32, copy=True)
-        if convert_func is not None:
-            temp_weight = convert_func(temp_weight, inplace=True)
+        cache_key = None
+        if set_func is None:
+            loaded, cache_key = self._load_cached_patched_weight(key, weight, device_to, inplace_update)
+            if loaded:
+                return
 
-        out_weight = comfy.lora.calculate_weight(self.patches[key], temp_weight, key)
+        temp_weight = self._patch_temp_weight(weight, device_to, convert_func)
+        with comfy.load_trace.span("lora_patch", key=key, patches=len(self.patches[key]), bytes=temp_weight.nbytes):
+            out_weight = comfy.lora.calculate_weight(self.patches[key], temp_weight, key)
         if set_func is None:
-            out_weight = comfy.float.stochastic_rounding(out_weight, weight.dtype, seed=string_to_seed(key))
-            if inplace_update:
-                comfy.utils.copy_to_param(self.model, key, out_weight)
-            else:
-                comfy.utils.set_attr_param(self.model, key, out_weight)
+            self._store_patched_weight(key, out_weight, weight, cache_key, inplace_update)
         else:
             set_func(out_weight, inplace_update=inplace_update, seed=string_to_seed(key))
 
+    def patch_weights_to_device(self, keys, device_to=None, inplace_update=False):
+        """
+        patch_weight_to_device for a list of keys. Weights with the same shape and the same kind of
+        lora/loha/lokr patches (see comfy.lora.batched_patch_signature) are patched together with
+        batched matmuls, the rest one key at a time.
+        """
+        inplace_update = self.weight_inplace_update or inplace_update
+        groups = {}
+        for key in keys:
+            if key not in self.patches:
+                continue
+            weight, set_func, convert_func = get_key_weight(self.model, key)
+            signature = None
+            if set_func is None:
+                signature = comfy.lora.batched_patch_signature(self.patches[key], weight)
+            if signature is None:
+                self.patch_weight_to_device(key, device_to=device_to, inplace_update=inplace_update)
+            else:
+                groups.setdefault(signature, []).append(key)
+
+        for signature, group in groups.items():
+            if len(group) == 1:
+                self.patch_weight_to_device(group[0], device_to=device_to, inplace_update=inplace_update)
+                continue
+            numel = 1
+            for d in signature[0]:
+                numel *= d
+            batch_size = max(1, comfy.lora.BATCHED_PATCH_MAX_BYTES // max(1, numel * 4))
+            for i in range(0, len(group), batch_size):
+                pending = []
+                for key in group[i:i + batch_size]:
+                    weight, _, convert_func = get_key_weight(self.model, key)
+                    self._backup_weight(key, weight, inplace_update)
+                    loaded, cache_key = self._load_cached_patched_weight(key, weight, device_to, inplace_update)
+                    if not loaded:
+                        pending.append((key, weight, cache_key, self._patch_temp_weight(weight, device_to, convert_func)))
+                if len(pending) == 0:
+                    continue
+                with comfy.load_trace.span("lora_patch_batched", keys=len(pending), bytes=sum(p[3].nbytes for p in pending)):
+                    comfy.lora.calculate_weights_batched([(self.patches[key], temp_weight, key) for key, _, _, temp_weight in pending])
+                for key, weight, cache_key, temp_weight in pending:
+                    self._store_patched_weight(key, temp_weight, weight, cache_key, inplace_update)
+
     def _load_list(self):
         loading = []
         for n, m in self.model.named_modules():
@@ -583,6 +688,7 @@ class ModelPatcher:
                 loading.append((comfy.model_management.module_size(m), n, m, params))
         return loading
 
+    @comfy.load_trace.traced("ModelPatcher.load")
     def load(self, device_to=None, lowvram_model_memory=0, force_patch_weights=False, full_load=False):
         with self.use_ejected():
             self.unpatch_hooks()
@@ -652,6 +758,7 @@ class ModelPatcher:
                 mem_counter += move_weight_functions(m, device_to)
 
             load_completely.sort(reverse=True)
+            patch_keys = []
             for x in load_completely:
                 n = x[1]
                 m = x[2]
@@ -660,18 +767,23 @@ class ModelPatcher:
                     if m.comfy_patched_weights == True:
                         continue
 
-                for param in params:
-                    self.patch_weight_to_device("{}.{}".format(n, param), device_to=device_to)
+                patch_keys += ["{}.{}".format(n, param) for param in params]
 
                 logging.debug("lowvram: loaded module regularly {} {}".format(n, m))
                 m.comfy_patched_weights = True
 
-            for x in load_completely:
-                x[2].to(device_to)
+            self.patch_weights_to_device(patch_keys, device_to=device_to)
+
+            # Moved in model order so the first layers are ready first when the copies are asynchronous
+            module_order = {n: i for i, (n, _) in enumerate(self.model.named_modules())}
+            with comfy.load_trace.span("move_to_device", device=str(device_to), bytes=sum(x[0] for x in load_completely)):
+                comfy.host_tier.load([x[2] for x in sorted(load_completely, key=lambda x: module_order.get(x[1], 0))], device_to, owner=self.model)
 
             if lowvram_counter > 0:
                 logging.info("loaded partially {} {} {}".format(lowvram_model_memory / (1024 * 1024), mem_counter / (1024 * 1024), patch_counter))
                 self.model.model_lowvram = True
+                if device_to is not None:
+                    self.attach_layer_streamer(device_to)
             else:
                 logging.info("loaded completely {} {} {}".format(lowvram_model_memory / (1024 * 1024), mem_counter / (1024 * 1024), full_load))
                 self.model.model_lowvram = False
@@ -682,6 +794,7 @@ class ModelPatcher:
             self.model.lowvram_patch_counter += patch_counter
             self.model.device = device_to
             self.model.model_loaded_weight_memory = mem_counter
+            comfy.load_trace.annotate(bytes=mem_counter, lowvram_modules=lowvram_counter, lowvram_patches=patch_counter)
             self.model.current_weight_patches_uuid = self.patches_uuid
 
             for callback in self.get_all_callbacks(CallbacksMP.ON_LOAD):
@@ -709,6 +822,7 @@ class ModelPatcher:
     def unpatch_model(self, device_to=None, unpatch_weights=True):
         self.eject_model()
         if unpatch_weights:
+            self.clear_patched_variants()
             self.unpatch_hooks()
             if self.model.model_lowvram:
                 for m in self.model.modules():
@@ -731,7 +845,7 @@ class ModelPatcher:
             self.backup.clear()
 
             if device_to is not None:
-                self.model.to(device_to)
+                comfy.host_tier.offload(self.model, device_to)
                 self.model.device = device_to
             self.model.model_loaded_weight_memory = 0
 
@@ -745,7 +859,9 @@ class ModelPatcher:
 
         self.object_patches_backup.clear()
 
+    @comfy.load_trace.traced("ModelPatcher.partially_unload")
     def partially_unload(self, device_to, memory_to_free=0):
+        self.clear_patched_variants()
         with self.use_ejected():
             hooks_unpatched = False
             memory_freed = 0
@@ -785,7 +901,7 @@ class ModelPatcher:
                     bias_key = "{}.bias".format(n)
                     if move_weight:
                         cast_weight = self.force_cast_weights
-                        m.to(device_to)
+                        comfy.host_tier.offload(m, device_to, owner=self.model)
                         module_mem += move_weight_functions(m, device_to)
                         if lowvram_possible:
                             if weight_key in self.patches:
@@ -806,11 +922,92 @@ class ModelPatcher:
             self.model.model_lowvram = True
             self.model.lowvram_patch_counter += patch_counter
             self.model.model_loaded_weight_memory -= memory_freed
+            if memory_freed > 0:
+                self.attach_layer_streamer(self.load_device)
+            comfy.load_trace.annotate(bytes=memory_freed)
             return memory_freed
 
+    def attach_layer_streamer(self, device):
+        """With --lowvram-stream-layers, makes the modules that cast their weights on the fly prefetch them (see comfy.layer_streaming)."""
+        if args.lowvram_stream_layers <= 0:
+            return
+        streamer = comfy.layer_streaming.LayerStreamer(torch.device(device), ahead=args.lowvram_stream_layers)
+        for m in self.model.modules():
+            if getattr(m, "comfy_cast_weights", False) and hasattr(m, "prev_comfy_cast_weights"):
+                m.comfy_layer_streamer = streamer
+
+    def switch_patched_variant(self, device_to):
+        """
+        With --patched-variants, swaps the weights of another clone that are live on device_to for the
+        ones of this clone without unloading the model: the patched weights of the previous clone are
+        kept, the ones of this clone are reused if they were kept before or calculated otherwise.
+        Only the patched keys are duplicated, the other weights are shared. Returns False when the
+        model has to be reloaded the usual way.
+        """
+        if args.patched_variants <= 0 or self.model.model_lowvram or self.model.model_loaded_weight_memory <= 0:
+            return False
+        if self.model.device != device_to or self.weight_inplace_update or len(self.hook_backup) > 0:
+            return False
+        if any(bk.inplace_update for bk in self.backup.values()):
+            return False
+        model_keys = set(self.model.state_dict().keys())
+        keys = [k for k in self.patches if k in model_keys]
+        if any(get_key_weight(self.model, k)[1] is not None for k in itertools.chain(keys, self.backup)):
+            return False
+
+        variants = getattr(self.model, "patched_variants", None)
+        if variants is None:
+            variants = self.model.patched_variants = collections.OrderedDict()
+        with comfy.load_trace.span("switch_patched_variant", keys=len(keys)):
+            variants[self.model.current_weight_patches_uuid] = {k: comfy.utils.get_attr(self.model, k) for k in self.backup}
+            variant = variants.pop(self.patches_uuid, None)
+            new_keys = set(keys) if variant is None else set(variant.keys())
+            for k in list(self.backup.keys()):
+                bk = self.backup[k]
+                if k in new_keys:
+                    # The original weight, only read by patch_weight_to_device
+                    comfy.utils.set_attr_param(self.model, k, bk.weight)
+                else:
+                    comfy.utils.set_attr_param(self.model, k, bk.weight.to(device_to, copy=True))
+                    self.backup.pop(k)
+            if variant is None:
+                self.patch_weights_to_device(keys, device_to=device_to)
+            else:
+                for k, weight in variant.items():
+                    if k not in self.backup:
+                        self._backup_weight(k, comfy.utils.get_attr(self.model, k), False)
+                    comfy.utils.set_attr_param(self.model, k, weight)
+            while len(variants) > args.patched_variants:
+                variants.popitem(last=False)
+        self.model.current_weight_patches_uuid = self.patches_uuid
+        return True
+
+    def clear_patched_variants(self):
+        if getattr(self.model, "patched_variants", None):
+            self.model.patched_variants.clear()
+
+    def patched_variants_size(self):
+        """Memory used by the patched weights kept by switch_patched_variant, on top of loaded_size()."""
+        variants = getattr(self.model, "patched_variants", None)
+        if not variants:
+            return 0
+        return sum(weight.nbytes for variant in variants.values() for weight in variant.values())
+
+    def free_patched_variants(self, memory_to_free=None):
+        """Drops the least recently used kept variants until memory_to_free bytes are freed (all of them if None). Returns the bytes freed."""
+        variants = getattr(self.model, "patched_variants", None)
+        freed = 0
+        while variants and (memory_to_free is None or freed < memory_to_free):
+            _, variant = variants.popitem(last=False)
+            freed += sum(weight.nbytes for weight in variant.values())
+        return freed
+
+    @comfy.load_trace.traced("ModelPatcher.partially_load")
     def partially_load(self, device_to, extra_memory=0, force_patch_weights=False):
         with self.use_ejected(skip_and_inject_on_exit_only=True):
             unpatch_weights = self.model.current_weight_patches_uuid is not None and (self.model.current_weight_patches_uuid != self.patches_uuid or force_patch_weights)
+            if unpatch_weights and not force_patch_weights and self.switch_patched_variant(device_to):
+                unpatch_weights = False
             # TODO: force_patch_weights should not unload + reload full model
             used = self.model.model_loaded_weight_memory
             self.unpatch_model(self.offload_device, unpatch_weights=unpatch_weights)
@@ -1092,6 +1289,7 @@ class ModelPatcher:
             callback(self, hooks)
         return comfy.hooks.create_transformer_options_from_hooks(self, hooks, transformer_options)
 
+    @comfy.load_trace.traced("patch_hooks")
     def patch_hooks(self, hooks: comfy.hooks.HookGroup):
         with self.use_ejected():
             if hooks is not None:
@@ -37,8 +37,17 @@ def cast_bias_weight(s, input=None, dtype=None, device=None, bias_dtype=None):
         if device is None:
             device = input.device
 
+    streamer = getattr(s, "comfy_layer_streamer", None)
+    if streamer is not None:
+        prefetched = streamer.cast(s, dtype, device, bias_dtype, cast_module_weights)
+        if prefetched is not None:
+            return prefetched
+    return cast_module_weights(s, dtype, device, bias_dtype)
+
+def cast_module_weights(s, dtype, device, bias_dtype, non_blocking=None):
     bias = None
-    non_blocking = comfy.model_management.device_supports_non_blocking(device)
+    if non_blocking is None:
+        non_blocking = comfy.model_management.device_supports_non_blocking(device)
     if s.bias is not None:
         has_function = len(s.bias_function) > 0
         bias = comfy.model_management.cast_to(s.bias, bias_dtype, device, non_blocking=non_blocking, copy=has_function)
@@ -57,6 +66,7 @@ class CastWeightBiasOp:
     comfy_cast_weights = False
     weight_function = []
     bias_function = []
+    comfy_layer_streamer = None
 
 class disable_weight_init:
     class Linear(torch.nn.Linear, CastWeightBiasOp):
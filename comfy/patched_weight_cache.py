@@ -0,0 +1,165 @@
+import collections
+import hashlib
+import logging
+import struct
+import threading
+import weakref
+
+import torch
+
+from comfy.cli_args import args
+import comfy.weight_adapter as weight_adapter
+
+# Digests of tensors that are hashed often (base weights, LoRA weights), valid as long as the tensor is alive
+_tensor_digests = {}
+_tensor_digests_lock = threading.Lock()
+
+
+def _tensor_version(t):
+    try:
+        return t._version
+    except RuntimeError:
+        # Inference tensors don't track in place changes
+        return None
+
+
+def tensor_digest(t):
+    """sha256 of the dtype, shape and data of a tensor, memoized for the lifetime of the tensor object."""
+    key = id(t)
+    version = _tensor_version(t)
+    with _tensor_digests_lock:
+        memo = _tensor_digests.get(key, None)
+        if memo is not None and memo[0]() is t and memo[1] == version:
+            return memo[2]
+
+    data = t.detach().to("cpu").contiguous()
+    h = hashlib.sha256()
+    h.update("{}{}".format(t.dtype, tuple(t.shape)).encode())
+    if data.numel() > 0:
+        h.update(memoryview(data.reshape(-1).view(torch.uint8).numpy()))
+    digest = h.digest()
+
+    def forget(_, key=key):
+        with _tensor_digests_lock:
+            _tensor_digests.pop(key, None)
+    with _tensor_digests_lock:
+        _tensor_digests[key] = (weakref.ref(t, forget), version, digest)
+    return digest
+
+
+def _encode(obj, h):
+    if obj is None or isinstance(obj, (bool, int, str)):
+        h.update("{}:{!r};".format(type(obj).__name__, obj).encode())
+    elif isinstance(obj, float):
+        h.update(b"f" + struct.pack("<d", obj))
+    elif isinstance(obj, torch.Tensor):
+        h.update(b"t" + tensor_digest(obj))
+    elif isinstance(obj, tuple):
+        h.update(b"(%d" % len(obj))
+        for x in obj:
+            if not _encode(x, h):
+                return False
+        h.update(b")")
+    elif isinstance(obj, dict):
+        h.update(b"{%d" % len(obj))
+        for k in sorted(obj):
+            if not isinstance(k, str) or not _encode(k, h) or not _encode(obj[k], h):
+                return False
+        h.update(b"}")
+    elif isinstance(obj, weight_adapter.WeightAdapterBase):
+        h.update("adapter:{}:".format(type(obj).__name__).encode())
+        return _encode(tuple(obj.weights), h)
+    else:
+        return False
+    return True
+
+
+def patched_weight_key(key, base_digest, patches, dtype):
+    """
+    Digest of everything the merged weight depends on: the base weight (its tensor_digest), the
+    patches with their strengths and the dtype of the result. Returns None for patches that can't
+    be cached: nested model patches, custom functions or patches that read other model weights.
+    """
+    h = hashlib.sha256()
+    h.update("{}:{}:".format(key, dtype).encode())
+    h.update(base_digest)
+    for strength, v, strength_model, offset, function in patches:
+        if function is not None or isinstance(v, list):
+            return None
+        if isinstance(v, tuple) and len(v) == 2 and v[0] == "model_as_lora":
+            return None
+        if not _encode((strength, strength_model, offset), h) or not _encode(v, h):
+            return None
+    return h.digest()
+
+
+class PatchedWeightCache:
+    """
+    LRU cache of weights with their LoRAs (or other patches) already merged, kept in CPU memory
+    and optionally in a DiskCache directory, so going back to a LoRA combination that was used
+    before skips calculate_weight.
+    """
+    def __init__(self, max_bytes, disk_cache=None):
+        self.max_bytes = max_bytes
+        self.disk_cache = disk_cache
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cache_key):
+        with self.lock:
+            weight = self.entries.get(cache_key, None)
+            if weight is not None:
+                self.entries.move_to_end(cache_key)
+                self.hits += 1
+                return weight
+        if self.disk_cache is not None:
+            weight = self.disk_cache.get(cache_key)
+            if weight is not None:
+                self._store(cache_key, weight)
+                with self.lock:
+                    self.hits += 1
+                return weight
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, cache_key, weight):
+        weight = weight.detach().to("cpu", copy=True)
+        self._store(cache_key, weight)
+        if self.disk_cache is not None:
+            self.disk_cache.set(cache_key, weight)
+
+    def _store(self, cache_key, weight):
+        size = weight.nbytes
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if cache_key in self.entries:
+                return
+            self.entries[cache_key] = weight
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted.nbytes
+
+
+_cache = None
+_cache_initialized = False
+
+
+def get_cache():
+    """The cache configured with --lora-cache-gb / --lora-cache-directory, or None when disabled."""
+    global _cache, _cache_initialized
+    if not _cache_initialized:
+        _cache_initialized = True
+        if args.lora_cache_gb > 0 or args.lora_cache_directory is not None:
+            disk_cache = None
+            if args.lora_cache_directory is not None:
+                from comfy_execution.disk_cache import DiskCache
+                disk_cache = DiskCache(args.lora_cache_directory, max_bytes=int(args.lora_cache_disk_gb * (1024 ** 3)))
+            _cache = PatchedWeightCache(int(args.lora_cache_gb * (1024 ** 3)), disk_cache=disk_cache)
+            logging.info("Caching merged LoRA weights: {} GB of RAM, disk: {}".format(args.lora_cache_gb, args.lora_cache_directory))
+    return _cache
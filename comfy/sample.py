@@ -50,3 +50,37 @@ def sample_custom(model, noise, cfg, sampler, sigmas, positive, negative, latent
     samples = comfy.samplers.sample(model, noise, positive, negative, cfg, model.load_device, sampler, sigmas, model_options=model.model_options, latent_image=latent_image, denoise_mask=noise_mask, callback=callback, disable_pbar=disable_pbar, seed=seed)
     samples = samples.to(comfy.model_management.intermediate_device())
     return samples
+
+def _same_option(a, b):
+    return a is b or (isinstance(a, (int, float, str, bool)) and type(a) is type(b) and a == b)
+
+def batch_conditioning(conds, batch_sizes, batched_options=("pooled_output",)):
+    """
+    Concatenates the conditioning of jobs that are sampled together along the batch dimension, each
+    one repeated to the batch size of its latent. Returns None if the conditionings don't line up:
+    different number of conds, shapes or options other than the batched_options tensors.
+    """
+    if any(len(c) != len(conds[0]) for c in conds):
+        return None
+
+    def concat(tensors):
+        if any(not isinstance(t, torch.Tensor) or t.shape[1:] != tensors[0].shape[1:] or t.shape[0] not in (1, b) for t, b in zip(tensors, batch_sizes)):
+            return None
+        return torch.cat([comfy.utils.repeat_to_batch_size(t, b) for t, b in zip(tensors, batch_sizes)])
+
+    out = []
+    for entries in zip(*conds):
+        cond = concat([e[0] for e in entries])
+        if cond is None or any(e[1].keys() != entries[0][1].keys() for e in entries):
+            return None
+        options = {}
+        for k, v in entries[0][1].items():
+            if k in batched_options and isinstance(v, torch.Tensor):
+                v = concat([e[1][k] for e in entries])
+                if v is None:
+                    return None
+            elif any(not _same_option(v, e[1][k]) for e in entries):
+                return None
+            options[k] = v
+        out.append([cond, options])
+    return out
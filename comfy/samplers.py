@@ -16,6 +16,8 @@ import comfy.sampler_helpers
 import comfy.model_patcher
 import comfy.patcher_extension
 import comfy.hooks
+import comfy.memory_model
+import comfy.step_cache
 import scipy.stats
 import numpy
 
@@ -252,13 +254,24 @@ def _calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Te
             to_batch_temp.reverse()
             to_batch = to_batch_temp[:1]
 
-            free_memory = model_management.get_free_memory(x_in.device)
-            for i in range(1, len(to_batch_temp) + 1):
-                batch_amount = to_batch_temp[:len(to_batch_temp)//i]
-                input_shape = [len(batch_amount) * first_shape[0]] + list(first_shape)[1:]
-                if model.memory_required(input_shape) * 1.5 < free_memory:
-                    to_batch = batch_amount
-                    break
+            memory_model = getattr(model, "memory_model", None)
+            variant = None if first[0].control is None else "control"
+            decision_key = (tuple(first_shape), len(to_batch_temp), variant)
+            batch_count = None
+            if memory_model is not None:
+                batch_count = memory_model.cached_batch(decision_key)
+            if batch_count is not None:
+                to_batch = to_batch_temp[:batch_count]
+            else:
+                free_memory = model_management.get_free_memory(x_in.device)
+                for i in range(1, len(to_batch_temp) + 1):
+                    batch_amount = to_batch_temp[:len(to_batch_temp)//i]
+                    input_shape = [len(batch_amount) * first_shape[0]] + list(first_shape)[1:]
+                    if comfy.memory_model.batch_fits(model, input_shape, free_memory, variant):
+                        to_batch = batch_amount
+                        break
+                if memory_model is not None:
+                    memory_model.cache_batch(decision_key, len(to_batch))
 
             input_x = []
             mult = []
@@ -310,13 +323,14 @@ def _calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Te
 
             c['transformer_options'] = transformer_options
 
-            if control is not None:
-                c['control'] = control.get_control(input_x, timestep_, c, len(cond_or_uncond), transformer_options)
+            with comfy.memory_model.measure_peak(memory_model, x_in.device, input_x.shape, variant):
+                if control is not None:
+                    c['control'] = control.get_control(input_x, timestep_, c, len(cond_or_uncond), transformer_options)
 
-            if 'model_function_wrapper' in model_options:
-                output = model_options['model_function_wrapper'](model.apply_model, {"input": input_x, "timestep": timestep_, "c": c, "cond_or_uncond": cond_or_uncond}).chunk(batch_chunks)
-            else:
-                output = model.apply_model(input_x, timestep_, **c).chunk(batch_chunks)
+                if 'model_function_wrapper' in model_options:
+                    output = model_options['model_function_wrapper'](model.apply_model, {"input": input_x, "timestep": timestep_, "c": c, "cond_or_uncond": cond_or_uncond}).chunk(batch_chunks)
+                else:
+                    output = model.apply_model(input_x, timestep_, **c).chunk(batch_chunks)
 
             for o in range(batch_chunks):
                 cond_index = cond_or_uncond[o]
@@ -358,6 +372,14 @@ def cfg_function(model, cond_pred, uncond_pred, cond_scale, x, timestep, model_o
 
     return cfg_result
 
+def calc_cond_batch_cached(step_cache, model, conds, x, timestep, model_options):
+    if step_cache.may_skip(x, timestep):
+        cond_pred = calc_cond_batch(model, conds[:1], x, timestep, model_options)[0]
+        return [cond_pred, step_cache.uncond_estimate(cond_pred)]
+    out = calc_cond_batch(model, conds, x, timestep, model_options)
+    step_cache.update(out[0], out[1])
+    return out
+
 #The main sampling function shared by all the samplers
 #Returns denoised
 def sampling_function(model, x, timestep, uncond, cond, cond_scale, model_options={}, seed=None):
@@ -367,7 +389,11 @@ def sampling_function(model, x, timestep, uncond, cond, cond_scale, model_option
         uncond_ = uncond
 
     conds = [cond, uncond_]
-    out = calc_cond_batch(model, conds, x, timestep, model_options)
+    step_cache = model_options.get("step_cache_state", None)
+    if step_cache is not None and uncond_ is not None:
+        out = calc_cond_batch_cached(step_cache, model, conds, x, timestep, model_options)
+    else:
+        out = calc_cond_batch(model, conds, x, timestep, model_options)
 
     for fn in model_options.get("sampler_pre_cfg_function", []):
         args = {"conds":conds, "conds_out": out, "cond_scale": cond_scale, "timestep": timestep,
@@ -924,6 +950,7 @@ class CFGGuider:
         self.model_options = model_patcher.model_options
         self.original_conds = {}
         self.cfg = 1.0
+        self.step_cache_stats = None
 
     def set_conds(self, positive, negative):
         self.inner_set_conds({"positive": positive, "negative": negative})
@@ -949,6 +976,9 @@ class CFGGuider:
 
         extra_model_options = comfy.model_patcher.create_model_options_clone(self.model_options)
         extra_model_options.setdefault("transformer_options", {})["sample_sigmas"] = sigmas
+        step_cache = comfy.step_cache.StepCache.from_options(self.inner_model, extra_model_options)
+        if step_cache is not None:
+            extra_model_options["step_cache_state"] = step_cache
         extra_args = {"model_options": extra_model_options, "seed": seed}
 
         executor = comfy.patcher_extension.WrapperExecutor.new_class_executor(
@@ -957,6 +987,9 @@ class CFGGuider:
             comfy.patcher_extension.get_all_wrappers(comfy.patcher_extension.WrappersMP.SAMPLER_SAMPLE, extra_args["model_options"], is_model_options=True)
         )
         samples = executor.execute(self, sigmas, extra_args, callback, noise, latent_image, denoise_mask, disable_pbar)
+        if step_cache is not None:
+            step_cache.log_stats()
+            self.step_cache_stats = step_cache.get_stats()
         return self.inner_model.process_latent_out(samples.to(torch.float32))
 
     def outer_sample(self, noise, latent_image, sampler, sigmas, denoise_mask=None, callback=None, disable_pbar=False, seed=None):
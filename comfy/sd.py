@@ -44,6 +44,7 @@ import comfy.text_encoders.wan
 import comfy.text_encoders.hidream
 
 import comfy.model_patcher
+import comfy.conditioning_cache
 import comfy.lora
 import comfy.lora_convert
 import comfy.hooks
@@ -212,8 +213,7 @@ class CLIP:
         if return_pooled == "unprojected":
             self.cond_stage_model.set_clip_options({"projected_pooled": False})
 
-        self.load_model()
-        o = self.cond_stage_model.encode_token_weights(tokens)
+        o = self.encode_token_weights(tokens, unprojected=return_pooled == "unprojected")
         cond, pooled = o[:2]
         if return_dict:
             out = {"cond": cond, "pooled_output": pooled}
@@ -227,6 +227,27 @@ class CLIP:
             return cond, pooled
         return cond
 
+    def encode_token_weights(self, tokens, unprojected=False):
+        """
+        Loads the model and runs cond_stage_model.encode_token_weights with the clip options already
+        set, through the conditioning cache when it is enabled and no hooks are patched in.
+        """
+        cache = comfy.conditioning_cache.get_cache()
+        cache_key = None
+        if cache is not None and self.patcher.forced_hooks is None and len(self.patcher.hook_patches) == 0:
+            options = {"layer": self.layer_idx, "unprojected": unprojected}
+            cache_key = comfy.conditioning_cache.conditioning_key(self.cond_stage_model, self.patcher.patches_uuid, options, tokens)
+            if cache_key is not None:
+                o = cache.get(cache_key)
+                if o is not None:
+                    return o
+
+        self.load_model()
+        o = self.cond_stage_model.encode_token_weights(tokens)
+        if cache_key is not None:
+            cache.set(cache_key, o)
+        return o
+
     def encode(self, text):
         tokens = self.tokenize(text)
         return self.encode_from_tokens(tokens)
@@ -1089,7 +1110,8 @@ def load_diffusion_model_state_dict(sd, model_options={}): #load unet in diffuse
 
 
 def load_diffusion_model(unet_path, model_options={}):
-    sd = comfy.utils.load_torch_file(unet_path)
+    # The weights end up in the requested dtype, converting them while the file is read overlaps the two
+    sd = comfy.utils.load_torch_file(unet_path, dtype=model_options.get("dtype", None))
     model = load_diffusion_model_state_dict(sd, model_options=model_options)
     if model is None:
         logging.error("ERROR UNSUPPORTED UNET {}".format(unet_path))
@@ -1,4 +1,7 @@
 import os
+import collections
+import functools
+import threading
 
 from transformers import CLIPTokenizer
 import comfy.ops
@@ -338,6 +341,11 @@ def token_weights(string, current_weight):
             out += [(x, current_weight)]
     return out
 
+@functools.lru_cache(maxsize=4096)
+def parsed_token_weights(text):
+    """token_weights(text, 1.0) memoized: every tokenizer of a model parses the same prompt."""
+    return tuple(token_weights(text, 1.0))
+
 def escape_important(text):
     text = text.replace("\\)", "\0\1")
     text = text.replace("\\(", "\0\2")
@@ -385,7 +393,7 @@ def bundled_embed(embed, prefix, suffix): #bundled embedding in lora format
 
     return torch.cat(out_list, dim=0)
 
-def load_embed(embedding_name, embedding_directory, embedding_size, embed_key=None):
+def find_embed_file(embedding_name, embedding_directory):
     if isinstance(embedding_directory, str):
         embedding_directory = [embedding_directory]
 
@@ -412,11 +420,15 @@ def load_embed(embedding_name, embedding_directory, embedding_size, embed_key=No
         if valid_file is not None:
             break
 
-    if valid_file is None:
-        return None
+    return valid_file
 
-    embed_path = valid_file
+def load_embed(embedding_name, embedding_directory, embedding_size, embed_key=None):
+    embed_path = find_embed_file(embedding_name, embedding_directory)
+    if embed_path is None:
+        return None
+    return load_embed_file(embed_path, embedding_name, embedding_size, embed_key)
 
+def load_embed_file(embed_path, embedding_name, embedding_size, embed_key=None):
     embed_out = None
 
     try:
@@ -456,6 +468,41 @@ def load_embed(embedding_name, embedding_directory, embedding_size, embed_key=No
                 embed_out = next(iter(values))
     return embed_out
 
+EMBED_CACHE_SIZE = 256
+_embed_cache = collections.OrderedDict() # (name, directories, size, key) -> (path, file mtime and size, embedding)
+_embed_cache_lock = threading.Lock()
+
+def _embed_file_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def load_embed_cached(embedding_name, embedding_directory, embedding_size, embed_key=None):
+    """load_embed memoized, the embedding is loaded again when its file changes."""
+    directories = (embedding_directory,) if isinstance(embedding_directory, str) else tuple(embedding_directory)
+    key = (embedding_name, directories, embedding_size, embed_key)
+    with _embed_cache_lock:
+        entry = _embed_cache.get(key, None)
+    if entry is not None and entry[1] == _embed_file_key(entry[0]):
+        with _embed_cache_lock:
+            if key in _embed_cache:
+                _embed_cache.move_to_end(key)
+        return entry[2]
+
+    embed_path = find_embed_file(embedding_name, embedding_directory)
+    if embed_path is None:
+        return None
+    file_key = _embed_file_key(embed_path)
+    embed = load_embed_file(embed_path, embedding_name, embedding_size, embed_key)
+    if embed is not None:
+        with _embed_cache_lock:
+            _embed_cache[key] = (embed_path, file_key, embed)
+            while len(_embed_cache) > EMBED_CACHE_SIZE:
+                _embed_cache.popitem(last=False)
+    return embed
+
 class SDTokenizer:
     def __init__(self, tokenizer_path=None, max_length=77, pad_with_end=True, embedding_directory=None, embedding_size=768, embedding_key='clip_l', tokenizer_class=CLIPTokenizer, has_start_token=True, has_end_token=True, pad_to_max_length=True, min_length=None, pad_token=None, end_token=None, tokenizer_data={}, tokenizer_args={}):
         if tokenizer_path is None:
@@ -500,6 +547,29 @@ class SDTokenizer:
         self.embedding_identifier = "embedding:"
         self.embedding_size = embedding_size
         self.embedding_key = embedding_key
+        self.word_ids_cache = {}
+        self.word_ids_cache_size = 65536
+
+    def tokenize_words(self, words):
+        '''
+        Returns the input_ids of each of the words, the ones that weren't tokenized recently are
+        tokenized with a single batched call of the tokenizer.
+        '''
+        out = {}
+        missing = []
+        for word in words:
+            ids = self.word_ids_cache.get(word, None)
+            if ids is not None:
+                out[word] = ids
+            elif word not in out:
+                out[word] = None
+                missing.append(word)
+        if len(missing) > 0:
+            if len(self.word_ids_cache) + len(missing) > self.word_ids_cache_size:
+                self.word_ids_cache.clear()
+            for word, ids in zip(missing, self.tokenizer(missing)["input_ids"]):
+                out[word] = self.word_ids_cache[word] = ids
+        return [out[word] for word in words]
 
     def _try_get_embedding(self, embedding_name:str):
         '''
@@ -509,11 +579,11 @@ class SDTokenizer:
         split_embed = embedding_name.split()
         embedding_name = split_embed[0]
         leftover = ' '.join(split_embed[1:])
-        embed = load_embed(embedding_name, self.embedding_directory, self.embedding_size, self.embedding_key)
+        embed = load_embed_cached(embedding_name, self.embedding_directory, self.embedding_size, self.embedding_key)
         if embed is None:
             stripped = embedding_name.strip(',')
             if len(stripped) < len(embedding_name):
-                embed = load_embed(stripped, self.embedding_directory, self.embedding_size, self.embedding_key)
+                embed = load_embed_cached(stripped, self.embedding_directory, self.embedding_size, self.embedding_key)
                 return (embed, "{} {}".format(embedding_name[len(stripped):], leftover))
         return (embed, leftover)
 
@@ -527,10 +597,11 @@ class SDTokenizer:
         '''
 
         text = escape_important(text)
-        parsed_weights = token_weights(text, 1.0)
+        parsed_weights = parsed_token_weights(text)
 
-        # tokenize words
+        # split the prompt in words and embeddings, the words are tokenized together afterwards
         tokens = []
+        words = []
         for weighted_segment, weight in parsed_weights:
             to_tokenize = unescape_important(weighted_segment)
             split = re.split(' {0}|\n{0}'.format(self.embedding_identifier), to_tokenize)
@@ -556,11 +627,15 @@ class SDTokenizer:
                         word = leftover
                     else:
                         continue
-                end = 999999999999
-                if self.tokenizer_adds_end_token:
-                    end = -1
-                #parse word
-                tokens.append([(t, weight) for t in self.tokenizer(word)["input_ids"][self.tokens_start:end]])
+                words.append((len(tokens), word, weight))
+                tokens.append(None)
+
+        #parse words
+        end = 999999999999
+        if self.tokenizer_adds_end_token:
+            end = -1
+        for (i, _, weight), ids in zip(words, self.tokenize_words([w for _, w, _ in words])):
+            tokens[i] = [(t, weight) for t in ids[self.tokens_start:end]]
 
         #reshape token array to CLIP input size
         batched_tokens = []
@@ -0,0 +1,97 @@
+"""
+Skips model evaluations of the uncond during sampling. Late in the schedule the difference between
+the cond and uncond predictions changes very little from one step to the next, so once the sampling
+is past start_percent the uncond prediction of a step can be estimated from the cond prediction and
+the difference measured at the last step the uncond was evaluated. The relative change of the cond
+prediction between steps is accumulated as the error estimate. A step is skipped only if the error
+with the change of the previous step added stays under the threshold, and at most max_skipped_steps
+steps in a row. This is decided before the model call so a step runs either the cond alone or the
+cond and uncond batched together, never both one after the other.
+
+The cache works on the model calls themselves so every sampler, including the ones calling the
+model more than once per step, uses it unchanged.
+"""
+import logging
+
+from comfy.cli_args import args
+
+DEFAULT_OPTIONS = {"threshold": 0.05, "start_percent": 0.5, "max_skipped_steps": 2}
+
+# Options by model type (the name of the BaseModel class). Video models run many steps over large
+# latents and tolerate more reuse.
+MODEL_TYPE_OPTIONS = {
+    "WAN21": {"threshold": 0.15, "start_percent": 0.3, "max_skipped_steps": 3},
+    "HunyuanVideo": {"threshold": 0.15, "start_percent": 0.3, "max_skipped_steps": 3},
+    "CosmosVideo": {"threshold": 0.1, "start_percent": 0.3, "max_skipped_steps": 3},
+    "GenmoMochi": {"threshold": 0.1, "start_percent": 0.3, "max_skipped_steps": 3},
+    "LTXV": {"threshold": 0.1, "start_percent": 0.4, "max_skipped_steps": 2},
+}
+
+
+def model_type_options(model):
+    options = dict(DEFAULT_OPTIONS)
+    options.update(MODEL_TYPE_OPTIONS.get(type(model).__name__, {}))
+    return options
+
+
+class StepCache:
+    def __init__(self, threshold, start_sigma, max_skipped_steps):
+        self.threshold = threshold
+        self.start_sigma = start_sigma
+        self.max_skipped_steps = max_skipped_steps
+        self.delta = None  # cond prediction - uncond prediction at the last evaluation of the uncond
+        self.last_cond = None
+        self.last_change = None  # relative change of the cond prediction at the last step
+        self.error = 0.0
+        self.skipped_in_row = 0
+        self.evaluations = 0
+        self.skipped = 0
+
+    @classmethod
+    def from_options(cls, model, model_options):
+        """The cache of a sampling run with the options of the model, None if it isn't enabled."""
+        options = model_options.get("step_cache", None)
+        if options is None:
+            if not args.step_cache:
+                return None
+            options = model_type_options(model)
+        if options["threshold"] <= 0 or options["max_skipped_steps"] <= 0:
+            return None
+        start_sigma = float(model.model_sampling.percent_to_sigma(options["start_percent"]))
+        return cls(options["threshold"], start_sigma, options["max_skipped_steps"])
+
+    def may_skip(self, x, timestep):
+        """If the uncond of this step is skipped, expecting the cond prediction to change as much as at the last step."""
+        return (self.delta is not None and self.delta.shape == x.shape and self.skipped_in_row < self.max_skipped_steps
+                and float(timestep.max()) <= self.start_sigma
+                and self.last_change is not None and self.error + self.last_change < self.threshold)
+
+    def _observe(self, cond_pred):
+        if self.last_cond is not None and self.last_cond.shape == cond_pred.shape:
+            self.last_change = ((cond_pred - self.last_cond).abs().mean() / self.last_cond.abs().mean().clamp(min=1e-6)).item()
+        else:
+            self.last_change = None
+        self.last_cond = cond_pred
+
+    def uncond_estimate(self, cond_pred):
+        """The estimated uncond prediction of a skipped step."""
+        self._observe(cond_pred)
+        self.error += self.last_change
+        self.skipped_in_row += 1
+        self.skipped += 1
+        self.evaluations += 1
+        return cond_pred - self.delta
+
+    def update(self, cond_pred, uncond_pred):
+        self._observe(cond_pred)
+        self.delta = cond_pred - uncond_pred
+        self.error = 0.0
+        self.skipped_in_row = 0
+        self.evaluations += 1
+
+    def get_stats(self):
+        return {"evaluations": self.evaluations, "skipped": self.skipped}
+
+    def log_stats(self):
+        if self.evaluations > 0:
+            logging.info("Step cache: skipped {} of {} uncond evaluations".format(self.skipped, self.evaluations))
@@ -17,10 +17,17 @@
 """
 
 
+import os
 import torch
 import math
 import struct
+import json
+import mmap
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import comfy.checkpoint_pickle
+import comfy.load_trace
 import safetensors.torch
 import numpy as np
 from PIL import Image
@@ -28,6 +35,7 @@ import logging
 import itertools
 from torch.nn.functional import interpolate
 from einops import rearrange
+from comfy.cli_args import args
 
 ALWAYS_SAFE_LOAD = False
 if hasattr(torch.serialization, "add_safe_globals"):  # TODO: this was added in pytorch 2.4, the unsafe path should be removed once earlier versions are deprecated
@@ -46,16 +54,193 @@ if hasattr(torch.serialization, "add_safe_globals"):  # TODO: this was added in
 else:
     logging.info("Warning, you are using an old pytorch version and some ckpt/pt files might be loaded unsafely. Upgrading to 2.4 or above is recommended.")
 
-def load_torch_file(ckpt, safe_load=False, device=None, return_metadata=False):
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    SAFETENSORS_DTYPES["F8_E4M3"] = torch.float8_e4m3fn
+    SAFETENSORS_DTYPES["F8_E5M2"] = torch.float8_e5m2
+
+MMAP_SAFETENSORS = sys.byteorder == "little" and not args.disable_mmap
+
+def read_safetensors_header(ckpt):
+    with open(ckpt, "rb") as fp:
+        header_size = struct.unpack("<Q", fp.read(8))[0]
+        header = json.loads(fp.read(header_size))
+    return header, 8 + header_size
+
+def safetensors_mmap_tensors(ckpt, f):
+    """
+    Returns the tensors of the safetensors file ckpt (opened as f) as views into a copy on write
+    memory map of the file. Nothing is read until the data of a tensor is used (cast, moved to a
+    device, copied into a model...) so key and shape scans are free, and the pages that were read
+    are page cache the OS can drop instead of a second copy of the weights in process memory.
+    """
+    header, data_start = read_safetensors_header(ckpt)
+    with open(ckpt, "rb") as fp:
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    sd = {}
+    for k in f.keys():
+        info = header[k]
+        dtype = SAFETENSORS_DTYPES.get(info["dtype"], None)
+        start, end = info["data_offsets"]
+        if dtype is None:
+            sd[k] = f.get_tensor(k)
+        elif start == end:
+            sd[k] = torch.empty(info["shape"], dtype=dtype)
+        else:
+            count = (end - start) // dtype.itemsize
+            sd[k] = torch.frombuffer(mapped, dtype=dtype, count=count, offset=data_start + start).view(info["shape"])
+    return sd
+
+PARALLEL_LOAD_CHUNK_SIZE = 64 * 1024 * 1024
+
+def load_cast(t, dtype):
+    """
+    Converts a floating point tensor wider than dtype to it. Narrower ones (fp8 weights of a
+    fp16 model) and single values (the scales of scaled fp8 checkpoints) are kept as they are.
+    """
+    if dtype is None or not t.is_floating_point() or t.element_size() <= dtype.itemsize or t.numel() == 1:
+        return t
+    return t.to(dtype)
+
+def safetensors_parallel_tensors(ckpt, f, threads, device=None, dtype=None, chunk_size=PARALLEL_LOAD_CHUNK_SIZE):
+    """
+    Reads the tensors of a safetensors file (opened as f) with a pool of threads, each reading
+    chunk_size byte ranges straight into the memory of the tensors. A single sequential reader
+    leaves most of the bandwidth of NVMe and network storage unused.
+
+    Tensors are converted to dtype (see load_cast) and moved to device by the thread that completes
+    them, while the other threads keep reading. When loading to a cuda device they are read into pinned memory.
+    """
+    header, data_start = read_safetensors_header(ckpt)
+    pin_memory = device is not None and device.type == "cuda"
+
+    sd = {}
+    jobs = []  # Lists of (key, byte view of the tensor, offset in the tensor, length) read by one thread
+    job = []
+    job_size = 0
+    remaining = {}
+    for k in sorted(f.keys(), key=lambda k: header[k]["data_offsets"][0]):
+        info = header[k]
+        tensor_dtype = SAFETENSORS_DTYPES.get(info["dtype"], None)
+        if tensor_dtype is None:
+            sd[k] = f.get_tensor(k)
+            continue
+        start, end = info["data_offsets"]
+        sd[k] = torch.empty(info["shape"], dtype=tensor_dtype, pin_memory=pin_memory)
+        if start == end:
+            continue
+        raw = sd[k].reshape(-1).view(torch.uint8).numpy()
+        remaining[k] = 0
+        for offset in range(0, end - start, chunk_size):
+            length = min(chunk_size, end - start - offset)
+            job.append((k, raw, offset, length))
+            remaining[k] += 1
+            job_size += length
+            if job_size >= chunk_size:
+                jobs.append(job)
+                job = []
+                job_size = 0
+    if len(job) > 0:
+        jobs.append(job)
+
+    lock = threading.Lock()
+    local = threading.local()
+    handles = []
+
+    def finish(k):
+        t = load_cast(sd[k], dtype)
+        if device is not None and device.type != "cpu":
+            t = t.to(device, non_blocking=pin_memory)
+        sd[k] = t
+
+    def read_job(job):
+        fp = getattr(local, "fp", None)
+        if fp is None:
+            fp = local.fp = open(ckpt, "rb", buffering=0)
+            with lock:
+                handles.append(fp)
+        for k, raw, offset, length in job:
+            fp.seek(data_start + header[k]["data_offsets"][0] + offset)
+            view = memoryview(raw)[offset:offset + length]
+            read = 0
+            while read < length:
+                n = fp.readinto(view[read:])
+                if not n:
+                    raise ValueError("MetadataIncompleteBuffer: {} ended before the data of {}".format(ckpt, k))
+                read += n
+            with lock:
+                remaining[k] -= 1
+                done = remaining[k] == 0
+            if done:
+                finish(k)
+
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for _ in executor.map(read_job, jobs):
+                pass
+    finally:
+        for fp in handles:
+            fp.close()
+
+    for k in sd:
+        if k not in remaining:
+            finish(k)
+    return {k: sd[k] for k in f.keys()}
+
+LOAD_TORCH_FILE_HOOK = None
+def set_load_torch_file_hook(function):
+    """function(path) returns the (state dict, metadata) of a file that was already read into RAM, or None."""
+    global LOAD_TORCH_FILE_HOOK
+    LOAD_TORCH_FILE_HOOK = function
+
+def load_torch_file(ckpt, safe_load=False, device=None, return_metadata=False, dtype=None):
+    # dtype: floating point weights wider than it are converted while loading (see load_cast)
+    # bytes is only set by the paths reading the file, memory mapped and prefetched files aren't read here
+    with comfy.load_trace.span("load_torch_file", path=os.path.basename(ckpt)) as s:
+        try:
+            s.set(file_size=os.path.getsize(ckpt))
+        except OSError:
+            pass
+        return _load_torch_file(ckpt, safe_load=safe_load, device=device, return_metadata=return_metadata, dtype=dtype)
+
+def _load_torch_file(ckpt, safe_load=False, device=None, return_metadata=False, dtype=None):
     if device is None:
         device = torch.device("cpu")
     metadata = None
+    if LOAD_TORCH_FILE_HOOK is not None:
+        staged = LOAD_TORCH_FILE_HOOK(ckpt)
+        if staged is not None:
+            sd, metadata = staged
+            if device.type != "cpu" or dtype is not None:
+                sd = {k: load_cast(v, dtype).to(device, non_blocking=True) for k, v in sd.items()}
+            return (sd, metadata) if return_metadata else sd
     if ckpt.lower().endswith(".safetensors") or ckpt.lower().endswith(".sft"):
         try:
             with safetensors.safe_open(ckpt, framework="pt", device=device.type) as f:
-                sd = {}
-                for k in f.keys():
-                    sd[k] = f.get_tensor(k)
+                if args.load_threads > 1:
+                    sd = safetensors_parallel_tensors(ckpt, f, args.load_threads, device=device, dtype=dtype)
+                    comfy.load_trace.annotate(bytes=os.path.getsize(ckpt))
+                elif MMAP_SAFETENSORS and device.type == "cpu":
+                    sd = safetensors_mmap_tensors(ckpt, f)
+                else:
+                    sd = {}
+                    for k in f.keys():
+                        sd[k] = f.get_tensor(k)
+                    comfy.load_trace.annotate(bytes=sum(t.nbytes for t in sd.values()))
+                if dtype is not None:
+                    sd = {k: load_cast(v, dtype) for k, v in sd.items()}
                 if return_metadata:
                     metadata = f.metadata()
         except Exception as e:
@@ -71,6 +256,7 @@ def load_torch_file(ckpt, safe_load=False, device=None, return_metadata=False):
             pl_sd = torch.load(ckpt, map_location=device, weights_only=True)
         else:
             pl_sd = torch.load(ckpt, map_location=device, pickle_module=comfy.checkpoint_pickle)
+        comfy.load_trace.annotate(bytes=os.path.getsize(ckpt))
         if "global_step" in pl_sd:
             logging.debug(f"Global Step: {pl_sd['global_step']}")
         if "state_dict" in pl_sd:
@@ -83,6 +269,8 @@ def load_torch_file(ckpt, safe_load=False, device=None, return_metadata=False):
                     sd = pl_sd
             else:
                 sd = pl_sd
+        if dtype is not None:
+            sd = {k: load_cast(v, dtype) if isinstance(v, torch.Tensor) else v for k, v in sd.items()}
     return (sd, metadata) if return_metadata else sd
 
 def save_torch_file(sd, ckpt, metadata=None):
@@ -1,7 +1,19 @@
+import hashlib
+import inspect
 import itertools
+import logging
+import math
+import os
+import threading
+import weakref
+
+import psutil
+import torch
 from typing import Sequence, Mapping, Dict
-from comfy_execution.graph import DynamicPrompt
+from comfy_execution.graph import DynamicPrompt, get_input_info
 
+import comfyui_version
+import folder_paths
 import nodes
 
 from comfy_execution.graph_utils import is_link
@@ -56,6 +68,59 @@ def to_hashable(obj):
         # TODO - Support other objects like tensors?
         return Unhashable()
 
+def _encode_signature(obj, buffer):
+    if obj is None or isinstance(obj, bool):
+        buffer.append(repr(obj).encode())
+    elif isinstance(obj, int):
+        buffer.append(b"i%d;" % obj)
+    elif isinstance(obj, float):
+        if math.isnan(obj):
+            # NaN is how nodes ask to never be cached (e.g. from IS_CHANGED)
+            return False
+        buffer.append(b"f" + obj.hex().encode() + b";")
+    elif isinstance(obj, str):
+        encoded = obj.encode("utf-8", "surrogatepass")
+        buffer.append(b"s%d:" % len(encoded))
+        buffer.append(encoded)
+    elif isinstance(obj, bytes):
+        buffer.append(b"b%d:" % len(obj))
+        buffer.append(obj)
+    elif isinstance(obj, Mapping):
+        buffer.append(b"{%d:" % len(obj))
+        for k, v in sorted(obj.items()):
+            if not _encode_signature(k, buffer) or not _encode_signature(v, buffer):
+                return False
+        buffer.append(b"}")
+    elif isinstance(obj, Sequence):
+        buffer.append(b"[%d:" % len(obj))
+        for i in obj:
+            if not _encode_signature(i, buffer):
+                return False
+        buffer.append(b"]")
+    else:
+        return False
+    return True
+
+def to_digest(obj):
+    """
+    Returns a fixed-size digest of a signature built from the same kinds of values that
+    to_hashable accepts, or an Unhashable if any part of it can't be hashed.
+    """
+    buffer = []
+    if not _encode_signature(obj, buffer):
+        return Unhashable()
+    return hashlib.sha256(b"".join(buffer)).digest()
+
+# Node signatures only depend on the prompt and the IS_CHANGED results, so they are shared between
+# every key set (outputs, ui, subcaches) built for the same IsChangedCache.
+_signature_memos = weakref.WeakKeyDictionary()
+
+def get_signature_memo(key_set):
+    if key_set.is_changed_cache is None:
+        return {}
+    memos = _signature_memos.setdefault(key_set.is_changed_cache, {})
+    return memos.setdefault((type(key_set), key_set.dynprompt), {})
+
 class CacheKeySetID(CacheKeySet):
     def __init__(self, dynprompt, node_ids, is_changed_cache):
         super().__init__(dynprompt, node_ids, is_changed_cache)
@@ -77,6 +142,7 @@ class CacheKeySetInputSignature(CacheKeySet):
         super().__init__(dynprompt, node_ids, is_changed_cache)
         self.dynprompt = dynprompt
         self.is_changed_cache = is_changed_cache
+        self.node_signatures = get_signature_memo(self)
         self.add_keys(node_ids)
 
     def include_node_id_in_input(self) -> bool:
@@ -93,67 +159,161 @@ class CacheKeySetInputSignature(CacheKeySet):
             self.subcache_keys[node_id] = (node_id, node["class_type"])
 
     def get_node_signature(self, dynprompt, node_id):
-        signature = []
-        ancestors, order_mapping = self.get_ordered_ancestry(dynprompt, node_id)
-        signature.append(self.get_immediate_node_signature(dynprompt, node_id, order_mapping))
-        for ancestor_id in ancestors:
-            signature.append(self.get_immediate_node_signature(dynprompt, ancestor_id, order_mapping))
-        return to_hashable(signature)
-
-    def get_immediate_node_signature(self, dynprompt, node_id, ancestor_order_mapping):
+        signature = self.node_signatures.get(node_id, None)
+        if signature is not None:
+            return signature
+
+        # Walk the ancestry iteratively (long chains would blow the recursion limit) and compute
+        # each signature only once all of its parents have one.
+        visiting = set()
+        stack = [node_id]
+        while len(stack) > 0:
+            current_id = stack[-1]
+            if current_id in self.node_signatures:
+                stack.pop()
+                continue
+            pending_parents = []
+            if dynprompt.has_node(current_id) and current_id not in visiting:
+                inputs = dynprompt.get_node(current_id)["inputs"]
+                for key in sorted(inputs.keys()):
+                    if is_link(inputs[key]):
+                        ancestor_id = inputs[key][0]
+                        if ancestor_id not in self.node_signatures and ancestor_id not in visiting:
+                            pending_parents.append(ancestor_id)
+            if len(pending_parents) > 0:
+                visiting.add(current_id)
+                stack.extend(reversed(pending_parents))
+                continue
+            stack.pop()
+            visiting.discard(current_id)
+            self.node_signatures[current_id] = self.get_immediate_node_signature(dynprompt, current_id)
+        return self.node_signatures[node_id]
+
+    def get_immediate_node_signature(self, dynprompt, node_id):
+        """
+        Returns a fixed-size digest of the node's own inputs combined with the digests of the nodes
+        it is linked to. Returns an Unhashable if the node can't be cached.
+        """
         if not dynprompt.has_node(node_id):
             # This node doesn't exist -- we can't cache it.
-            return [float("NaN")]
+            return Unhashable()
         node = dynprompt.get_node(node_id)
         class_type = node["class_type"]
         class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
-        signature = [class_type, self.is_changed_cache.get(node_id)]
+        # Without an IsChangedCache (outside of an execution) only nodes without IS_CHANGED have a valid signature
+        signature = [class_type, self.is_changed_cache.get(node_id) if self.is_changed_cache is not None else False]
         if self.include_node_id_in_input() or (hasattr(class_def, "NOT_IDEMPOTENT") and class_def.NOT_IDEMPOTENT) or include_unique_id_in_input(class_type):
             signature.append(node_id)
         inputs = node["inputs"]
         for key in sorted(inputs.keys()):
             if is_link(inputs[key]):
                 (ancestor_id, ancestor_socket) = inputs[key]
-                ancestor_index = ancestor_order_mapping[ancestor_id]
-                signature.append((key,("ANCESTOR", ancestor_index, ancestor_socket)))
+                ancestor_signature = self.node_signatures.get(ancestor_id, None)
+                if not isinstance(ancestor_signature, bytes):
+                    # Either uncacheable or part of a cycle
+                    return Unhashable()
+                signature.append((key, ("ANCESTOR", ancestor_signature, ancestor_socket)))
             else:
                 signature.append((key, inputs[key]))
-        return signature
-
-    # This function returns a list of all ancestors of the given node. The order of the list is
-    # deterministic based on which specific inputs the ancestor is connected by.
-    def get_ordered_ancestry(self, dynprompt, node_id):
-        ancestors = []
-        order_mapping = {}
-        self.get_ordered_ancestry_internal(dynprompt, node_id, ancestors, order_mapping)
-        return ancestors, order_mapping
+        return to_digest(signature)
 
-    def get_ordered_ancestry_internal(self, dynprompt, node_id, ancestors, order_mapping):
-        if not dynprompt.has_node(node_id):
-            return
-        inputs = dynprompt.get_node(node_id)["inputs"]
-        input_keys = sorted(inputs.keys())
-        for key in input_keys:
-            if is_link(inputs[key]):
-                ancestor_id = inputs[key][0]
-                if ancestor_id not in order_mapping:
-                    ancestors.append(ancestor_id)
-                    order_mapping[ancestor_id] = len(ancestors) - 1
-                    self.get_ordered_ancestry_internal(dynprompt, ancestor_id, ancestors, order_mapping)
+def standalone_node_signature(node_id, node):
+    """
+    The output cache key of a node without links or IS_CHANGED (a loader) computed outside of an
+    execution, None for other nodes. Doesn't touch any state shared with the executions.
+    """
+    class_def = nodes.NODE_CLASS_MAPPINGS.get(node.get("class_type", None), None)
+    if class_def is None or hasattr(class_def, "IS_CHANGED"):
+        return None
+    if any(is_link(value) for value in node.get("inputs", {}).values()):
+        return None
+    dynprompt = DynamicPrompt({node_id: node})
+    signature = CacheKeySetInputSignature(dynprompt, [], None).get_node_signature(dynprompt, node_id)
+    return signature if isinstance(signature, bytes) else None
+
+def _file_identity(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (path, st.st_mtime_ns, st.st_size)
+
+def input_file_identities(class_def, inputs):
+    """
+    (input name, path, mtime, size) of the files named by the COMBO inputs of a node, looked up in
+    every model folder and the input directory so that replacing a file under the same name is seen.
+    """
+    identities = []
+    try:
+        class_inputs = class_def.INPUT_TYPES()
+    except Exception:
+        return identities
+    for key in sorted(inputs.keys()):
+        value = inputs[key]
+        if is_link(value) or not isinstance(value, str) or value == "":
+            continue
+        input_type, _, _ = get_input_info(class_def, key, class_inputs)
+        if not isinstance(input_type, list):
+            continue
+        paths = set()
+        for folder_name in list(folder_paths.folder_names_and_paths):
+            path = folder_paths.get_full_path(folder_name, value)
+            if path is not None:
+                paths.add(path)
+        path = folder_paths.get_annotated_filepath(value)
+        if os.path.isfile(path):
+            paths.add(path)
+        for path in sorted(paths):
+            identity = _file_identity(path)
+            if identity is not None:
+                identities.append((key,) + identity)
+    return identities
+
+_code_hashes = {}
+_code_hashes_lock = threading.Lock()
+
+def node_code_version(class_def):
+    """
+    The DISK_CACHE_VERSION of a node class with a hash of the source file of its module, so persisted
+    outputs are dropped when the node is updated.
+    """
+    try:
+        path = inspect.getsourcefile(class_def)
+    except TypeError:
+        path = None
+    identity = _file_identity(path) if path is not None else None
+    code_hash = None
+    if identity is not None:
+        with _code_hashes_lock:
+            code_hash = _code_hashes.get(identity, None)
+        if code_hash is None:
+            try:
+                with open(path, "rb") as f:
+                    code_hash = hashlib.sha256(f.read()).hexdigest()
+            except OSError:
+                code_hash = None
+            else:
+                with _code_hashes_lock:
+                    _code_hashes[identity] = code_hash
+    return [class_def.__module__, class_def.__qualname__, getattr(class_def, "DISK_CACHE_VERSION", None), code_hash]
 
 class BasicCache:
-    def __init__(self, key_class):
+    def __init__(self, key_class, disk_cache=None):
         self.key_class = key_class
         self.initialized = False
         self.dynprompt: DynamicPrompt
         self.cache_key_set: CacheKeySet
         self.cache = {}
         self.subcaches = {}
+        # Optional second tier consulted on misses for node classes that set DISK_CACHEABLE
+        self.disk_cache = disk_cache
+        self.disk_keys = {}
 
     def set_prompt(self, dynprompt, node_ids, is_changed_cache):
         self.dynprompt = dynprompt
         self.cache_key_set = self.key_class(dynprompt, node_ids, is_changed_cache)
         self.is_changed_cache = is_changed_cache
+        self.disk_keys = {}
         self.initialized = True
 
     def all_node_ids(self):
@@ -187,10 +347,45 @@ class BasicCache:
         self._clean_cache()
         self._clean_subcaches()
 
+    def _use_disk_cache(self, node_id, cache_key):
+        if self.disk_cache is None or not isinstance(cache_key, bytes):
+            return False
+        class_type = self.dynprompt.get_node(node_id)["class_type"]
+        class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+        return getattr(class_def, "DISK_CACHEABLE", False)
+
+    def _get_disk_key(self, node_id, cache_key):
+        """
+        The cache key extended with what it doesn't see across restarts: the identity of the files
+        named by the inputs and the code version of the node and all of its ancestors.
+        """
+        disk_key = self.disk_keys.get(node_id, None)
+        if disk_key is not None:
+            return disk_key
+        identities = set()
+        visited = set()
+        stack = [node_id]
+        while len(stack) > 0:
+            current_id = stack.pop()
+            if current_id in visited or not self.dynprompt.has_node(current_id):
+                continue
+            visited.add(current_id)
+            node = self.dynprompt.get_node(current_id)
+            class_def = nodes.NODE_CLASS_MAPPINGS[node["class_type"]]
+            identities.add(to_digest([node_code_version(class_def), input_file_identities(class_def, node["inputs"])]))
+            stack.extend(value[0] for value in node["inputs"].values() if is_link(value))
+        disk_key = to_digest([cache_key, comfyui_version.__version__, sorted(identities)])
+        self.disk_keys[node_id] = disk_key
+        return disk_key
+
     def _set_immediate(self, node_id, value):
         assert self.initialized
         cache_key = self.cache_key_set.get_data_key(node_id)
         self.cache[cache_key] = value
+        if self._use_disk_cache(node_id, cache_key):
+            disk_key = self._get_disk_key(node_id, cache_key)
+            if isinstance(disk_key, bytes):
+                self.disk_cache.set(disk_key, value)
 
     def _get_immediate(self, node_id):
         if not self.initialized:
@@ -198,6 +393,12 @@ class BasicCache:
         cache_key = self.cache_key_set.get_data_key(node_id)
         if cache_key in self.cache:
             return self.cache[cache_key]
+        elif self._use_disk_cache(node_id, cache_key):
+            disk_key = self._get_disk_key(node_id, cache_key)
+            value = self.disk_cache.get(disk_key) if isinstance(disk_key, bytes) else None
+            if value is not None:
+                self._set_immediate(node_id, value)
+            return value
         else:
             return None
 
@@ -205,7 +406,7 @@ class BasicCache:
         subcache_key = self.cache_key_set.get_subcache_key(node_id)
         subcache = self.subcaches.get(subcache_key, None)
         if subcache is None:
-            subcache = BasicCache(self.key_class)
+            subcache = BasicCache(self.key_class, disk_cache=self.disk_cache)
             self.subcaches[subcache_key] = subcache
         subcache.set_prompt(self.dynprompt, children_ids, self.is_changed_cache)
         return subcache
@@ -227,8 +428,8 @@ class BasicCache:
         return result
 
 class HierarchicalCache(BasicCache):
-    def __init__(self, key_class):
-        super().__init__(key_class)
+    def __init__(self, key_class, disk_cache=None):
+        super().__init__(key_class, disk_cache=disk_cache)
 
     def _get_cache_for(self, node_id):
         assert self.dynprompt is not None
@@ -265,8 +466,8 @@ class HierarchicalCache(BasicCache):
         return cache._ensure_subcache(node_id, children_ids)
 
 class LRUCache(BasicCache):
-    def __init__(self, key_class, max_size=100):
-        super().__init__(key_class)
+    def __init__(self, key_class, max_size=100, disk_cache=None):
+        super().__init__(key_class, disk_cache=disk_cache)
         self.max_size = max_size
         self.min_generation = 0
         self.generation = 0
@@ -317,6 +518,80 @@ class LRUCache(BasicCache):
         return self
 
 
+def estimate_size(obj, seen=None):
+    """
+    Estimates the number of bytes held by a cached output. Only tensors (and the lists, tuples and
+    dicts that contain them) are counted, everything else is treated as negligible.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    if isinstance(obj, torch.Tensor):
+        seen.add(id(obj))
+        return obj.nelement() * obj.element_size()
+    if isinstance(obj, (str, bytes, int, float, bool, type(None))):
+        return 0
+    if isinstance(obj, Mapping):
+        seen.add(id(obj))
+        return sum(estimate_size(v, seen) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        seen.add(id(obj))
+        return sum(estimate_size(v, seen) for v in obj)
+    return 0
+
+class RAMBudgetCache(LRUCache):
+    """
+    An LRU cache that evicts by the estimated size of the cached outputs instead of by entry count.
+    Entries from older prompts are evicted least recently used first and, within the same prompt,
+    largest first, until the cache fits in max_bytes and the system has at least min_free_bytes of
+    available RAM. Entries used by the prompt that is currently executing are never evicted.
+    """
+    def __init__(self, key_class, max_bytes, min_free_bytes=None, disk_cache=None):
+        super().__init__(key_class, max_size=0, disk_cache=disk_cache)
+        self.max_bytes = max_bytes
+        if min_free_bytes is None:
+            min_free_bytes = psutil.virtual_memory().total * 0.1
+        self.min_free_bytes = min_free_bytes
+        self.entry_sizes = {}
+        self.total_bytes = 0
+
+    def clean_unused(self):
+        self._evict()
+        self._clean_subcaches()
+
+    def set(self, node_id, value):
+        super().set(node_id, value)
+        self._evict()
+
+    def _set_immediate(self, node_id, value):
+        super()._set_immediate(node_id, value)
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        self.total_bytes -= self.entry_sizes.get(cache_key, 0)
+        self.entry_sizes[cache_key] = estimate_size(value)
+        self.total_bytes += self.entry_sizes[cache_key]
+
+    def _under_pressure(self):
+        if self.total_bytes > self.max_bytes:
+            return True
+        return self.total_bytes > 0 and psutil.virtual_memory().available < self.min_free_bytes
+
+    def _evict(self):
+        if not self._under_pressure():
+            return
+        candidates = [key for key in self.cache if self.used_generation[key] < self.generation]
+        candidates.sort(key=lambda key: (self.used_generation[key], -self.entry_sizes.get(key, 0)))
+        for key in candidates:
+            del self.cache[key]
+            del self.used_generation[key]
+            self.children.pop(key, None)
+            self.total_bytes -= self.entry_sizes.pop(key, 0)
+            if not self._under_pressure():
+                break
+        if len(candidates) > 0:
+            logging.debug("RAM cache holds {:.2f} GB after eviction".format(self.total_bytes / (1024 ** 3)))
+
+
 class DependencyAwareCache(BasicCache):
     """
     A cache implementation that tracks dependencies between nodes and manages
@@ -325,14 +600,15 @@ class DependencyAwareCache(BasicCache):
     executed.
     """
 
-    def __init__(self, key_class):
+    def __init__(self, key_class, disk_cache=None):
         """
         Initialize the DependencyAwareCache.
 
         Args:
             key_class: The class used for generating cache keys.
+            disk_cache: Optional DiskCache consulted on misses.
         """
-        super().__init__(key_class)
+        super().__init__(key_class, disk_cache=disk_cache)
         self.descendants = {}  # Maps node_id -> set of descendant node_ids
         self.ancestors = {}    # Maps node_id -> set of ancestor node_ids
         self.executed_nodes = set()  # Tracks nodes that have been executed
@@ -0,0 +1,165 @@
+import json
+import logging
+import os
+import threading
+
+import safetensors.torch
+import torch
+
+# Bump this whenever the on-disk layout changes so stale entries are never loaded
+DISK_CACHE_VERSION = 1
+
+
+class UnserializableOutput(Exception):
+    pass
+
+
+def serialize_output(value):
+    """
+    Splits a node output into a dict of tensors and a JSON structure referencing them.
+    Only tensors, lists, tuples, dicts with string keys and JSON primitives are supported.
+    """
+    tensors = {}
+    tensor_names = {}
+    storages = set()
+
+    def encode(obj):
+        if obj is None or isinstance(obj, (bool, int, float, str)):
+            return obj
+        if isinstance(obj, torch.Tensor):
+            name = tensor_names.get(id(obj), None)
+            if name is None:
+                tensor = obj.detach().to("cpu").contiguous()
+                storage = tensor.untyped_storage()
+                # safetensors refuses tensors that share memory
+                if storage.data_ptr() in storages or storage.nbytes() != tensor.nbytes:
+                    tensor = tensor.clone()
+                storages.add(tensor.untyped_storage().data_ptr())
+                name = str(len(tensors))
+                tensors[name] = tensor
+                tensor_names[id(obj)] = name
+            return {"__tensor__": name}
+        if isinstance(obj, (list, tuple)):
+            items = [encode(x) for x in obj]
+            if isinstance(obj, tuple):
+                return {"__tuple__": items}
+            return items
+        if isinstance(obj, dict):
+            if not all(isinstance(k, str) for k in obj.keys()):
+                raise UnserializableOutput("dict keys must be strings")
+            return {"__dict__": [[k, encode(v)] for k, v in obj.items()]}
+        raise UnserializableOutput(f"can't serialize {type(obj).__name__}")
+
+    structure = encode(value)
+    return tensors, json.dumps(structure)
+
+
+def deserialize_output(tensors, structure):
+    def decode(obj):
+        if isinstance(obj, list):
+            return [decode(x) for x in obj]
+        if isinstance(obj, dict):
+            if "__tensor__" in obj:
+                return tensors[obj["__tensor__"]]
+            if "__tuple__" in obj:
+                return tuple(decode(x) for x in obj["__tuple__"])
+            return {k: decode(v) for k, v in obj["__dict__"]}
+        return obj
+
+    return decode(json.loads(structure))
+
+
+class DiskCache:
+    """
+    A size capped on-disk store for node outputs, keyed by the input signature digest of the node.
+    Entries are safetensors files with the structure of the output stored in the metadata, and are
+    evicted least recently used first (by file modification time) once max_bytes is exceeded.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = os.path.join(directory, f"v{DISK_CACHE_VERSION}")
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.entries = {}  # Maps hex key -> (last used time, size in bytes)
+        self.total_bytes = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+                continue
+            if not entry.name.endswith(".safetensors"):
+                continue
+            stat = entry.stat()
+            self.entries[entry.name[:-len(".safetensors")]] = (stat.st_mtime, stat.st_size)
+            self.total_bytes += stat.st_size
+        logging.info("Disk cache: {} entries, {:.2f} GB in {}".format(len(self.entries), self.total_bytes / (1024 ** 3), self.directory))
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + ".safetensors")
+
+    def __contains__(self, key):
+        return key.hex() in self.entries
+
+    def get(self, key):
+        name = key.hex()
+        with self.lock:
+            if name not in self.entries:
+                return None
+            path = self._path(name)
+            try:
+                with safetensors.safe_open(path, framework="pt", device="cpu") as f:
+                    structure = f.metadata()["structure"]
+                    tensors = {k: f.get_tensor(k) for k in f.keys()}
+                value = deserialize_output(tensors, structure)
+                os.utime(path)
+            except Exception as e:
+                logging.warning(f"Failed to load disk cache entry {path}: {e}")
+                self._remove(name)
+                return None
+            self.entries[name] = (os.path.getmtime(path), self.entries[name][1])
+            return value
+
+    def set(self, key, value):
+        name = key.hex()
+        with self.lock:
+            if name in self.entries:
+                return
+            try:
+                tensors, structure = serialize_output(value)
+            except UnserializableOutput as e:
+                logging.debug(f"Not writing output to the disk cache: {e}")
+                return
+            path = self._path(name)
+            tmp_path = path + ".tmp"
+            try:
+                safetensors.torch.save_file(tensors, tmp_path, metadata={"structure": structure})
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logging.warning(f"Failed to write disk cache entry {path}: {e}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                return
+            stat = os.stat(path)
+            self.entries[name] = (stat.st_mtime, stat.st_size)
+            self.total_bytes += stat.st_size
+            self._evict()
+
+    def _remove(self, name):
+        _, size = self.entries.pop(name)
+        self.total_bytes -= size
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        for name in sorted(self.entries, key=lambda n: self.entries[n][0]):
+            self._remove(name)
+            if self.total_bytes <= self.max_bytes:
+                break
@@ -0,0 +1,146 @@
+import bisect
+import json
+
+
+def estimate_entry_size(entry):
+    return len(json.dumps(entry, default=str))
+
+
+def summarize_entry(entry):
+    """
+    Returns a small description of a history entry (status, timings and output files) that can be
+    sent to clients without the full prompt.
+    """
+    status = entry.get("status") or {}
+    timestamps = {}
+    for message in status.get("messages", []):
+        event, data = message
+        if isinstance(data, dict) and "timestamp" in data:
+            timestamps[event] = data["timestamp"]
+
+    start_time = timestamps.get("execution_start", None)
+    end_time = None
+    for event in ("execution_success", "execution_error", "execution_interrupted"):
+        if event in timestamps:
+            end_time = timestamps[event]
+            break
+
+    output_files = []
+    for node_id, node_output in entry.get("outputs", {}).items():
+        if not isinstance(node_output, dict):
+            continue
+        for items in node_output.values():
+            if not isinstance(items, list):
+                continue
+            for x in items:
+                if isinstance(x, dict) and "filename" in x:
+                    output_files.append({"node": node_id, "filename": x["filename"], "subfolder": x.get("subfolder", ""), "type": x.get("type", "output")})
+
+    prompt = entry.get("prompt", ())
+    summary = {
+        "number": prompt[0] if len(prompt) > 0 else None,
+        "status": status.get("status_str", None),
+        "completed": status.get("completed", None),
+        "start_time": start_time,
+        "end_time": end_time,
+        "execution_time": (end_time - start_time) / 1000 if start_time is not None and end_time is not None else None,
+        "outputs": output_files,
+    }
+    if len(prompt) > 3 and isinstance(prompt[3], dict) and "client_id" in prompt[3]:
+        summary["client_id"] = prompt[3]["client_id"]
+    return summary
+
+
+class PromptHistory:
+    """
+    Ordered store for the results of executed prompts, bounded by entry count and (optionally)
+    by the estimated JSON size of the entries. Every entry gets an increasing sequence number
+    which is used as a cursor, so fetching a page only touches the entries on that page.
+    """
+    def __init__(self, max_items=10000, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.entries = {}  # Maps prompt id -> [sequence number, entry, summary, size]
+        self.sequences = []  # Sequence numbers in insertion order, live entries start at self.head
+        self.prompt_ids = []
+        self.head = 0
+        self.next_sequence = 0
+        self.total_bytes = 0
+
+    def __len__(self):
+        return len(self.sequences) - self.head
+
+    def __contains__(self, prompt_id):
+        return prompt_id in self.entries
+
+    def __getitem__(self, prompt_id):
+        return self.entries[prompt_id][1]
+
+    def add(self, prompt_id, entry):
+        if prompt_id in self.entries:
+            self.remove(prompt_id)
+        size = estimate_entry_size(entry)
+        sequence = self.next_sequence
+        self.next_sequence += 1
+        self.entries[prompt_id] = [sequence, entry, summarize_entry(entry), size]
+        self.sequences.append(sequence)
+        self.prompt_ids.append(prompt_id)
+        self.total_bytes += size
+        self._evict()
+        return sequence
+
+    def _evict(self):
+        while len(self) > 1 and (len(self) > self.max_items or (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+            prompt_id = self.prompt_ids[self.head]
+            self.total_bytes -= self.entries.pop(prompt_id)[3]
+            self.prompt_ids[self.head] = None
+            self.head += 1
+        if self.head > 1024 and self.head * 2 > len(self.sequences):
+            del self.sequences[:self.head]
+            del self.prompt_ids[:self.head]
+            self.head = 0
+
+    def remove(self, prompt_id):
+        if prompt_id not in self.entries:
+            return
+        sequence, _, _, size = self.entries.pop(prompt_id)
+        self.total_bytes -= size
+        i = bisect.bisect_left(self.sequences, sequence, lo=self.head)
+        del self.sequences[i]
+        del self.prompt_ids[i]
+
+    def clear(self):
+        self.__init__(self.max_items, self.max_bytes)
+
+    def get(self, prompt_id, summary=False):
+        if summary:
+            return self.entries[prompt_id][2]
+        return self.entries[prompt_id][1]
+
+    def items(self, offset=0, max_items=None, summary=False):
+        """Entries oldest first, starting at offset. A negative offset counts from the newest entry."""
+        if offset < 0:
+            offset = max(len(self) + offset, 0)
+        start = self.head + offset
+        end = len(self.prompt_ids) if max_items is None else min(start + max_items, len(self.prompt_ids))
+        return {prompt_id: self.get(prompt_id, summary) for prompt_id in self.prompt_ids[start:end]}
+
+    def page(self, cursor=None, max_items=None, summary=False):
+        """
+        Entries newest first, starting right before cursor (or at the newest entry). Returns the
+        entries and the cursor for the next page, which is None once the oldest entry was returned.
+        Pages have at least one entry.
+        """
+        if max_items is not None:
+            max_items = max(max_items, 1)
+        end = len(self.sequences)
+        if cursor is not None:
+            end = bisect.bisect_left(self.sequences, cursor, lo=self.head)
+        start = self.head if max_items is None else max(self.head, end - max_items)
+        out = {}
+        for i in range(end - 1, start - 1, -1):
+            out[self.prompt_ids[i]] = self.get(self.prompt_ids[i], summary)
+        next_cursor = None
+        if start > self.head:
+            next_cursor = self.sequences[start]
+        return out, next_cursor
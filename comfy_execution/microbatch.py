@@ -0,0 +1,202 @@
+"""
+Cross prompt micro-batching. Queued prompts that have the same graph and only differ in their seeds
+and texts are executed together as one merged prompt: the nodes of the first prompt keep their ids,
+the ones of the next prompts get a "mb<index>_" prefix. Nodes that are identical in every prompt
+(loaders...) have the same cache signature so they still run once, and the sampling nodes that line
+up between the prompts run as one batched call of their MICROBATCH_FUNCTION. Messages, outputs and
+history are split back to each prompt.
+"""
+import re
+
+import nodes
+from comfy_execution.graph_utils import is_link
+from comfy_execution.scheduling import MODEL_INPUT_NAMES
+
+# Inputs of the sampling nodes that may differ between the prompts of a batch
+BATCHED_INPUTS = frozenset(["seed", "noise_seed"])
+
+_MEMBER_PREFIX = re.compile(r"^mb(\d+)_")
+
+
+def member_prefix(index):
+    return "" if index == 0 else "mb{}_".format(index)
+
+
+def split_node_id(node_id):
+    """(index of the prompt in the batch, node id in that prompt) of a node id of the merged prompt."""
+    match = _MEMBER_PREFIX.match(node_id)
+    if match is None:
+        return 0, node_id
+    return int(match.group(1)), node_id[match.end():]
+
+
+def is_batched_node(class_type):
+    class_def = nodes.NODE_CLASS_MAPPINGS.get(class_type, None)
+    return class_def is not None and getattr(class_def, "MICROBATCH_FUNCTION", None) is not None
+
+
+def batch_signature(item):
+    """
+    What has to be equal for queue items to be batched together: the graph, the node inputs except
+    the seeds and texts (the seeds of the sampling nodes only) and the outputs to execute. Prompts
+    of different clients are batched together, messages and outputs go back to each one's client.
+    None if the prompt has no sampling node that can be batched.
+    """
+    prompt = item[2]
+    batched = False
+    signature = []
+    for node_id in sorted(prompt.keys()):
+        node = prompt[node_id]
+        if not isinstance(node, dict) or "class_type" not in node:
+            return None
+        sampler = is_batched_node(node["class_type"])
+        batched = batched or sampler
+        inputs = []
+        for name, value in sorted(node.get("inputs", {}).items()):
+            if is_link(value):
+                inputs.append((name, tuple(value)))
+            elif name in BATCHED_INPUTS and isinstance(value, int):
+                inputs.append((name, int))
+            elif not sampler and isinstance(value, str) and name not in MODEL_INPUT_NAMES:
+                inputs.append((name, str))
+            else:
+                inputs.append((name, repr(value)))
+        signature.append((node_id, node["class_type"], tuple(inputs)))
+    if not batched:
+        return None
+    return (tuple(signature), tuple(sorted(item[4])))
+
+
+class MicroBatch:
+    """The queue items of a batch and the merged prompt executing them."""
+    def __init__(self, items):
+        self.items = items
+        self.prompt = {}
+        self.groups = {}  # sampling node id -> ids of the same node in every prompt
+        for index, item in enumerate(items):
+            prefix = member_prefix(index)
+            for node_id, node in item[2].items():
+                node = dict(node)
+                node["inputs"] = {name: [prefix + value[0], value[1]] if is_link(value) else value for name, value in node.get("inputs", {}).items()}
+                self.prompt[prefix + node_id] = node
+        for node_id, node in items[0][2].items():
+            if is_batched_node(node["class_type"]):
+                group = [member_prefix(index) + node_id for index in range(len(items))]
+                for member_id in group:
+                    self.groups[member_id] = group
+        self.execute_outputs = [member_prefix(index) + node_id for index, item in enumerate(items) for node_id in item[4]]
+
+    @property
+    def prompt_id(self):
+        return self.items[0][1]
+
+    @property
+    def extra_data(self):
+        return dict(self.items[0][3], microbatch=self)
+
+    def member_data(self, node_id):
+        """(original prompt, extra data) of the prompt a node of the merged prompt belongs to."""
+        item = self.items[split_node_id(node_id)[0]]
+        return item[2], item[3]
+
+    def add_group_links(self, execution_list):
+        """Makes each batched sampling node wait for the inputs of the other nodes of its group so they can run as one call."""
+        for node_id, group in self.groups.items():
+            if node_id not in execution_list.pendingNodes:
+                continue
+            for other in group:
+                if other == node_id or other not in execution_list.pendingNodes:
+                    continue
+                for value in self.prompt[other]["inputs"].values():
+                    if is_link(value):
+                        execution_list.add_strong_link(value[0], value[1], node_id)
+
+    def failed_members(self, messages, interrupted=()):
+        """
+        Indexes of the prompts a failed execution of the merged prompt is final for: the one of the
+        failing node, none if it was a batched node (any prompt may have caused it) and, if the
+        execution was interrupted, the interrupted prompts (all of them for a global interrupt).
+        """
+        for event, data in messages:
+            if event == "execution_interrupted":
+                if len(interrupted) > 0:
+                    return set(index for index, item in enumerate(self.items) if item[1] in interrupted)
+                break
+            if event == "execution_error":
+                if data["node_id"] in self.groups:
+                    return set()
+                return {split_node_id(data["node_id"])[0]}
+        return set(range(len(self.items)))
+
+    def split_message(self, event, data):
+        """Splits a message about the merged prompt into (index, message data) for the prompts it concerns."""
+        if not isinstance(data, dict) or data.get("prompt_id", None) != self.prompt_id:
+            return [(None, data)]
+        node_id = data.get("node", data.get("node_id", None))
+        if node_id is not None:
+            index, original = split_node_id(node_id)
+            data = dict(data, prompt_id=self.items[index][1])
+            for key in ("node", "node_id", "display_node"):
+                if data.get(key, None) is not None:
+                    data[key] = split_node_id(data[key])[1]
+            if "executed" in data:
+                data["executed"] = [n for i, n in map(split_node_id, data["executed"]) if i == index]
+            return [(index, data)]
+        out = []
+        for index, item in enumerate(self.items):
+            member = dict(data, prompt_id=item[1])
+            if "nodes" in data:
+                member["nodes"] = [n for i, n in map(split_node_id, data["nodes"]) if i == index]
+            out.append((index, member))
+        return out
+
+    def split_messages(self, messages):
+        """Status messages of every prompt of the batch."""
+        out = [[] for _ in self.items]
+        for event, data in messages:
+            for index, member in self.split_message(event, data):
+                out[index if index is not None else 0].append((event, member))
+        return out
+
+    def split_history(self, history_result):
+        out = [{"outputs": {}, "meta": {}} for _ in self.items]
+        for key in ("outputs", "meta"):
+            for node_id, value in history_result.get(key, {}).items():
+                index, original = split_node_id(node_id)
+                if key == "meta":
+                    value = dict(value)
+                    for name in ("node_id", "display_node", "parent_node", "real_node_id"):
+                        if value.get(name, None) is not None:
+                            value[name] = split_node_id(value[name])[1]
+                out[index][key][original] = value
+        return out
+
+
+class MicroBatchServer:
+    """
+    View of the server for the execution of a merged prompt: messages about its nodes are sent as
+    messages about the nodes of the prompts they belong to, to the clients of these prompts.
+    """
+    def __init__(self, server_instance, batch):
+        object.__setattr__(self, "server", server_instance)
+        object.__setattr__(self, "batch", batch)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in ("client_id", "last_prompt_id"):
+            setattr(self.server, name, value)
+        elif name == "last_node_id":
+            self.server.last_node_id = split_node_id(value)[1] if value is not None else None
+
+    def __getattr__(self, name):
+        return getattr(self.server, name)
+
+    def send_sync(self, event, data, sid=None):
+        for index, member in self.batch.split_message(event, data):
+            member_sid = sid
+            if sid is not None and index is not None:
+                # Sent to the client of the merged prompt, which is the one of its first prompt
+                member_sid = self.batch.items[index][3].get("client_id", None)
+                if member_sid is None:
+                    continue
+            self.server.send_sync(event, member, member_sid)
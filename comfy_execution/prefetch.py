@@ -0,0 +1,217 @@
+import collections
+import logging
+import os
+import threading
+
+import torch
+
+import comfy.utils
+import folder_paths
+from comfy_execution.scheduling import MODEL_INPUT_NAMES, get_models
+
+# Model folders the files named by loader node inputs are looked up in, first match wins
+MODEL_INPUT_FOLDERS = {
+    "ckpt_name": ("checkpoints",),
+    "unet_name": ("diffusion_models",),
+    "lora_name": ("loras",),
+    "clip_name": ("text_encoders", "clip_vision"),
+    "clip_name1": ("text_encoders",),
+    "clip_name2": ("text_encoders",),
+    "clip_name3": ("text_encoders",),
+    "vae_name": ("vae",),
+    "control_net_name": ("controlnet",),
+    "style_model_name": ("style_models",),
+    "clip_vision_name": ("clip_vision",),
+    "gligen_name": ("gligen",),
+    "upscale_model_name": ("upscale_models",),
+}
+
+
+def get_model_files(item, is_cached=None):
+    """
+    Paths of the safetensors files the loader nodes of the prompt of a queue item will load, without
+    the ones of the nodes is_cached(prompt, node_id) says have their outputs cached already.
+    """
+    models = set()
+    for node_id, node in item[2].items():
+        inputs = node.get("inputs", {}) if isinstance(node, dict) else {}
+        node_models = [(name, value) for name, value in inputs.items() if name in MODEL_INPUT_NAMES and isinstance(value, str)]
+        if len(node_models) > 0 and (is_cached is None or not is_cached(item[2], node_id)):
+            models.update(node_models)
+    paths = []
+    for name, filename in sorted(models):
+        for folder in MODEL_INPUT_FOLDERS.get(name, ()):
+            path = folder_paths.get_full_path(folder, filename)
+            if path is not None:
+                if path.lower().endswith((".safetensors", ".sft")) and path not in paths:
+                    paths.append(path)
+                break
+    return paths
+
+
+def get_model_folders(item):
+    folders = set()
+    for name, _ in get_models(item):
+        folders.update(MODEL_INPUT_FOLDERS.get(name, ()))
+    return folders
+
+
+def _file_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+class ModelPrefetcher:
+    """
+    Reads the model files of the next prompts in the queue into host RAM (pinned when the models run
+    on a cuda device) while the current prompt executes, so that load_torch_file gets them from memory
+    instead of the disk. At most max_bytes are staged; files are dropped (or their staging cancelled)
+    as soon as no running or upcoming prompt needs them anymore.
+    """
+    def __init__(self, max_bytes, lookahead=1, pin_memory=False):
+        self.max_bytes = max_bytes
+        self.lookahead = lookahead
+        self.pin_memory = pin_memory
+        self.lock = threading.Condition(threading.Lock())
+        self.staged = collections.OrderedDict()  # path -> (file key, state dict, metadata, size)
+        self.staged_bytes = 0
+        self.wanted = []  # Paths to stage, in the order they will be needed
+        self.keep = set()  # Paths of running prompts: kept if staged but not started
+        self.folders = set()
+        self.hits = 0
+        self.cancelled = 0
+        self.running = True
+        self.thread = None
+        self.cache_checks = []
+
+    def start(self):
+        self.thread = threading.Thread(target=self._worker, daemon=True, name="ModelPrefetcher")
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+
+    def add_cache_check(self, is_cached):
+        """Files of loader nodes is_cached(prompt, node_id) returns True for are not prefetched: their outputs won't be loaded again."""
+        self.cache_checks.append(is_cached)
+
+    def _is_cached(self, prompt, node_id):
+        return any(is_cached(prompt, node_id) for is_cached in self.cache_checks)
+
+    def queue_changed(self, running, upcoming):
+        """
+        Called with the running queue items and the queued ones in the order they will run (at least
+        lookahead of them) whenever either of them changes.
+        """
+        keep = set()
+        for item in running:
+            keep.update(get_model_files(item))
+        wanted = []
+        folders = set()
+        for item in upcoming[:self.lookahead]:
+            folders.update(get_model_folders(item))
+            for path in get_model_files(item, self._is_cached):
+                if path not in wanted and path not in keep:
+                    wanted.append(path)
+        with self.lock:
+            self.wanted = wanted
+            self.keep = keep
+            self.folders.update(folders)
+            for path in list(self.staged.keys()):
+                if path not in wanted and path not in keep:
+                    self._drop(path)
+            self.lock.notify_all()
+
+    def _drop(self, path):
+        entry = self.staged.pop(path)
+        self.staged_bytes -= entry[3]
+
+    def take(self, path):
+        """The staged (state dict, metadata) of path if it was staged and hasn't changed since, or None."""
+        with self.lock:
+            entry = self.staged.get(path, None)
+            if entry is None:
+                return None
+            self._drop(path)
+            if path in self.wanted:
+                self.wanted.remove(path)
+            self.lock.notify_all()
+        if entry[0] != _file_key(path):
+            return None
+        with self.lock:
+            self.hits += 1
+        return entry[1], entry[2]
+
+    def get_stats(self):
+        with self.lock:
+            return {"staged": list(self.staged.keys()), "staged_bytes": self.staged_bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "cancelled": self.cancelled}
+
+    def _next(self):
+        for path in self.wanted:
+            if path in self.staged:
+                continue
+            key = _file_key(path)
+            if key is None or key[1] > self.max_bytes:
+                continue
+            # Files that don't fit next to what's already staged wait for it to be used
+            if self.staged_bytes + key[1] > self.max_bytes:
+                return None
+            return path, key
+        return None
+
+    def _is_wanted(self, path):
+        with self.lock:
+            return self.running and path in self.wanted
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                folders, self.folders = self.folders, set()
+                task = None
+                if len(folders) == 0:
+                    task = self._next()
+                    while self.running and task is None and len(self.folders) == 0:
+                        self.lock.wait()
+                        task = self._next()
+                if not self.running:
+                    return
+            for folder in folders:
+                # Warms folder_paths.filename_list_cache for the validation of the upcoming prompts
+                folder_paths.get_filename_list(folder)
+            if task is not None:
+                self._stage(*task)
+
+    def _stage(self, path, key):
+        try:
+            sd, metadata = comfy.utils.load_torch_file(path, return_metadata=True)
+            staged = {}
+            size = 0
+            for k, t in sd.items():
+                if not self._is_wanted(path):
+                    logging.debug("Prefetch of {} cancelled".format(path))
+                    with self.lock:
+                        self.cancelled += 1
+                    return
+                # The tensors are memory mapped, copying them is what reads the file
+                out = torch.empty(t.shape, dtype=t.dtype, pin_memory=self.pin_memory)
+                out.copy_(t)
+                staged[k] = out
+                size += out.nbytes
+        except Exception as e:
+            logging.warning("Prefetching {} failed: {}".format(path, e))
+            with self.lock:
+                if path in self.wanted:
+                    self.wanted.remove(path)
+            return
+        with self.lock:
+            # Still useful if its prompt started running while it was staged
+            if self.running and (path in self.wanted or path in self.keep) and path not in self.staged:
+                self.staged[path] = (key, staged, metadata, size)
+                self.staged_bytes += size
+                logging.debug("Prefetched {} ({:.1f} MB)".format(path, size / (1024 * 1024)))
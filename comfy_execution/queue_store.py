@@ -0,0 +1,210 @@
+import json
+import logging
+import queue
+import sqlite3
+import threading
+
+from comfy_execution.history import summarize_entry
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue (
+    prompt_id TEXT PRIMARY KEY,
+    number REAL NOT NULL,
+    item TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    prompt_id TEXT NOT NULL UNIQUE,
+    number REAL,
+    status TEXT,
+    client_id TEXT,
+    start_time INTEGER,
+    end_time INTEGER,
+    entry TEXT NOT NULL,
+    summary TEXT
+);
+CREATE INDEX IF NOT EXISTS history_end_time ON history (end_time);
+CREATE INDEX IF NOT EXISTS history_status ON history (status, end_time);
+CREATE INDEX IF NOT EXISTS history_client_id ON history (client_id, end_time);
+"""
+
+
+# Keys of the extra data of a prompt that are never written to the database
+SENSITIVE_EXTRA_DATA_KEYS = ("auth_token_comfy_org", "api_key_comfy_org")
+
+
+def strip_sensitive(item):
+    """The queue item (or history entry prompt) without the api tokens in its extra data."""
+    if len(item) > 3 and isinstance(item[3], dict) and any(k in item[3] for k in SENSITIVE_EXTRA_DATA_KEYS):
+        extra_data = {k: v for k, v in item[3].items() if k not in SENSITIVE_EXTRA_DATA_KEYS}
+        item = tuple(item[:3]) + (extra_data,) + tuple(item[4:])
+    return item
+
+
+def encode_item(item):
+    return json.dumps(strip_sensitive(item), default=str)
+
+
+def encode_entry(entry):
+    if "prompt" in entry:
+        entry = dict(entry, prompt=strip_sensitive(entry["prompt"]))
+    return json.dumps(entry, default=str)
+
+
+def encode_summary(summary):
+    return json.dumps(summary, default=str)
+
+
+class Encoded:
+    """A parameter of a write that is only serialized (by encode) on the writer thread."""
+    def __init__(self, value, encode):
+        self.value = value
+        self.encode = encode
+
+
+def decode_entry(entry):
+    entry = json.loads(entry)
+    entry["prompt"] = tuple(entry["prompt"])
+    status = entry.get("status")
+    if status is not None:
+        status["messages"] = [tuple(m) for m in status.get("messages", [])]
+    return entry
+
+
+class SQLiteQueueStore:
+    """
+    Persists the queue and the history of a PromptQueue to a SQLite database.
+
+    Writes are handed to a background thread which serializes and commits them in batches, so put()
+    and task_done() never wait on the disk or the JSON encoding. A crash can lose the writes of the
+    last batch interval. API tokens in the extra data of the prompts are not persisted.
+    """
+    def __init__(self, path, max_history_items=None, batch_interval=0.05, max_batch=1000):
+        self.path = path
+        self.max_history_items = max_history_items
+        self.batch_interval = batch_interval
+        self.max_batch = max_batch
+        self.pending = queue.Queue()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(history)")]
+        if "summary" not in columns:
+            # Databases written before the summaries were stored, their rows decode the entry instead
+            self.connection.execute("ALTER TABLE history ADD COLUMN summary TEXT")
+        self.connection.commit()
+        # Reads come from the server thread while the writer commits
+        self.lock = threading.Lock()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def load_queue(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT item FROM queue ORDER BY number").fetchall()
+        return [tuple(json.loads(r[0])) for r in rows]
+
+    def load_history(self, max_items=None):
+        with self.lock:
+            if max_items is None:
+                rows = self.connection.execute("SELECT prompt_id, entry FROM history ORDER BY id").fetchall()
+            else:
+                rows = self.connection.execute("SELECT prompt_id, entry FROM (SELECT id, prompt_id, entry FROM history ORDER BY id DESC LIMIT ?) ORDER BY id", (max_items,)).fetchall()
+        return [(prompt_id, decode_entry(entry)) for prompt_id, entry in rows]
+
+    def query_history(self, since=None, until=None, status=None, client_id=None, max_items=None, summary=False):
+        """
+        History entries (or their summaries) that ended in [since, until) (millisecond timestamps),
+        newest first. Waits for the pending writes so the result matches the history in memory.
+        """
+        self.flush()
+        conditions = []
+        params = []
+        if since is not None:
+            conditions.append("end_time >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("end_time < ?")
+            params.append(until)
+        if status is not None:
+            conditions.append("status = ?")
+            params.append(status)
+        if client_id is not None:
+            conditions.append("client_id = ?")
+            params.append(client_id)
+        sql = "SELECT prompt_id, summary, entry FROM history" if summary else "SELECT prompt_id, entry FROM history"
+        if len(conditions) > 0:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY end_time DESC, id DESC"
+        if max_items is not None:
+            sql += " LIMIT ?"
+            params.append(max_items)
+        with self.lock:
+            rows = self.connection.execute(sql, params).fetchall()
+        if summary:
+            return [(prompt_id, json.loads(entry_summary) if entry_summary is not None else summarize_entry(decode_entry(entry))) for prompt_id, entry_summary, entry in rows]
+        return [(prompt_id, decode_entry(entry)) for prompt_id, entry in rows]
+
+    def put_item(self, item):
+        self.pending.put(("INSERT OR REPLACE INTO queue (prompt_id, number, item) VALUES (?, ?, ?)", (item[1], item[0], Encoded(item, encode_item))))
+
+    def remove_item(self, prompt_id):
+        self.pending.put(("DELETE FROM queue WHERE prompt_id = ?", (prompt_id,)))
+
+    def clear_queue(self):
+        self.pending.put(("DELETE FROM queue", ()))
+
+    def add_history(self, prompt_id, entry, summary=None):
+        if summary is None:
+            summary = summarize_entry(entry)
+        self.pending.put(("INSERT OR REPLACE INTO history (prompt_id, number, status, client_id, start_time, end_time, entry, summary) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                          (prompt_id, summary["number"], summary["status"], summary.get("client_id", None), summary["start_time"], summary["end_time"], Encoded(entry, encode_entry), Encoded(summary, encode_summary))))
+
+    def remove_history(self, prompt_id):
+        self.pending.put(("DELETE FROM history WHERE prompt_id = ?", (prompt_id,)))
+
+    def clear_history(self):
+        self.pending.put(("DELETE FROM history", ()))
+
+    def flush(self):
+        """Blocks until every write issued before the call is committed."""
+        done = threading.Event()
+        self.pending.put(done)
+        done.wait()
+
+    def _write_loop(self):
+        while True:
+            batch = [self.pending.get()]
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(self.pending.get(timeout=self.batch_interval))
+            except queue.Empty:
+                pass
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        events = []
+        history_changed = False
+        with self.lock:
+            try:
+                for op in batch:
+                    if isinstance(op, threading.Event):
+                        events.append(op)
+                        continue
+                    sql, params = op
+                    params = tuple(p.encode(p.value) if isinstance(p, Encoded) else p for p in params)
+                    self.connection.execute(sql, params)
+                    history_changed = history_changed or sql.startswith("INSERT OR REPLACE INTO history")
+                if history_changed and self.max_history_items is not None:
+                    self.connection.execute("DELETE FROM history WHERE id <= (SELECT id FROM history ORDER BY id DESC LIMIT 1 OFFSET ?)", (self.max_history_items,))
+                self.connection.commit()
+            except (sqlite3.Error, TypeError, ValueError) as e:
+                logging.error(f"Failed to write {len(batch)} queue updates to {self.path}: {e}")
+                self.connection.rollback()
+        for event in events:
+            event.set()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.connection.close()
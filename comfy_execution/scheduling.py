@@ -0,0 +1,213 @@
+import collections
+import copy
+import heapq
+import math
+
+# Priority classes, most urgent first. Prompts without one are "normal".
+PRIORITY_CLASSES = ("high", "normal", "low")
+DEFAULT_PRIORITY = "normal"
+
+
+def get_priority(item):
+    priority = item[3].get("priority", DEFAULT_PRIORITY)
+    if priority not in PRIORITY_CLASSES:
+        return DEFAULT_PRIORITY
+    return priority
+
+
+def get_client_id(item):
+    return item[3].get("client_id", None)
+
+
+def _is_count(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+# Options of the "scheduler" field of POST /queue: name -> (keyword of set_scheduler_options, validator)
+SCHEDULER_OPTIONS = {
+    "fair_share": ("fair_share", lambda value: isinstance(value, bool)),
+    "max_in_flight_per_client": ("max_in_flight", _is_count),
+    "model_affinity_window": ("model_affinity_window", _is_count),
+}
+
+
+def parse_scheduler_options(options):
+    """(keyword arguments of PromptQueue.set_scheduler_options for the valid options, names of the invalid ones)."""
+    if not isinstance(options, dict):
+        return {}, ["scheduler"]
+    out = {}
+    invalid = []
+    for name, value in options.items():
+        if name not in SCHEDULER_OPTIONS:
+            continue
+        keyword, is_valid = SCHEDULER_OPTIONS[name]
+        if is_valid(value):
+            out[keyword] = value
+        else:
+            invalid.append(name)
+    return out, invalid
+
+
+# Inputs of loader nodes (CheckpointLoaderSimple, UNETLoader, LoraLoader...) naming the model file they load
+MODEL_INPUT_NAMES = frozenset(["ckpt_name", "unet_name", "lora_name", "clip_name", "clip_name1", "clip_name2", "clip_name3",
+                               "vae_name", "control_net_name", "style_model_name", "clip_vision_name", "gligen_name", "upscale_model_name"])
+
+
+def get_models(item):
+    """The set of (input name, file name) model files loaded by the prompt of a queue item."""
+    models = set()
+    for node in item[2].values():
+        inputs = node.get("inputs", {}) if isinstance(node, dict) else {}
+        for name, value in inputs.items():
+            if name in MODEL_INPUT_NAMES and isinstance(value, str):
+                models.add((name, value))
+    return models
+
+
+class WaitTimeStats:
+    """Time spent in the queue by the prompts of one priority class."""
+    def __init__(self, window=1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = collections.deque(maxlen=window)
+
+    def add(self, wait_time):
+        self.count += 1
+        self.total += wait_time
+        self.max = max(self.max, wait_time)
+        self.recent.append(wait_time)
+
+    def percentile(self, p):
+        if len(self.recent) == 0:
+            return None
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, math.ceil(p * len(values)) - 1)]
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count > 0 else None,
+            "max": self.max,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+        }
+
+
+class QueueScheduler:
+    """
+    Picks the next prompt to run. Higher priority classes always go first. Within a class prompts
+    run in order of their number, or round robin between clients when fair_share is enabled.
+    Clients with max_in_flight prompts running are skipped until one of them is done.
+
+    With a model_affinity_window, the next model_affinity_window prompts of the class are looked at
+    and the one sharing the most model files with the previous prompt of the worker runs first, so
+    prompts using the same checkpoint run back to back. A prompt is passed over at most
+    model_affinity_window times.
+    """
+    def __init__(self, fair_share=False, max_in_flight=0, model_affinity_window=0):
+        self.fair_share = fair_share
+        self.max_in_flight = max_in_flight
+        self.model_affinity_window = model_affinity_window
+        self.last_served = {}  # Maps client id -> value of served_counter when it last got a prompt
+        self.served_counter = 0
+        self.wait_times = {p: WaitTimeStats() for p in PRIORITY_CLASSES}
+        self.last_models = {}  # Maps worker id -> models used by the last prompt it got
+        self.times_skipped = {}  # Maps prompt id -> number of times it was passed over for model affinity
+        self.reordered = 0
+        self.model_loads_saved = 0
+        self.last_worker_id = None
+
+    def select(self, queue, running, worker_id=None):
+        """Returns the index in queue of the next item to run, or None if nothing can run now."""
+        in_flight = collections.Counter()
+        if self.max_in_flight > 0:
+            for item in running:
+                in_flight[get_client_id(item)] += 1
+
+        candidates = []
+        for i, item in enumerate(queue):
+            client_id = get_client_id(item)
+            if self.max_in_flight > 0 and in_flight[client_id] >= self.max_in_flight:
+                continue
+            key = (PRIORITY_CLASSES.index(get_priority(item)),)
+            if self.fair_share:
+                key += (self.last_served.get(client_id, -1),)
+            key += (item[0],)
+            candidates.append((key, i))
+
+        if len(candidates) == 0:
+            return None
+        best_key, best = min(candidates)
+        if self.model_affinity_window <= 1:
+            return best
+
+        last_models = self.last_models.get(worker_id, None)
+        if not last_models:
+            return best
+
+        window = heapq.nsmallest(self.model_affinity_window, (c for c in candidates if c[0][0] == best_key[0]))
+        shared = [len(get_models(queue[i]) & last_models) for _, i in window]
+        chosen = max(range(len(window)), key=lambda x: (shared[x], -x))
+        for x in range(chosen):
+            if self.times_skipped.get(queue[window[x][1]][1], 0) >= self.model_affinity_window:
+                chosen = x
+                break
+        if chosen == 0:
+            return best
+
+        for _, i in window[:chosen]:
+            prompt_id = queue[i][1]
+            self.times_skipped[prompt_id] = self.times_skipped.get(prompt_id, 0) + 1
+        self.reordered += 1
+        self.model_loads_saved += shared[chosen] - shared[0]
+        return window[chosen][1]
+
+    def served(self, item, wait_time, worker_id=None):
+        self.wait_times[get_priority(item)].add(wait_time)
+        self._update_served(item, worker_id)
+        self.last_worker_id = worker_id
+
+    def _update_served(self, item, worker_id):
+        self.last_served[get_client_id(item)] = self.served_counter
+        self.served_counter += 1
+        if self.model_affinity_window > 1:
+            self.times_skipped.pop(item[1], None)
+            models = get_models(item)
+            if len(models) > 0:
+                self.last_models[worker_id] = models
+
+    def upcoming(self, queue, count):
+        """
+        The next count items of queue in the order they will be selected if nothing else is queued
+        meanwhile and the running prompts are done by then. Doesn't change the state of the scheduler.
+        """
+        simulation = copy.copy(self)
+        simulation.last_served = dict(self.last_served)
+        simulation.last_models = dict(self.last_models)
+        simulation.times_skipped = dict(self.times_skipped)
+        remaining = list(queue)
+        out = []
+        while len(out) < count and len(remaining) > 0:
+            index = simulation.select(remaining, (), self.last_worker_id)
+            if index is None:
+                break
+            item = remaining.pop(index)
+            simulation._update_served(item, self.last_worker_id)
+            out.append(item)
+        return out
+
+    def forget(self, prompt_id):
+        self.times_skipped.pop(prompt_id, None)
+
+    def get_stats(self):
+        return {
+            "fair_share": self.fair_share,
+            "max_in_flight_per_client": self.max_in_flight,
+            "wait_times": {p: s.as_dict() for p, s in self.wait_times.items()},
+            "model_affinity": {
+                "window": self.model_affinity_window,
+                "reordered": self.reordered,
+                "model_loads_saved": self.model_loads_saved,
+            },
+        }
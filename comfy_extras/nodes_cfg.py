@@ -40,6 +40,25 @@ class CFGZeroStar:
         m.set_model_sampler_post_cfg_function(cfg_zero_star)
         return (m, )
 
+class CFGStepCache:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"model": ("MODEL",),
+                             "threshold": ("FLOAT", {"default": 0.05, "min": 0.0, "max": 10.0, "step": 0.01, "tooltip": "How much the cond prediction may change, accumulated over the skipped steps, before the uncond is evaluated again. 0 disables the cache."}),
+                             "start_percent": ("FLOAT", {"default": 0.5, "min": 0.0, "max": 1.0, "step": 0.001}),
+                             "max_skipped_steps": ("INT", {"default": 2, "min": 0, "max": 100}),
+                            }}
+    RETURN_TYPES = ("MODEL",)
+    FUNCTION = "patch"
+    CATEGORY = "advanced/guidance"
+    DESCRIPTION = "Skips the uncond model evaluation of the steps after start_percent when the cond prediction barely changed, reusing the last difference between the cond and uncond predictions."
+
+    def patch(self, model, threshold, start_percent, max_skipped_steps):
+        m = model.clone()
+        m.model_options["step_cache"] = {"threshold": threshold, "start_percent": start_percent, "max_skipped_steps": max_skipped_steps}
+        return (m, )
+
 NODE_CLASS_MAPPINGS = {
-    "CFGZeroStar": CFGZeroStar
+    "CFGZeroStar": CFGZeroStar,
+    "CFGStepCache": CFGStepCache,
 }
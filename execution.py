@@ -1,5 +1,7 @@
 import sys
 import copy
+import collections
+import itertools
 import logging
 import threading
 import heapq
@@ -7,16 +9,22 @@ import time
 import traceback
 from enum import Enum
 import inspect
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 from typing import List, Literal, NamedTuple, Optional
 
 import torch
 import nodes
 
 import comfy.model_management
+import comfy.load_trace
 from comfy_execution.graph import get_input_info, ExecutionList, DynamicPrompt, ExecutionBlocker
 from comfy_execution.graph_utils import is_link, GraphBuilder
-from comfy_execution.caching import HierarchicalCache, LRUCache, DependencyAwareCache, CacheKeySetInputSignature, CacheKeySetID
+from comfy_execution.caching import HierarchicalCache, LRUCache, RAMBudgetCache, DependencyAwareCache, CacheKeySetInputSignature, CacheKeySetID, standalone_node_signature, to_digest
 from comfy_execution.validation import validate_node_input
+from comfy_execution.history import PromptHistory
+from comfy_execution.scheduling import QueueScheduler
+from comfy_execution.microbatch import MicroBatchServer, batch_signature
 
 class ExecutionResult(Enum):
     SUCCESS = 0
@@ -64,10 +72,15 @@ class CacheType(Enum):
     CLASSIC = 0
     LRU = 1
     DEPENDENCY_AWARE = 2
+    RAM_BUDGET = 3
 
 
+# UI results only hold filenames and small values, so the RAM budgeted cache keeps them by count
+MAXIMUM_UI_CACHE_SIZE = 10000
+
 class CacheSet:
-    def __init__(self, cache_type=None, cache_size=None):
+    def __init__(self, cache_type=None, cache_size=None, disk_cache=None):
+        self.disk_cache = disk_cache
         if cache_type == CacheType.DEPENDENCY_AWARE:
             self.init_dependency_aware_cache()
             logging.info("Disabling intermediate node cache.")
@@ -76,6 +89,9 @@ class CacheSet:
                 cache_size = 0
             self.init_lru_cache(cache_size)
             logging.info("Using LRU cache")
+        elif cache_type == CacheType.RAM_BUDGET:
+            self.init_ram_budget_cache(cache_size)
+            logging.info("Using RAM budgeted cache ({} GB)".format(cache_size))
         else:
             self.init_classic_cache()
 
@@ -83,18 +99,25 @@ class CacheSet:
 
     # Performs like the old cache -- dump data ASAP
     def init_classic_cache(self):
-        self.outputs = HierarchicalCache(CacheKeySetInputSignature)
+        self.outputs = HierarchicalCache(CacheKeySetInputSignature, disk_cache=self.disk_cache)
         self.ui = HierarchicalCache(CacheKeySetInputSignature)
         self.objects = HierarchicalCache(CacheKeySetID)
 
     def init_lru_cache(self, cache_size):
-        self.outputs = LRUCache(CacheKeySetInputSignature, max_size=cache_size)
+        self.outputs = LRUCache(CacheKeySetInputSignature, max_size=cache_size, disk_cache=self.disk_cache)
         self.ui = LRUCache(CacheKeySetInputSignature, max_size=cache_size)
         self.objects = HierarchicalCache(CacheKeySetID)
 
+    # cache_size is the RAM budget in GB
+    def init_ram_budget_cache(self, cache_size):
+        max_bytes = int(cache_size * (1024 ** 3))
+        self.outputs = RAMBudgetCache(CacheKeySetInputSignature, max_bytes=max_bytes, disk_cache=self.disk_cache)
+        self.ui = LRUCache(CacheKeySetInputSignature, max_size=MAXIMUM_UI_CACHE_SIZE)
+        self.objects = HierarchicalCache(CacheKeySetID)
+
     # only hold cached items while the decendents have not executed
     def init_dependency_aware_cache(self):
-        self.outputs = DependencyAwareCache(CacheKeySetInputSignature)
+        self.outputs = DependencyAwareCache(CacheKeySetInputSignature, disk_cache=self.disk_cache)
         self.ui = DependencyAwareCache(CacheKeySetInputSignature)
         self.objects = DependencyAwareCache(CacheKeySetID)
 
@@ -133,11 +156,17 @@ def get_input_data(inputs, class_def, unique_id, outputs=None, dynprompt=None, e
         elif input_category is not None:
             input_data_all[x] = [input_data]
 
+    original_prompt = dynprompt.get_original_prompt() if dynprompt is not None else {}
+    microbatch = extra_data.get("microbatch", None)
+    if microbatch is not None:
+        # The prompt and extra data of the prompt of the batch the node belongs to
+        original_prompt, extra_data = microbatch.member_data(unique_id)
+
     if "hidden" in valid_inputs:
         h = valid_inputs["hidden"]
         for x in h:
             if h[x] == "PROMPT":
-                input_data_all[x] = [dynprompt.get_original_prompt() if dynprompt is not None else {}]
+                input_data_all[x] = [original_prompt]
             if h[x] == "DYNPROMPT":
                 input_data_all[x] = [dynprompt]
             if h[x] == "EXTRA_PNGINFO":
@@ -215,6 +244,33 @@ def merge_result_data(results, obj):
             output.append([o[i] for o in results])
     return output
 
+def get_microbatch_inputs(group, dynprompt, caches, extra_data):
+    """
+    The inputs of the nodes of a group of batched sampling nodes (see comfy_execution.microbatch)
+    that still have to be executed, or None if they can't be executed with a single call.
+    """
+    group_inputs = {}
+    for node_id in group:
+        if caches.outputs.get(node_id) is not None:
+            continue
+        node = dynprompt.get_node(node_id)
+        class_def = nodes.NODE_CLASS_MAPPINGS[node["class_type"]]
+        input_data_all, missing_keys = get_input_data(node["inputs"], class_def, node_id, caches.outputs, dynprompt, extra_data)
+        if len(missing_keys) > 0:
+            return None
+        for value in input_data_all.values():
+            if len(value) != 1 or isinstance(value[0], ExecutionBlocker):
+                return None
+        group_inputs[node_id] = {k: v[0] for k, v in input_data_all.items()}
+    if len(group_inputs) < 2:
+        return None
+    return group_inputs
+
+def get_microbatch_output_data(obj, group_inputs):
+    nodes.before_node_execution()
+    results = getattr(obj, obj.MICROBATCH_FUNCTION)(list(group_inputs.values()))
+    return {node_id: merge_result_data([result], obj) for node_id, result in zip(group_inputs.keys(), results)}
+
 def get_output_data(obj, input_data_all, execution_block_cb=None, pre_execute_cb=None):
     results = []
     uis = []
@@ -265,7 +321,18 @@ def format_value(x):
     else:
         return str(x)
 
-def execute(server, dynprompt, caches, current_item, extra_data, executed, prompt_id, execution_list, pending_subgraph_results):
+@contextmanager
+def released(lock):
+    if lock is None:
+        yield
+        return
+    lock.release()
+    try:
+        yield
+    finally:
+        lock.acquire()
+
+def execute(server, dynprompt, caches, current_item, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, bookkeeping_lock=None):
     unique_id = current_item
     real_node_id = dynprompt.get_real_node_id(unique_id)
     display_node_id = dynprompt.get_display_node_id(unique_id)
@@ -344,7 +411,23 @@ def execute(server, dynprompt, caches, current_item, extra_data, executed, promp
                     return block
             def pre_execute_cb(call_index):
                 GraphBuilder.set_default_prefix(unique_id, call_index, 0)
-            output_data, output_ui, has_subgraph = get_output_data(obj, input_data_all, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb)
+            microbatch = extra_data.get("microbatch", None)
+            group_inputs = None
+            if microbatch is not None and unique_id in microbatch.groups:
+                group_inputs = get_microbatch_inputs(microbatch.groups[unique_id], dynprompt, caches, extra_data)
+            # When branches run in parallel, only the node itself runs outside of the lock that protects
+            # the caches and the execution list
+            with released(bookkeeping_lock):
+                if group_inputs is not None:
+                    group_outputs = get_microbatch_output_data(obj, group_inputs)
+                else:
+                    output_data, output_ui, has_subgraph = get_output_data(obj, input_data_all, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb)
+            if group_inputs is not None:
+                # The other nodes of the group find their outputs in the cache
+                for node_id, node_output in group_outputs.items():
+                    if node_id != unique_id:
+                        caches.outputs.set(node_id, node_output)
+                output_data, output_ui, has_subgraph = group_outputs[unique_id], [], False
         if len(output_ui) > 0:
             caches.ui.set(unique_id, {
                 "meta": {
@@ -433,15 +516,71 @@ def execute(server, dynprompt, caches, current_item, extra_data, executed, promp
 
     return (ExecutionResult.SUCCESS, None, None)
 
+def get_execution_resource(class_def):
+    """
+    Returns what a node class declared it mostly uses with EXECUTION_RESOURCE: "cpu", "io" or "gpu".
+    Nodes that don't declare anything are assumed to need the GPU (and model management) exclusively.
+    """
+    resource = getattr(class_def, "EXECUTION_RESOURCE", "gpu")
+    if resource not in EXECUTION_RESOURCES:
+        return "gpu"
+    return resource
+
+EXECUTION_RESOURCES = ("cpu", "io", "gpu")
+
+# Per thread state of a prompt worker: "server" is the view of the server its progress goes to
+worker_context = threading.local()
+
+@contextmanager
+def inherit_worker_context(server, device, prompt_ids=(), cancelled=None):
+    """Makes a thread pool thread act as the prompt worker it runs nodes for: same server view, torch device and interrupts."""
+    previous_server = getattr(worker_context, "server", None)
+    previous_device = getattr(comfy.model_management.thread_torch_device, "device", None)
+    previous_prompt_ids = comfy.model_management.get_thread_interrupt_scope()
+    previous_cancelled = comfy.model_management.get_thread_cancel_event()
+    worker_context.server = server
+    comfy.model_management.set_thread_torch_device(device)
+    comfy.model_management.set_thread_interrupt_scope(prompt_ids)
+    comfy.model_management.set_thread_cancel_event(cancelled)
+    try:
+        yield
+    finally:
+        if previous_server is None:
+            del worker_context.server
+        else:
+            worker_context.server = previous_server
+        comfy.model_management.set_thread_torch_device(previous_device)
+        comfy.model_management.set_thread_interrupt_scope(previous_prompt_ids)
+        comfy.model_management.set_thread_cancel_event(previous_cancelled)
+
+@contextmanager
+def prompt_interrupt_scope(prompt_ids):
+    """
+    Makes the interrupts of prompt_ids (see /interrupt) stop the nodes executed in the context.
+    They are cleared at the end, unless an enclosing scope covers them as well.
+    """
+    previous_prompt_ids = comfy.model_management.get_thread_interrupt_scope()
+    comfy.model_management.set_thread_interrupt_scope(prompt_ids)
+    try:
+        yield
+    finally:
+        comfy.model_management.set_thread_interrupt_scope(previous_prompt_ids)
+        comfy.model_management.clear_prompt_interrupts(set(prompt_ids) - set(previous_prompt_ids))
+
 class PromptExecutor:
-    def __init__(self, server, cache_type=False, cache_size=None):
+    def __init__(self, server, cache_type=False, cache_size=None, disk_cache=None, max_workers=1):
         self.cache_size = cache_size
+        self.disk_cache = disk_cache
         self.cache_type = cache_type
         self.server = server
+        self.max_workers = max_workers
+        self.thread_pool = None
+        if max_workers > 1:
+            self.thread_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="node_worker")
         self.reset()
 
     def reset(self):
-        self.caches = CacheSet(cache_type=self.cache_type, cache_size=self.cache_size)
+        self.caches = CacheSet(cache_type=self.cache_type, cache_size=self.cache_size, disk_cache=self.disk_cache)
         self.status_messages = []
         self.success = True
 
@@ -493,7 +632,8 @@ class PromptExecutor:
         self.status_messages = []
         self.add_message("execution_start", { "prompt_id": prompt_id}, broadcast=False)
 
-        with torch.inference_mode():
+        prompt_ids = [item[1] for item in extra_data["microbatch"].items] if "microbatch" in extra_data else [prompt_id]
+        with torch.inference_mode(), comfy.load_trace.prompt_trace(prompt_id), prompt_interrupt_scope(prompt_ids):
             dynamic_prompt = DynamicPrompt(prompt)
             is_changed_cache = IsChangedCache(dynamic_prompt, self.caches.outputs)
             for cache in self.caches.all:
@@ -515,25 +655,32 @@ class PromptExecutor:
             current_outputs = self.caches.outputs.all_node_ids()
             for node_id in list(execute_outputs):
                 execution_list.add_node(node_id)
+            if "microbatch" in extra_data:
+                extra_data["microbatch"].add_group_links(execution_list)
 
-            while not execution_list.is_empty():
-                node_id, error, ex = execution_list.stage_node_execution()
-                if error is not None:
-                    self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
-                    break
-
-                result, error, ex = execute(self.server, dynamic_prompt, self.caches, node_id, extra_data, executed, prompt_id, execution_list, pending_subgraph_results)
-                self.success = result != ExecutionResult.FAILURE
-                if result == ExecutionResult.FAILURE:
-                    self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
-                    break
-                elif result == ExecutionResult.PENDING:
-                    execution_list.unstage_node_execution()
-                else: # result == ExecutionResult.SUCCESS:
-                    execution_list.complete_node_execution()
+            if self.thread_pool is not None:
+                success = self.execute_parallel(dynamic_prompt, prompt_id, extra_data, executed, execution_list, pending_subgraph_results, current_outputs)
+                if success:
+                    self.add_message("execution_success", { "prompt_id": prompt_id }, broadcast=False)
             else:
-                # Only execute when the while-loop ends without break
-                self.add_message("execution_success", { "prompt_id": prompt_id }, broadcast=False)
+                while not execution_list.is_empty():
+                    node_id, error, ex = execution_list.stage_node_execution()
+                    if error is not None:
+                        self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
+                        break
+
+                    result, error, ex = execute(self.server, dynamic_prompt, self.caches, node_id, extra_data, executed, prompt_id, execution_list, pending_subgraph_results)
+                    self.success = result != ExecutionResult.FAILURE
+                    if result == ExecutionResult.FAILURE:
+                        self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
+                        break
+                    elif result == ExecutionResult.PENDING:
+                        execution_list.unstage_node_execution()
+                    else: # result == ExecutionResult.SUCCESS:
+                        execution_list.complete_node_execution()
+                else:
+                    # Only execute when the while-loop ends without break
+                    self.add_message("execution_success", { "prompt_id": prompt_id }, broadcast=False)
 
             ui_outputs = {}
             meta_outputs = {}
@@ -551,8 +698,186 @@ class PromptExecutor:
             if comfy.model_management.DISABLE_SMART_MEMORY:
                 comfy.model_management.unload_all_models()
 
+    def is_output_cached(self, prompt, node_id):
+        """
+        If the outputs of a loader node of prompt are in the output cache, so executing it won't load
+        anything. Used by the model prefetcher from other threads.
+        """
+        node = prompt.get(node_id, None)
+        if not isinstance(node, dict):
+            return False
+        signature = standalone_node_signature(node_id, node)
+        return signature is not None and signature in self.caches.outputs.cache
+
+    def execute_microbatch(self, batch):
+        """
+        Executes the prompts of a comfy_execution.microbatch.MicroBatch as one merged prompt. Returns
+        the (history result, status messages, success) of each of them. When the merged prompt fails,
+        the prompt the failing node belongs to gets the error and the other prompts are executed again
+        one by one (their nodes that already ran are cached) so they don't fail with it.
+        """
+        prompt_ids = [item[1] for item in batch.items]
+        with prompt_interrupt_scope(prompt_ids):
+            server = self.server
+            self.server = MicroBatchServer(server, batch)
+            try:
+                self.execute(batch.prompt, batch.prompt_id, batch.extra_data, batch.execute_outputs)
+            finally:
+                self.server = server
+            histories = batch.split_history(self.history_result)
+            messages = batch.split_messages(self.status_messages)
+            results = [(history, member_messages, self.success) for history, member_messages in zip(histories, messages)]
+            if self.success:
+                return results
+
+            failed = batch.failed_members(self.status_messages, comfy.model_management.get_interrupted_prompts(prompt_ids))
+            for index, item in enumerate(batch.items):
+                if index not in failed:
+                    self.execute(item[2], item[1], item[3], item[4])
+                    results[index] = (self.history_result, self.status_messages, self.success)
+            self.success = all(success for _, _, success in results)
+            return results
+
+    def execute_parallel(self, dynamic_prompt, prompt_id, extra_data, executed, execution_list, pending_subgraph_results, current_outputs):
+        """
+        Runs every ready node on the thread pool instead of one node at a time. Nodes that declare
+        EXECUTION_RESOURCE "cpu" or "io" overlap with everything else, the remaining ("gpu") nodes
+        are still executed one at a time. Returns True if every node executed successfully.
+        """
+        self.success = True
+        bookkeeping_lock = threading.Lock()
+        running = {}  # Maps future -> (node_id, resource)
+        failure = None
+        # Set on the first failure so the other running nodes stop early, without touching the
+        # global interrupt state other prompts (and user interrupts) go through
+        cancelled = threading.Event()
+
+        worker_server = getattr(worker_context, "server", None)
+        worker_device = getattr(comfy.model_management.thread_torch_device, "device", None)
+        worker_prompt_ids = comfy.model_management.get_thread_interrupt_scope()
+
+        def run_node(node_id):
+            if cancelled.is_set():
+                return (ExecutionResult.FAILURE, None, None)
+            with inherit_worker_context(worker_server or self.server, worker_device, worker_prompt_ids, cancelled), torch.inference_mode(), comfy.load_trace.prompt_trace(prompt_id), bookkeeping_lock:
+                return execute(self.server, dynamic_prompt, self.caches, node_id, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, bookkeeping_lock=bookkeeping_lock)
+
+        with bookkeeping_lock:
+            while True:
+                if failure is None:
+                    running_nodes = set(node_id for node_id, _ in running.values())
+                    gpu_busy = any(resource == "gpu" for _, resource in running.values())
+                    for node_id in execution_list.get_ready_nodes():
+                        if node_id in running_nodes:
+                            continue
+                        class_type = dynamic_prompt.get_node(node_id)["class_type"]
+                        resource = get_execution_resource(nodes.NODE_CLASS_MAPPINGS[class_type])
+                        if resource == "gpu":
+                            if gpu_busy:
+                                continue
+                            gpu_busy = True
+                        running[self.thread_pool.submit(run_node, node_id)] = (node_id, resource)
+
+                if len(running) == 0:
+                    if failure is not None:
+                        error, ex = failure
+                        self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
+                        return False
+                    if execution_list.is_empty():
+                        return True
+                    # Nothing is ready or running, so stage_node_execution will report the cycle
+                    _, error, ex = execution_list.stage_node_execution()
+                    self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
+                    return False
+
+                with released(bookkeeping_lock):
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    node_id, _ = running.pop(future)
+                    result, error, ex = future.result()
+                    if result == ExecutionResult.FAILURE:
+                        self.success = False
+                        if failure is None:
+                            failure = (error, ex)
+                            cancelled.set()
+                    elif result == ExecutionResult.SUCCESS:
+                        execution_list.pop_node(node_id)
+
+class ValidationCache:
+    """
+    Remembers the nodes that passed validation, keyed by a digest of the node and of everything
+    upstream of it, so that resubmitting a tweaked prompt only validates the nodes that changed.
+    Nodes with VALIDATE_INPUTS are always validated again since it can depend on outside state
+    (files existing...), and the COMBO inputs of a cached node are checked again against the current
+    options since files can be removed.
+    """
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()  # Maps node signature -> (validated constant inputs, names of the COMBO inputs)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, signature):
+        with self.lock:
+            entry = self.entries.get(signature, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(signature)
+            self.hits += 1
+            return copy.deepcopy(entry[0]), entry[1]
+
+    def set(self, signature, inputs, combo_inputs=()):
+        with self.lock:
+            self.entries[signature] = (copy.deepcopy(inputs), tuple(combo_inputs))
+            self.entries.move_to_end(signature)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+def combo_inputs_valid(obj_class, inputs, combo_inputs):
+    """If the values of the COMBO inputs combo_inputs are still among the options of the node."""
+    if len(combo_inputs) == 0:
+        return True
+    class_inputs = obj_class.INPUT_TYPES()
+    for x in combo_inputs:
+        input_type, _, _ = get_input_info(obj_class, x, class_inputs)
+        if not isinstance(input_type, list) or inputs.get(x, None) not in input_type:
+            return False
+    return True
+
+def get_validation_signature(prompt, unique_id, signatures):
+    if unique_id in signatures:
+        return signatures[unique_id]
+    signatures[unique_id] = None  # Guards against cycles
+    node = prompt.get(unique_id, None)
+    if not isinstance(node, dict) or not isinstance(node.get('inputs', None), dict):
+        return None
+
+    signature = [node.get('class_type', None)]
+    for key in sorted(node['inputs'].keys()):
+        val = node['inputs'][key]
+        if is_link(val):
+            if val[0] not in prompt:
+                return None
+            upstream = get_validation_signature(prompt, val[0], signatures)
+            if upstream is None:
+                return None
+            signature.append((key, ("LINK", upstream, val[1])))
+        else:
+            signature.append((key, val))
+    digest = to_digest(signature)
+    if not isinstance(digest, bytes):
+        return None
+    signatures[unique_id] = digest
+    return digest
 
-def validate_inputs(prompt, item, validated):
+def validate_inputs(prompt, item, validated, validation_cache=None, signatures=None):
     unique_id = item
     if unique_id in validated:
         return validated[unique_id]
@@ -561,6 +886,22 @@ def validate_inputs(prompt, item, validated):
     class_type = prompt[unique_id]['class_type']
     obj_class = nodes.NODE_CLASS_MAPPINGS[class_type]
 
+    signature = None
+    if validation_cache is not None and not hasattr(obj_class, "VALIDATE_INPUTS"):
+        signature = get_validation_signature(prompt, unique_id, signatures)
+    if signature is not None:
+        cached = validation_cache.get(signature)
+        if cached is not None and combo_inputs_valid(obj_class, cached[0], cached[1]):
+            validated_inputs = cached[0]
+            # Upstream nodes still need their inputs converted, and the ones with VALIDATE_INPUTS can fail now
+            ret = (True, [], unique_id)
+            for val in inputs.values():
+                if is_link(val) and validate_inputs(prompt, val[0], validated, validation_cache, signatures)[0] is False:
+                    ret = (False, [], unique_id)
+            inputs.update(validated_inputs)
+            validated[unique_id] = ret
+            return ret
+
     class_inputs = obj_class.INPUT_TYPES()
     valid_inputs = set(class_inputs.get('required',{})).union(set(class_inputs.get('optional',{})))
 
@@ -574,6 +915,7 @@ def validate_inputs(prompt, item, validated):
         validate_function_inputs = argspec.args
         validate_has_kwargs = argspec.varkw is not None
     received_types = {}
+    combo_inputs = []
 
     for x in valid_inputs:
         input_type, input_category, extra_info = get_input_info(obj_class, x, class_inputs)
@@ -629,7 +971,7 @@ def validate_inputs(prompt, item, validated):
                 errors.append(error)
                 continue
             try:
-                r = validate_inputs(prompt, o_id, validated)
+                r = validate_inputs(prompt, o_id, validated, validation_cache, signatures)
                 if r[0] is False:
                     # `r` will be set in `validated[o_id]` already
                     valid = False
@@ -718,6 +1060,7 @@ def validate_inputs(prompt, item, validated):
                     continue
 
                 if isinstance(input_type, list):
+                    combo_inputs.append(x)
                     combo_options = input_type
                     if val not in combo_options:
                         input_config = info
@@ -777,6 +1120,8 @@ def validate_inputs(prompt, item, validated):
         ret = (False, errors, unique_id)
     else:
         ret = (True, [], unique_id)
+        if signature is not None:
+            validation_cache.set(signature, {k: v for k, v in inputs.items() if not is_link(v)}, combo_inputs)
 
     validated[unique_id] = ret
     return ret
@@ -787,7 +1132,7 @@ def full_type_name(klass):
         return klass.__qualname__
     return module + '.' + klass.__qualname__
 
-def validate_prompt(prompt):
+def validate_prompt(prompt, validation_cache=None):
     outputs = set()
     for x in prompt:
         if 'class_type' not in prompt[x]:
@@ -826,11 +1171,12 @@ def validate_prompt(prompt):
     errors = []
     node_errors = {}
     validated = {}
+    signatures = {}
     for o in outputs:
         valid = False
         reasons = []
         try:
-            m = validate_inputs(prompt, o, validated)
+            m = validate_inputs(prompt, o, validated, validation_cache, signatures)
             valid = m[0]
             reasons = m[1]
         except Exception as ex:
@@ -895,38 +1241,158 @@ def validate_prompt(prompt):
 
     return (True, None, list(good_outputs), node_errors)
 
+def apply_prompt_delta(prompt, delta):
+    """
+    Returns a copy of prompt with delta applied. delta maps node ids to:
+    - None to remove the node
+    - a node with a class_type, which replaces (or adds) the node
+    - {"inputs": {...}} to only change these inputs, an input set to None is removed
+    Raises ValueError if delta isn't made of these.
+    """
+    if not isinstance(delta, dict):
+        raise ValueError("prompt_delta must be an object mapping node ids to nodes")
+    prompt = copy.deepcopy(prompt)
+    for node_id, node in delta.items():
+        if node is None:
+            prompt.pop(node_id, None)
+        elif not isinstance(node, dict):
+            raise ValueError(f"Node {node_id} of prompt_delta must be an object or null")
+        elif not isinstance(node.get("inputs", {}), dict):
+            raise ValueError(f"The inputs of node {node_id} of prompt_delta must be an object")
+        elif "class_type" in node or node_id not in prompt:
+            prompt[node_id] = copy.deepcopy(node)
+        else:
+            for key, value in node.items():
+                if key != "inputs":
+                    prompt[node_id][key] = copy.deepcopy(value)
+                    continue
+                inputs = prompt[node_id].setdefault("inputs", {})
+                for input_name, input_value in value.items():
+                    if input_value is None:
+                        inputs.pop(input_name, None)
+                    else:
+                        inputs[input_name] = copy.deepcopy(input_value)
+    return prompt
+
 MAXIMUM_HISTORY_SIZE = 10000
 
 class PromptQueue:
-    def __init__(self, server):
+    def __init__(self, server, max_history_items=MAXIMUM_HISTORY_SIZE, max_history_bytes=None, store=None, scheduler=None, prefetcher=None):
         self.server = server
         self.mutex = threading.RLock()
         self.not_empty = threading.Condition(self.mutex)
         self.task_counter = 0
         self.queue = []
         self.currently_running = {}
-        self.history = {}
+        self.history = PromptHistory(max_items=max_history_items, max_bytes=max_history_bytes)
         self.flags = {}
+        self.workers = {}  # Maps worker id -> state of the prompt worker, see register_worker
+        self.store = store
+        self.scheduler = scheduler if scheduler is not None else QueueScheduler()
+        self.enqueue_times = {}  # Maps prompt id -> time it was queued, for the wait time stats
+        self.prefetcher = prefetcher
         server.prompt_queue = self
+        if store is not None:
+            self.restore()
+
+    def restore(self):
+        """Loads the history and the prompts that were pending (or running) when the server stopped."""
+        max_number = -1
+        for prompt_id, entry in self.store.load_history(max_items=self.history.max_items):
+            self.history.add(prompt_id, entry)
+            max_number = max(max_number, abs(entry["prompt"][0]))
+        items = self.store.load_queue()
+        for item in items:
+            heapq.heappush(self.queue, item)
+            self.enqueue_times[item[1]] = time.time()
+            max_number = max(max_number, abs(item[0]))
+        # New prompts have to be numbered after the restored ones
+        if hasattr(self.server, "number"):
+            self.server.number = max(self.server.number, int(max_number) + 1)
+        if len(items) > 0:
+            logging.info("Restored {} queued prompts from {}".format(len(items), self.store.path))
+
+    def register_worker(self, worker_id, device=None):
+        """
+        Registers a prompt worker pulling from this queue. Only needed when running more than one
+        worker: it lets the queue report what each of them is running and gives each its own flags.
+        """
+        with self.mutex:
+            self.workers[worker_id] = {"device": None if device is None else str(device), "task_id": None, "prompt_id": None, "started": None, "flags": {}}
 
     def put(self, item):
         with self.mutex:
             heapq.heappush(self.queue, item)
+            self.enqueue_times[item[1]] = time.time()
+            if self.store is not None:
+                self.store.put_item(item)
             self.server.queue_updated()
+            self._update_prefetcher()
             self.not_empty.notify()
 
-    def get(self, timeout=None):
+    def get(self, timeout=None, worker_id=None):
         with self.not_empty:
-            while len(self.queue) == 0:
+            index = self.scheduler.select(self.queue, self.currently_running.values(), worker_id)
+            while index is None:
                 self.not_empty.wait(timeout=timeout)
-                if timeout is not None and len(self.queue) == 0:
+                index = self.scheduler.select(self.queue, self.currently_running.values(), worker_id)
+                if timeout is not None and index is None:
                     return None
-            item = heapq.heappop(self.queue)
-            i = self.task_counter
-            self.currently_running[i] = copy.deepcopy(item)
-            self.task_counter += 1
-            self.server.queue_updated()
-            return (item, i)
+            return self._start_item(index, worker_id)
+
+    def get_microbatch(self, item, max_items, timeout=0.0, worker_id=None):
+        """
+        Takes up to max_items queued prompts that can be executed in a micro-batch with item (see
+        comfy_execution.microbatch) out of the queue, waiting up to timeout seconds for them to be
+        queued. Members are taken in the order the scheduler selects prompts for worker_id, the batch
+        ends at the first selected prompt that can't join it. Returns them as (item, item id) like get.
+        """
+        signature = batch_signature(item)
+        out = []
+        if signature is None or max_items <= 0:
+            return out
+        deadline = time.perf_counter() + timeout
+        with self.not_empty:
+            while True:
+                while len(out) < max_items:
+                    index = self.scheduler.select(self.queue, self.currently_running.values(), worker_id)
+                    if index is None:
+                        break
+                    if batch_signature(self.queue[index]) != signature:
+                        # Taking later prompts would put them ahead of this one
+                        return out
+                    out.append(self._start_item(index, worker_id, batch_member=True))
+                remaining = deadline - time.perf_counter()
+                if len(out) >= max_items or remaining <= 0:
+                    return out
+                self.not_empty.wait(timeout=remaining)
+                if len(self.queue) > 0:
+                    # The prompt that woke us up may be for another worker
+                    self.not_empty.notify()
+
+    def _start_item(self, index, worker_id, batch_member=False):
+        item = self._pop_queue_item(index)
+        now = time.time()
+        self.scheduler.served(item, now - self.enqueue_times.pop(item[1], now), worker_id)
+        i = self.task_counter
+        self.currently_running[i] = copy.deepcopy(item)
+        self.task_counter += 1
+        if worker_id is not None and not batch_member:
+            # The worker keeps reporting the prompt its micro-batch was built around
+            self.workers[worker_id].update(task_id=i, prompt_id=item[1], started=time.time())
+        self.server.queue_updated()
+        self._update_prefetcher()
+        return (item, i)
+
+    def _pop_queue_item(self, index):
+        if index == 0:
+            return heapq.heappop(self.queue)
+        item = self.queue[index]
+        last = self.queue.pop()
+        if index < len(self.queue):
+            self.queue[index] = last
+            heapq.heapify(self.queue)
+        return item
 
     class ExecutionStatus(NamedTuple):
         status_str: Literal['success', 'error']
@@ -937,20 +1403,32 @@ class PromptQueue:
                   status: Optional['PromptQueue.ExecutionStatus']):
         with self.mutex:
             prompt = self.currently_running.pop(item_id)
-            if len(self.history) > MAXIMUM_HISTORY_SIZE:
-                self.history.pop(next(iter(self.history)))
-
+            for worker in self.workers.values():
+                if worker["task_id"] == item_id:
+                    worker.update(task_id=None, prompt_id=None, started=None)
             status_dict: Optional[dict] = None
             if status is not None:
                 status_dict = copy.deepcopy(status._asdict())
 
-            self.history[prompt[1]] = {
+            # prompt is already a private copy made when the item left the queue
+            entry = {
                 "prompt": prompt,
                 "outputs": {},
                 'status': status_dict,
             }
-            self.history[prompt[1]].update(history_result)
+            entry.update(history_result)
+            self.history.add(prompt[1], entry)
+            if self.store is not None:
+                self.store.remove_item(prompt[1])
+                self.store.add_history(prompt[1], entry, self.history.entries[prompt[1]][2])
             self.server.queue_updated()
+            self._update_prefetcher()
+            # Prompts of this client may have been held back by the in flight limit
+            self.not_empty.notify_all()
+
+    def _update_prefetcher(self):
+        if self.prefetcher is not None:
+            self.prefetcher.queue_changed(list(self.currently_running.values()), self.scheduler.upcoming(self.queue, self.prefetcher.lookahead))
 
     def get_current_queue(self):
         with self.mutex:
@@ -959,14 +1437,52 @@ class PromptQueue:
                 out += [x]
             return (out, copy.deepcopy(self.queue))
 
+    def get_running_prompt_ids(self):
+        with self.mutex:
+            return [item[1] for item in self.currently_running.values()]
+
+    def device_busy(self, worker_id):
+        """If another worker on the device of worker_id is running a prompt, so the models of that device may be in use."""
+        with self.mutex:
+            device = self.workers[worker_id]["device"]
+            return any(other_id != worker_id and worker["device"] == device and worker["task_id"] is not None
+                       for other_id, worker in self.workers.items())
+
+    def get_worker_states(self):
+        with self.mutex:
+            out = []
+            for worker_id, worker in self.workers.items():
+                out.append({"worker": worker_id, "device": worker["device"], "prompt_id": worker["prompt_id"], "started": worker["started"]})
+            return out
+
+    def get_scheduler_stats(self):
+        with self.mutex:
+            return self.scheduler.get_stats()
+
+    def set_scheduler_options(self, fair_share=None, max_in_flight=None, model_affinity_window=None):
+        with self.mutex:
+            if fair_share is not None:
+                self.scheduler.fair_share = fair_share
+            if max_in_flight is not None:
+                self.scheduler.max_in_flight = max_in_flight
+            if model_affinity_window is not None:
+                self.scheduler.model_affinity_window = model_affinity_window
+            self.not_empty.notify_all()
+
     def get_tasks_remaining(self):
         with self.mutex:
             return len(self.queue) + len(self.currently_running)
 
     def wipe_queue(self):
         with self.mutex:
+            for item in self.queue:
+                self.enqueue_times.pop(item[1], None)
+                self.scheduler.forget(item[1])
+                if self.store is not None:
+                    self.store.remove_item(item[1])
             self.queue = []
             self.server.queue_updated()
+            self._update_prefetcher()
 
     def delete_queue_item(self, function):
         with self.mutex:
@@ -975,46 +1491,109 @@ class PromptQueue:
                     if len(self.queue) == 1:
                         self.wipe_queue()
                     else:
+                        self.enqueue_times.pop(self.queue[x][1], None)
+                        self.scheduler.forget(self.queue[x][1])
+                        if self.store is not None:
+                            self.store.remove_item(self.queue[x][1])
                         self.queue.pop(x)
                         heapq.heapify(self.queue)
                     self.server.queue_updated()
+                    self._update_prefetcher()
                     return True
         return False
 
-    def get_history(self, prompt_id=None, max_items=None, offset=-1):
+    def get_history(self, prompt_id=None, max_items=None, offset=-1, summary=False):
         with self.mutex:
             if prompt_id is None:
-                out = {}
-                i = 0
-                if offset < 0 and max_items is not None:
-                    offset = len(self.history) - max_items
-                for k in self.history:
-                    if i >= offset:
-                        out[k] = self.history[k]
-                        if max_items is not None and len(out) >= max_items:
-                            break
-                    i += 1
-                return out
+                if offset < 0:
+                    if max_items is None:
+                        offset = 0
+                    else:
+                        offset = -max_items
+                return self.history.items(offset=offset, max_items=max_items, summary=summary)
             elif prompt_id in self.history:
-                return {prompt_id: copy.deepcopy(self.history[prompt_id])}
+                return {prompt_id: copy.deepcopy(self.history.get(prompt_id, summary))}
             else:
                 return {}
 
+    def get_prompt(self, prompt_id):
+        """The prompt of a queued, running or finished item, or None if it isn't known anymore."""
+        with self.mutex:
+            item = None
+            if prompt_id in self.history:
+                item = self.history[prompt_id]["prompt"]
+            else:
+                for x in itertools.chain(self.currently_running.values(), self.queue):
+                    if x[1] == prompt_id:
+                        item = x
+                        break
+            if item is None:
+                return None
+            return copy.deepcopy(item[2])
+
+    def get_history_page(self, cursor=None, max_items=None, summary=False):
+        with self.mutex:
+            return self.history.page(cursor=cursor, max_items=max_items, summary=summary)
+
+    def query_history(self, since=None, until=None, status=None, client_id=None, max_items=None, summary=False):
+        """
+        History entries that ended in [since, until) (millisecond timestamps) filtered by status and
+        client_id, newest first. Uses the indexes of the store when there is one.
+        """
+        if self.store is not None:
+            return dict(self.store.query_history(since=since, until=until, status=status, client_id=client_id, max_items=max_items, summary=summary))
+
+        with self.mutex:
+            out = {}
+            matches = []
+            for prompt_id, (sequence, entry, entry_summary, _) in self.history.entries.items():
+                end_time = entry_summary["end_time"]
+                if since is not None and (end_time is None or end_time < since):
+                    continue
+                if until is not None and (end_time is None or end_time >= until):
+                    continue
+                if status is not None and entry_summary["status"] != status:
+                    continue
+                if client_id is not None and entry_summary.get("client_id", None) != client_id:
+                    continue
+                matches.append((end_time or 0, sequence, prompt_id))
+            matches.sort(reverse=True)
+            if max_items is not None:
+                matches = matches[:max_items]
+            for _, _, prompt_id in matches:
+                out[prompt_id] = self.history.get(prompt_id, summary)
+            return out
+
     def wipe_history(self):
         with self.mutex:
-            self.history = {}
+            self.history.clear()
+            if self.store is not None:
+                self.store.clear_history()
 
     def delete_history_item(self, id_to_delete):
         with self.mutex:
-            self.history.pop(id_to_delete, None)
+            self.history.remove(id_to_delete)
+            if self.store is not None:
+                self.store.remove_history(id_to_delete)
 
     def set_flag(self, name, data):
         with self.mutex:
             self.flags[name] = data
-            self.not_empty.notify()
+            # Every worker has to see flags like free_memory, not just the first one to wake up
+            for worker in self.workers.values():
+                worker["flags"][name] = data
+            self.not_empty.notify_all()
 
-    def get_flags(self, reset=True):
+    def get_flags(self, reset=True, worker_id=None):
         with self.mutex:
+            if worker_id is not None:
+                worker = self.workers[worker_id]
+                ret = worker["flags"]
+                if reset:
+                    worker["flags"] = {}
+                    self.flags = {}
+                    return ret
+                return ret.copy()
             if reset:
                 ret = self.flags
                 self.flags = {}
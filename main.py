@@ -136,10 +136,13 @@ import comfy.utils
 
 import execution
 import server
+from comfy_execution.scheduling import QueueScheduler
+from comfy_execution.microbatch import MicroBatch, MicroBatchServer
 from server import BinaryEventTypes
 import nodes
 import comfy.model_management
 import comfyui_version
+import torch
 import app.logger
 
 
@@ -155,15 +158,55 @@ def cuda_malloc_warning():
             logging.warning("\nWARNING: this card most likely does not support cuda-malloc, if you get \"CUDA error\" please run ComfyUI with: --disable-cuda-malloc\n")
 
 
-def prompt_worker(q, server_instance):
+class WorkerServer:
+    """
+    Per worker view of the PromptServer: when several workers execute prompts at the same time each
+    of them needs its own client, prompt and node ids. Writes go through to the real server so
+    websocket reconnects still see the most recent state.
+    """
+    def __init__(self, server_instance):
+        self.server = server_instance
+        self.client_id = None
+        self.last_node_id = None
+        self.last_prompt_id = None
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in ("client_id", "last_node_id", "last_prompt_id"):
+            setattr(self.server, name, value)
+
+    def __getattr__(self, name):
+        return getattr(self.server, name)
+
+
+worker_context = execution.worker_context
+
+
+def prompt_worker(q, server_instance, worker_id=None, device=None):
+    if device is not None:
+        comfy.model_management.set_thread_torch_device(device)
+    worker_context.server = server_instance
+
     current_time: float = 0.0
     cache_type = execution.CacheType.CLASSIC
+    cache_size = None
     if args.cache_lru > 0:
         cache_type = execution.CacheType.LRU
+        cache_size = args.cache_lru
+    elif args.cache_ram_gb > 0:
+        cache_type = execution.CacheType.RAM_BUDGET
+        cache_size = args.cache_ram_gb
     elif args.cache_none:
         cache_type = execution.CacheType.DEPENDENCY_AWARE
 
-    e = execution.PromptExecutor(server_instance, cache_type=cache_type, cache_size=args.cache_lru)
+    disk_cache = None
+    if args.disk_cache_directory is not None:
+        from comfy_execution.disk_cache import DiskCache
+        disk_cache = DiskCache(args.disk_cache_directory, max_bytes=int(args.disk_cache_size_gb * (1024 ** 3)))
+
+    e = execution.PromptExecutor(server_instance, cache_type=cache_type, cache_size=cache_size, disk_cache=disk_cache, max_workers=args.execution_threads)
+    if q.prefetcher is not None:
+        q.prefetcher.add_cache_check(e.is_output_cached)
     last_gc_collect = 0
     need_gc = False
     gc_collect_interval = 10.0
@@ -173,33 +216,58 @@ def prompt_worker(q, server_instance):
         if need_gc:
             timeout = max(gc_collect_interval - (current_time - last_gc_collect), 0.0)
 
-        queue_item = q.get(timeout=timeout)
+        queue_item = q.get(timeout=timeout, worker_id=worker_id)
         if queue_item is not None:
             item, item_id = queue_item
             execution_start_time = time.perf_counter()
             prompt_id = item[1]
             server_instance.last_prompt_id = prompt_id
 
-            e.execute(item[2], prompt_id, item[3], item[4])
+            batch_items = []
+            if args.microbatch_prompts > 1:
+                batch_items = q.get_microbatch(item, args.microbatch_prompts - 1, timeout=args.microbatch_window / 1000.0, worker_id=worker_id)
+
+            if len(batch_items) > 0:
+                batch_items.insert(0, queue_item)
+                batch = MicroBatch([i for i, _ in batch_items])
+                worker_context.server = MicroBatchServer(server_instance, batch)
+                try:
+                    batch_results = e.execute_microbatch(batch)
+                finally:
+                    worker_context.server = server_instance
+                results = [(i[1], i_id, i[3].get("client_id", None)) + r for (i, i_id), r in zip(batch_items, batch_results)]
+            else:
+                e.execute(item[2], prompt_id, item[3], item[4])
+                results = [(prompt_id, item_id, server_instance.client_id, e.history_result, e.status_messages, e.success)]
             need_gc = True
-            q.task_done(item_id,
-                        e.history_result,
-                        status=execution.PromptQueue.ExecutionStatus(
-                            status_str='success' if e.success else 'error',
-                            completed=e.success,
-                            messages=e.status_messages))
-            if server_instance.client_id is not None:
-                server_instance.send_sync("executing", {"node": None, "prompt_id": prompt_id}, server_instance.client_id)
+            for result_prompt_id, result_item_id, client_id, history_result, status_messages, success in results:
+                q.task_done(result_item_id,
+                            history_result,
+                            status=execution.PromptQueue.ExecutionStatus(
+                                status_str='success' if success else 'error',
+                                completed=success,
+                                messages=status_messages))
+                if client_id is not None:
+                    server_instance.send_sync("executing", {"node": None, "prompt_id": result_prompt_id}, client_id)
 
             current_time = time.perf_counter()
             execution_time = current_time - execution_start_time
-            logging.info("Prompt executed in {:.2f} seconds".format(execution_time))
+            if len(results) > 1:
+                logging.info("{} prompts executed in a micro-batch in {:.2f} seconds".format(len(results), execution_time))
+            else:
+                logging.info("Prompt executed in {:.2f} seconds".format(execution_time))
 
-        flags = q.get_flags()
+        flags = q.get_flags(worker_id=worker_id)
         free_memory = flags.get("free_memory", False)
 
         if flags.get("unload_models", free_memory):
-            comfy.model_management.unload_all_models()
+            if worker_id is None:
+                comfy.model_management.unload_all_models()
+            elif q.device_busy(worker_id):
+                comfy.model_management.unload_unused_models(device)
+            else:
+                # Every worker gets the flag, each one only unloads its own device
+                comfy.model_management.free_memory(1e30, device)
             need_gc = True
             last_gc_collect = 0
 
@@ -226,9 +294,10 @@ async def run(server_instance, address='', port=8188, verbose=True, call_on_star
     )
 
 
-def hijack_progress(server_instance):
+def hijack_progress(default_server):
     def hook(value, total, preview_image):
         comfy.model_management.throw_exception_if_processing_interrupted()
+        server_instance = getattr(worker_context, "server", default_server)
         progress = {"value": value, "max": total, "prompt_id": server_instance.last_prompt_id, "node": server_instance.last_node_id}
 
         server_instance.send_sync("progress", progress, server_instance.client_id)
@@ -266,7 +335,26 @@ def start_comfyui(asyncio_loop=None):
         asyncio_loop = asyncio.new_event_loop()
         asyncio.set_event_loop(asyncio_loop)
     prompt_server = server.PromptServer(asyncio_loop)
-    q = execution.PromptQueue(prompt_server)
+    max_history_bytes = None
+    if args.history_max_mb is not None:
+        max_history_bytes = int(args.history_max_mb * (1024 ** 2))
+    queue_store = None
+    if args.persist_queue:
+        from comfy_execution.queue_store import SQLiteQueueStore
+        queue_database = args.queue_database
+        if queue_database is None:
+            queue_database = os.path.join(folder_paths.get_user_directory(), "queue.db")
+        os.makedirs(os.path.dirname(os.path.abspath(queue_database)), exist_ok=True)
+        queue_store = SQLiteQueueStore(queue_database, max_history_items=args.history_max_items)
+    scheduler = QueueScheduler(fair_share=args.queue_fair_share, max_in_flight=args.max_in_flight_per_client, model_affinity_window=args.queue_model_affinity)
+    prefetcher = None
+    if args.prefetch_models_gb > 0:
+        from comfy_execution.prefetch import ModelPrefetcher
+        pin_memory = comfy.model_management.get_torch_device().type == "cuda"
+        prefetcher = ModelPrefetcher(int(args.prefetch_models_gb * (1024 ** 3)), lookahead=args.prefetch_lookahead, pin_memory=pin_memory)
+        comfy.utils.set_load_torch_file_hook(prefetcher.take)
+        prefetcher.start()
+    q = execution.PromptQueue(prompt_server, max_history_items=args.history_max_items, max_history_bytes=max_history_bytes, store=queue_store, scheduler=scheduler, prefetcher=prefetcher)
 
     nodes.init_extra_nodes(init_custom_nodes=not args.disable_all_custom_nodes)
 
@@ -275,7 +363,15 @@ def start_comfyui(asyncio_loop=None):
     prompt_server.add_routes()
     hijack_progress(prompt_server)
 
-    threading.Thread(target=prompt_worker, daemon=True, args=(q, prompt_server,)).start()
+    if args.worker_devices:
+        device_type = comfy.model_management.get_torch_device().type
+        for worker_id, device_index in enumerate(args.worker_devices):
+            device = torch.device(device_type, device_index)
+            q.register_worker(worker_id, device)
+            logging.info("Starting prompt worker {} on {}".format(worker_id, device))
+            threading.Thread(target=prompt_worker, daemon=True, args=(q, WorkerServer(prompt_server), worker_id, device)).start()
+    else:
+        threading.Thread(target=prompt_worker, daemon=True, args=(q, prompt_server,)).start()
 
     if args.quick_test_for_ci:
         exit(0)
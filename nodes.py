@@ -51,6 +51,7 @@ class CLIPTextEncode:
         return {"required": {"text": ("STRING", {"multiline": True, "dynamicPrompts": True}), "clip": ("CLIP", )}}
     RETURN_TYPES = ("CONDITIONING",)
     FUNCTION = "encode"
+    DISK_CACHEABLE = True
 
     CATEGORY = "conditioning"
 
@@ -65,6 +66,7 @@ class ConditioningCombine:
         return {"required": {"conditioning_1": ("CONDITIONING", ), "conditioning_2": ("CONDITIONING", )}}
     RETURN_TYPES = ("CONDITIONING",)
     FUNCTION = "combine"
+    EXECUTION_RESOURCE = "cpu"
 
     CATEGORY = "conditioning"
 
@@ -118,6 +120,7 @@ class ConditioningConcat:
             }}
     RETURN_TYPES = ("CONDITIONING",)
     FUNCTION = "concat"
+    EXECUTION_RESOURCE = "cpu"
 
     CATEGORY = "conditioning"
 
@@ -288,6 +291,7 @@ class VAEEncode:
         return {"required": { "pixels": ("IMAGE", ), "vae": ("VAE", )}}
     RETURN_TYPES = ("LATENT",)
     FUNCTION = "encode"
+    DISK_CACHEABLE = True
 
     CATEGORY = "latent"
 
@@ -316,6 +320,7 @@ class VAEEncodeForInpaint:
         return {"required": { "pixels": ("IMAGE", ), "vae": ("VAE", ), "mask": ("MASK", ), "grow_mask_by": ("INT", {"default": 6, "min": 0, "max": 64, "step": 1}),}}
     RETURN_TYPES = ("LATENT",)
     FUNCTION = "encode"
+    DISK_CACHEABLE = True
 
     CATEGORY = "latent/inpaint"
 
@@ -462,6 +467,7 @@ class LoadLatent:
 
     RETURN_TYPES = ("LATENT", )
     FUNCTION = "load"
+    EXECUTION_RESOURCE = "io"
 
     def load(self, latent):
         latent_path = folder_paths.get_annotated_filepath(latent)
@@ -589,6 +595,7 @@ class LoraLoader:
                               }}
     RETURN_TYPES = ("MODEL", "CLIP")
     FUNCTION = "load_lora"
+    EXECUTION_RESOURCE = "io"
 
     CATEGORY = "loaders"
 
@@ -1003,6 +1010,7 @@ class EmptyLatentImage:
                               "batch_size": ("INT", {"default": 1, "min": 1, "max": 4096})}}
     RETURN_TYPES = ("LATENT",)
     FUNCTION = "generate"
+    EXECUTION_RESOURCE = "cpu"
 
     CATEGORY = "latent"
 
@@ -1319,6 +1327,57 @@ def common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive,
     out["samples"] = samples
     return (out, )
 
+# Samplers that add noise at every step from the single seed of the batch, batching jobs would change their results
+STOCHASTIC_SAMPLER_NAMES = ("ancestral", "sde", "ddpm", "lcm", "seeds_")
+
+def _can_sample_together(jobs):
+    first = jobs[0]
+    if any(s in first["sampler_name"] for s in STOCHASTIC_SAMPLER_NAMES):
+        return False
+    for job in jobs:
+        if job["model"] is not first["model"] or set(job["latent"].keys()) != {"samples"}:
+            return False
+        if job["latent"]["samples"].shape[1:] != first["latent"]["samples"].shape[1:] or job["latent"]["samples"].dtype != first["latent"]["samples"].dtype:
+            return False
+        for k in ("steps", "cfg", "sampler_name", "scheduler", "denoise", "disable_noise", "start_step", "last_step", "force_full_denoise"):
+            if job.get(k, None) != first.get(k, None):
+                return False
+    return True
+
+def common_ksampler_batched(jobs):
+    """
+    common_ksampler for a list of jobs (dicts of its arguments) that only differ in their seed,
+    conditioning and latent, sampled as one batch when they line up. Each job keeps the noise of its
+    own seed. Returns the outputs of every job.
+    """
+    positive = negative = None
+    if len(jobs) > 1 and _can_sample_together(jobs):
+        batch_sizes = [job["latent"]["samples"].shape[0] for job in jobs]
+        positive = comfy.sample.batch_conditioning([job["positive"] for job in jobs], batch_sizes)
+        negative = comfy.sample.batch_conditioning([job["negative"] for job in jobs], batch_sizes)
+    if positive is None or negative is None:
+        return [common_ksampler(**job) for job in jobs]
+
+    first = jobs[0]
+    disable_noise = first.get("disable_noise", False)
+    latent_image = torch.cat([job["latent"]["samples"] for job in jobs])
+    if disable_noise:
+        noise = torch.zeros(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, device="cpu")
+    else:
+        noise = torch.cat([comfy.sample.prepare_noise(job["latent"]["samples"], job["seed"]) for job in jobs])
+
+    callback = latent_preview.prepare_callback(first["model"], first["steps"])
+    disable_pbar = not comfy.utils.PROGRESS_BAR_ENABLED
+    samples = comfy.sample.sample(first["model"], noise, first["steps"], first["cfg"], first["sampler_name"], first["scheduler"], positive, negative, latent_image,
+                                  denoise=first.get("denoise", 1.0), disable_noise=disable_noise, start_step=first.get("start_step", None), last_step=first.get("last_step", None),
+                                  force_full_denoise=first.get("force_full_denoise", False), callback=callback, disable_pbar=disable_pbar, seed=first["seed"])
+    out = []
+    for job, job_samples in zip(jobs, torch.split(samples, batch_sizes)):
+        latent = job["latent"].copy()
+        latent["samples"] = job_samples
+        out.append((latent, ))
+    return out
+
 class KSampler:
     @classmethod
     def INPUT_TYPES(s):
@@ -1338,12 +1397,17 @@ class KSampler:
 
     RETURN_TYPES = ("LATENT",)
     FUNCTION = "sample"
+    MICROBATCH_FUNCTION = "sample_batched"
 
     CATEGORY = "sampling"
 
     def sample(self, model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=1.0):
         return common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise)
 
+    def sample_batched(self, jobs):
+        return common_ksampler_batched([dict(model=j["model"], seed=j["seed"], steps=j["steps"], cfg=j["cfg"], sampler_name=j["sampler_name"], scheduler=j["scheduler"],
+                                             positive=j["positive"], negative=j["negative"], latent=j["latent_image"], denoise=j.get("denoise", 1.0)) for j in jobs])
+
 class KSamplerAdvanced:
     @classmethod
     def INPUT_TYPES(s):
@@ -1366,17 +1430,26 @@ class KSamplerAdvanced:
 
     RETURN_TYPES = ("LATENT",)
     FUNCTION = "sample"
+    MICROBATCH_FUNCTION = "sample_batched"
 
     CATEGORY = "sampling"
 
-    def sample(self, model, add_noise, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, start_at_step, end_at_step, return_with_leftover_noise, denoise=1.0):
+    @staticmethod
+    def ksampler_args(model, add_noise, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, start_at_step, end_at_step, return_with_leftover_noise, denoise=1.0):
         force_full_denoise = True
         if return_with_leftover_noise == "enable":
             force_full_denoise = False
         disable_noise = False
         if add_noise == "disable":
             disable_noise = True
-        return common_ksampler(model, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise, disable_noise=disable_noise, start_step=start_at_step, last_step=end_at_step, force_full_denoise=force_full_denoise)
+        return dict(model=model, seed=noise_seed, steps=steps, cfg=cfg, sampler_name=sampler_name, scheduler=scheduler, positive=positive, negative=negative, latent=latent_image,
+                    denoise=denoise, disable_noise=disable_noise, start_step=start_at_step, last_step=end_at_step, force_full_denoise=force_full_denoise)
+
+    def sample(self, model, add_noise, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, start_at_step, end_at_step, return_with_leftover_noise, denoise=1.0):
+        return common_ksampler(**self.ksampler_args(model, add_noise, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, start_at_step, end_at_step, return_with_leftover_noise, denoise=denoise))
+
+    def sample_batched(self, jobs):
+        return common_ksampler_batched([self.ksampler_args(**j) for j in jobs])
 
 class SaveImage:
     def __init__(self):
@@ -1460,6 +1533,7 @@ class LoadImage:
 
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "load_image"
+    EXECUTION_RESOURCE = "io"
     def load_image(self, image):
         image_path = folder_paths.get_annotated_filepath(image)
         
@@ -1534,6 +1608,7 @@ class LoadImageMask:
 
     RETURN_TYPES = ("MASK",)
     FUNCTION = "load_image"
+    EXECUTION_RESOURCE = "io"
     def load_image(self, image, channel):
         image_path = folder_paths.get_annotated_filepath(image)
         i = node_helpers.pillow(Image.open, image_path)
@@ -1580,6 +1655,7 @@ class ImageScale:
                               "crop": (s.crop_methods,)}}
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "upscale"
+    EXECUTION_RESOURCE = "cpu"
 
     CATEGORY = "image/upscaling"
 
@@ -1607,6 +1683,7 @@ class ImageScaleBy:
                               "scale_by": ("FLOAT", {"default": 1.0, "min": 0.01, "max": 8.0, "step": 0.01}),}}
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "upscale"
+    EXECUTION_RESOURCE = "cpu"
 
     CATEGORY = "image/upscaling"
 
@@ -1626,6 +1703,7 @@ class ImageInvert:
 
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "invert"
+    EXECUTION_RESOURCE = "cpu"
 
     CATEGORY = "image"
 
@@ -1641,6 +1719,7 @@ class ImageBatch:
 
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "batch"
+    EXECUTION_RESOURCE = "cpu"
 
     CATEGORY = "image"
 
@@ -1689,6 +1768,7 @@ class ImagePadForOutpaint:
 
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "expand_image"
+    EXECUTION_RESOURCE = "cpu"
 
     CATEGORY = "image"
 
@@ -26,6 +26,9 @@ import mimetypes
 from comfy.cli_args import args
 import comfy.utils
 import comfy.model_management
+import comfy.host_tier
+import comfy.conditioning_cache
+import comfy.load_trace
 import node_helpers
 from comfyui_version import __version__
 from app.frontend_management import FrontendManager
@@ -34,6 +37,7 @@ from app.model_manager import ModelFileManager
 from app.custom_node_manager import CustomNodeManager
 from typing import Optional
 from api_server.routes.internal.internal_routes import InternalRoutes
+from comfy_execution.scheduling import PRIORITY_CLASSES, parse_scheduler_options
 
 class BinaryEventTypes:
     PREVIEW_IMAGE = 1
@@ -163,6 +167,7 @@ class PromptServer():
         self.messages = asyncio.Queue()
         self.client_session:Optional[aiohttp.ClientSession] = None
         self.number = 0
+        self.validation_cache = execution.ValidationCache()
 
         middlewares = [cache_control]
         if args.enable_compress_response_body:
@@ -515,13 +520,32 @@ class PromptServer():
 
         @routes.get("/system_stats")
         async def system_stats(request):
-            device = comfy.model_management.get_torch_device()
-            device_name = comfy.model_management.get_torch_device_name(device)
             cpu_device = comfy.model_management.torch.device("cpu")
             ram_total = comfy.model_management.get_total_memory(cpu_device)
             ram_free = comfy.model_management.get_free_memory(cpu_device)
-            vram_total, torch_vram_total = comfy.model_management.get_total_memory(device, torch_total_too=True)
-            vram_free, torch_vram_free = comfy.model_management.get_free_memory(device, torch_free_too=True)
+
+            workers = self.prompt_queue.get_worker_states()
+            if len(workers) > 0:
+                worker_devices = [(w["worker"], comfy.model_management.torch.device(w["device"])) for w in workers]
+            else:
+                worker_devices = [(None, comfy.model_management.get_torch_device())]
+
+            devices = []
+            for worker_id, device in worker_devices:
+                vram_total, torch_vram_total = comfy.model_management.get_total_memory(device, torch_total_too=True)
+                vram_free, torch_vram_free = comfy.model_management.get_free_memory(device, torch_free_too=True)
+                device_stats = {
+                    "name": comfy.model_management.get_torch_device_name(device),
+                    "type": device.type,
+                    "index": device.index,
+                    "vram_total": vram_total,
+                    "vram_free": vram_free,
+                    "torch_vram_total": torch_vram_total,
+                    "torch_vram_free": torch_vram_free,
+                }
+                if worker_id is not None:
+                    device_stats["worker"] = worker_id
+                devices.append(device_stats)
 
             system_stats = {
                 "system": {
@@ -534,18 +558,15 @@ class PromptServer():
                     "embedded_python": os.path.split(os.path.split(sys.executable)[0])[1] == "python_embeded",
                     "argv": sys.argv
                 },
-                "devices": [
-                    {
-                        "name": device_name,
-                        "type": device.type,
-                        "index": device.index,
-                        "vram_total": vram_total,
-                        "vram_free": vram_free,
-                        "torch_vram_total": torch_vram_total,
-                        "torch_vram_free": torch_vram_free,
-                    }
-                ]
+                "devices": devices,
+                "models": comfy.model_management.model_stats_summary(),
             }
+            host_tier = comfy.host_tier.get_tier()
+            if host_tier is not None:
+                system_stats["host_ram_tier"] = host_tier.get_stats()
+            conditioning_cache = comfy.conditioning_cache.get_cache()
+            if conditioning_cache is not None:
+                system_stats["conditioning_cache"] = conditioning_cache.get_stats()
             return web.json_response(system_stats)
 
         @routes.get("/prompt")
@@ -587,6 +608,8 @@ class PromptServer():
 
         @routes.get("/object_info")
         async def get_object_info(request):
+            # The model/file lists might have changed, validate everything again
+            self.validation_cache.clear()
             with folder_paths.cache_helper:
                 out = {}
                 for x in nodes.NODE_CLASS_MAPPINGS:
@@ -610,12 +633,42 @@ class PromptServer():
             max_items = request.rel_url.query.get("max_items", None)
             if max_items is not None:
                 max_items = int(max_items)
-            return web.json_response(self.prompt_queue.get_history(max_items=max_items))
+            summary = request.rel_url.query.get("summary", "false").lower() == "true"
+
+            # Range queries on the end time (ms timestamps), status and client id, newest first
+            filters = {}
+            for key in ("since", "until"):
+                if key in request.rel_url.query:
+                    filters[key] = int(request.rel_url.query[key])
+            for key in ("status", "client_id"):
+                if key in request.rel_url.query:
+                    filters[key] = request.rel_url.query[key]
+            if len(filters) > 0:
+                return web.json_response(self.prompt_queue.query_history(max_items=max_items, summary=summary, **filters))
+
+            # Cursor based pagination, newest first: pass back next_cursor to get the following page
+            if "cursor" in request.rel_url.query:
+                cursor = request.rel_url.query["cursor"]
+                cursor = int(cursor) if cursor != "" else None
+                history, next_cursor = self.prompt_queue.get_history_page(cursor=cursor, max_items=max_items, summary=summary)
+                return web.json_response({"history": history, "next_cursor": next_cursor})
+
+            offset = int(request.rel_url.query.get("offset", -1))
+            return web.json_response(self.prompt_queue.get_history(max_items=max_items, offset=offset, summary=summary))
 
         @routes.get("/history/{prompt_id}")
         async def get_history_prompt_id(request):
             prompt_id = request.match_info.get("prompt_id", None)
-            return web.json_response(self.prompt_queue.get_history(prompt_id=prompt_id))
+            summary = request.rel_url.query.get("summary", "false").lower() == "true"
+            return web.json_response(self.prompt_queue.get_history(prompt_id=prompt_id, summary=summary))
+
+        @routes.get("/history/{prompt_id}/trace")
+        async def get_prompt_trace(request):
+            # Chrome trace event JSON of the model loads of a prompt, opens in chrome://tracing or ui.perfetto.dev
+            trace = comfy.load_trace.get_trace(request.match_info.get("prompt_id", None))
+            if trace is None:
+                return web.Response(status=404)
+            return web.json_response(trace.chrome_trace())
 
         @routes.get("/queue")
         async def get_queue(request):
@@ -623,6 +676,12 @@ class PromptServer():
             current_queue = self.prompt_queue.get_current_queue()
             queue_info['queue_running'] = current_queue[0]
             queue_info['queue_pending'] = current_queue[1]
+            workers = self.prompt_queue.get_worker_states()
+            if len(workers) > 0:
+                queue_info['workers'] = workers
+            queue_info['scheduler'] = self.prompt_queue.get_scheduler_stats()
+            if self.prompt_queue.prefetcher is not None:
+                queue_info['prefetch'] = self.prompt_queue.prefetcher.get_stats()
             return web.json_response(queue_info)
 
         @routes.post("/prompt")
@@ -641,15 +700,48 @@ class PromptServer():
 
                 self.number += 1
 
+            # Only the nodes that changed since an earlier prompt, see execution.apply_prompt_delta
+            if "prompt_delta" in json_data:
+                base_prompt_id = json_data.get("base_prompt_id", None)
+                base_prompt = self.prompt_queue.get_prompt(base_prompt_id)
+                if base_prompt is None:
+                    error = {
+                        "type": "base_prompt_not_found",
+                        "message": "Base prompt not found",
+                        "details": f"No queued or finished prompt with id {base_prompt_id}",
+                        "extra_info": {}
+                    }
+                    return web.json_response({"error": error, "node_errors": {}}, status=400)
+                try:
+                    json_data["prompt"] = execution.apply_prompt_delta(base_prompt, json_data["prompt_delta"])
+                except ValueError as e:
+                    error = {
+                        "type": "invalid_prompt_delta",
+                        "message": "Invalid prompt delta",
+                        "details": str(e),
+                        "extra_info": {}
+                    }
+                    return web.json_response({"error": error, "node_errors": {}}, status=400)
+
             if "prompt" in json_data:
                 prompt = json_data["prompt"]
-                valid = execution.validate_prompt(prompt)
+                valid = execution.validate_prompt(prompt, self.validation_cache)
                 extra_data = {}
                 if "extra_data" in json_data:
                     extra_data = json_data["extra_data"]
 
                 if "client_id" in json_data:
                     extra_data["client_id"] = json_data["client_id"]
+                if "priority" in json_data:
+                    if json_data["priority"] not in PRIORITY_CLASSES:
+                        error = {
+                            "type": "invalid_priority",
+                            "message": "Invalid priority",
+                            "details": "priority must be one of: {}".format(", ".join(PRIORITY_CLASSES)),
+                            "extra_info": {}
+                        }
+                        return web.json_response({"error": error, "node_errors": {}}, status=400)
+                    extra_data["priority"] = json_data["priority"]
                 if valid[0]:
                     prompt_id = str(uuid.uuid4())
                     outputs_to_execute = valid[2]
@@ -671,6 +763,18 @@ class PromptServer():
         @routes.post("/queue")
         async def post_queue(request):
             json_data =  await request.json()
+            # Validated before anything is applied, a rejected request leaves the queue as it was
+            options = None
+            if "scheduler" in json_data:
+                options, invalid = parse_scheduler_options(json_data["scheduler"])
+                if len(invalid) > 0:
+                    error = {
+                        "type": "invalid_scheduler_options",
+                        "message": "Invalid scheduler options",
+                        "details": "fair_share must be a boolean, max_in_flight_per_client and model_affinity_window non negative integers: {}".format(", ".join(invalid)),
+                        "extra_info": {"invalid": invalid}
+                    }
+                    return web.json_response({"error": error}, status=400)
             if "clear" in json_data:
                 if json_data["clear"]:
                     self.prompt_queue.wipe_queue()
@@ -679,12 +783,23 @@ class PromptServer():
                 for id_to_delete in to_delete:
                     delete_func = lambda a: a[1] == id_to_delete
                     self.prompt_queue.delete_queue_item(delete_func)
+            if options is not None:
+                self.prompt_queue.set_scheduler_options(**options)
 
             return web.Response(status=200)
 
         @routes.post("/interrupt")
         async def post_interrupt(request):
-            nodes.interrupt_processing()
+            try:
+                json_data = await request.json()
+            except json.JSONDecodeError:
+                json_data = {}
+            # Only the given prompt, or every running one: with several workers a global flag would
+            # be taken by whichever worker checks it first
+            prompt_id = json_data.get("prompt_id", None) if isinstance(json_data, dict) else None
+            for running_id in self.prompt_queue.get_running_prompt_ids():
+                if prompt_id is None or running_id == prompt_id:
+                    comfy.model_management.interrupt_prompt(running_id)
             return web.Response(status=200)
 
         @routes.post("/free")
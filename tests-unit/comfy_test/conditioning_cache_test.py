@@ -0,0 +1,102 @@
+import pytest
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.conditioning_cache  # noqa: E402
+import comfy.model_patcher  # noqa: E402
+import comfy.sd  # noqa: E402
+
+
+class FakeTextEncoder(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.scale = torch.nn.Parameter(torch.ones(1))
+        self.calls = 0
+        self.options = {}
+
+    def reset_clip_options(self):
+        self.options = {}
+
+    def set_clip_options(self, options):
+        self.options.update(options)
+
+    def encode_token_weights(self, tokens):
+        self.calls += 1
+        ids = torch.tensor([[t[0] for t in batch] for batch in tokens["l"]], dtype=torch.float32)
+        cond = ids.unsqueeze(-1) * self.scale * (2.0 if self.options.get("layer", None) == -2 else 1.0)
+        return cond, cond.mean(dim=1)
+
+
+def make_clip():
+    clip = comfy.sd.CLIP(no_init=True)
+    clip.cond_stage_model = FakeTextEncoder()
+    clip.patcher = comfy.model_patcher.ModelPatcher(clip.cond_stage_model, torch.device("cpu"), torch.device("cpu"))
+    clip.tokenizer = None
+    clip.layer_idx = None
+    clip.use_clip_schedule = False
+    clip.apply_hooks_to_conds = None
+    return clip
+
+
+def tokens(*ids):
+    return {"l": [[(i, 1.0) for i in ids]]}
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = comfy.conditioning_cache.ConditioningCache(1024 ** 2)
+    monkeypatch.setattr(comfy.conditioning_cache, "get_cache", lambda: cache)
+    return cache
+
+
+def test_repeated_prompts_are_cached(cache):
+    clip = make_clip()
+    cond, pooled = clip.encode_from_tokens(tokens(1, 2, 3), return_pooled=True)
+    again, pooled_again = clip.encode_from_tokens(tokens(1, 2, 3), return_pooled=True)
+    assert clip.cond_stage_model.calls == 1
+    assert torch.equal(cond, again) and torch.equal(pooled, pooled_again)
+    assert cache.get_stats()["hits"] == 1
+
+    # A clone shares the model and so the cache entries
+    clip.clone().encode_from_tokens(tokens(1, 2, 3))
+    assert clip.cond_stage_model.calls == 1
+
+    clip.encode_from_tokens(tokens(1, 2, 4))
+    assert clip.cond_stage_model.calls == 2
+    weighted = {"l": [[(1, 1.2), (2, 1.0), (3, 1.0)]]}
+    clip.encode_from_tokens(weighted)
+    assert clip.cond_stage_model.calls == 3
+
+
+def test_options_and_patches_are_part_of_the_key(cache):
+    clip = make_clip()
+    clip.encode_from_tokens(tokens(1, 2))
+    skipped = clip.clone()
+    skipped.clip_layer(-2)
+    assert torch.equal(skipped.encode_from_tokens(tokens(1, 2)), clip.encode_from_tokens(tokens(1, 2)) * 2)
+    assert clip.cond_stage_model.calls == 2
+
+    patched = clip.clone()
+    patched.add_patches({"scale": (torch.ones(1),)}, 1.0)
+    patched.encode_from_tokens(tokens(1, 2))
+    assert clip.cond_stage_model.calls == 3
+
+
+def test_lru_bound():
+    cache = comfy.conditioning_cache.ConditioningCache(3 * 64 * 4)
+    for i in range(5):
+        cache.set(bytes([i]), (torch.zeros(64), None))
+    assert cache.total_bytes <= 3 * 64 * 4
+    assert cache.get(bytes([0])) is None
+    assert cache.get(bytes([4])) is not None
+    assert cache.get_stats()["hit_rate"] == 0.5
+
+
+def test_embedding_tokens_are_hashed():
+    model = torch.nn.Linear(1, 1)
+    key = comfy.conditioning_cache.conditioning_key(model, None, {}, {"l": [[(torch.ones(4), 1.0)]]})
+    assert key == comfy.conditioning_cache.conditioning_key(model, None, {}, {"l": [[(torch.ones(4), 1.0)]]})
+    assert key != comfy.conditioning_cache.conditioning_key(model, None, {}, {"l": [[(torch.zeros(4), 1.0)]]})
+    assert comfy.conditioning_cache.conditioning_key(model, None, {}, {"l": [[(object(), 1.0)]]}) is None
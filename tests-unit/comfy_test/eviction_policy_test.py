@@ -0,0 +1,96 @@
+import threading
+import time
+
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.model_management  # noqa: E402
+import comfy.model_patcher  # noqa: E402
+
+
+class FakeLoadedModel:
+    def __init__(self, size, load_time, uses):
+        self.model = torch.nn.Linear(1, 1)
+        self.size = size
+        stats = comfy.model_management.get_model_stats(self.model)
+        stats.load_time = load_time
+        stats.loaded_bytes = size
+        now = time.time()
+        for _ in range(uses):
+            stats.used(now, comfy.model_management.USE_HALF_LIFE)
+
+    def model_memory(self):
+        return self.size
+
+    def model_loaded_memory(self):
+        return self.size
+
+    def model_offloaded_memory(self):
+        return 0
+
+
+def unload_order(policy, models):
+    return sorted(models, key=policy.sort_key)
+
+
+def test_cost_aware_keeps_expensive_models():
+    gb = 1024 ** 3
+    video = FakeLoadedModel(20 * gb, 60.0, uses=3)
+    vae = FakeLoadedModel(gb // 3, 0.2, uses=3)
+    rarely_used = FakeLoadedModel(20 * gb, 60.0, uses=1)
+    order = unload_order(comfy.model_management.CostAwareEvictionPolicy(), [video, vae, rarely_used])
+    assert order == [vae, rarely_used, video]
+
+
+def test_usage_decays():
+    stats = comfy.model_management.ModelStats("test")
+    stats.used(0.0, 10.0)
+    stats.used(0.0, 10.0)
+    assert stats.frequency(0.0, 10.0) == 2.0
+    assert stats.frequency(10.0, 10.0) == 1.0
+
+
+def test_load_stats_recorded():
+    model = torch.nn.Sequential(torch.nn.Linear(64, 64), torch.nn.Linear(64, 64))
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    comfy.model_management.load_models_gpu([patcher])
+    comfy.model_management.load_models_gpu([patcher])
+    stats = comfy.model_management.get_model_stats(patcher)
+    assert stats.hits + stats.misses == 2
+    assert stats.last_used is not None
+    summary = [s for s in comfy.model_management.model_stats_summary() if s["name"] == "Sequential"]
+    assert len(summary) == 1 and summary[0]["loaded"]
+    comfy.model_management.unload_all_models()
+
+
+def test_summary_does_not_wait_for_loads():
+    held = threading.Event()
+    release = threading.Event()
+
+    def load():
+        with comfy.model_management.model_management_lock:
+            held.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=load)
+    thread.start()
+    held.wait(5)
+    try:
+        assert isinstance(comfy.model_management.model_stats_summary(), list)
+    finally:
+        release.set()
+        thread.join()
+
+
+def test_unload_unused_models_keeps_used_ones():
+    patchers = [comfy.model_patcher.ModelPatcher(torch.nn.Linear(16, 16), torch.device("cpu"), torch.device("cpu")) for _ in range(2)]
+    comfy.model_management.load_models_gpu(patchers)
+    for loaded in comfy.model_management.current_loaded_models:
+        loaded.currently_used = loaded.model is patchers[1]
+    comfy.model_management.unload_unused_models(torch.device("cpu"))
+    loaded = [m.model for m in comfy.model_management.current_loaded_models]
+    assert patchers[1] in loaded and patchers[0] not in loaded
+    comfy.model_management.unload_all_models()
+    assert len(comfy.model_management.current_loaded_models) == 0
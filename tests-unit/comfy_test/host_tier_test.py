@@ -0,0 +1,109 @@
+import pytest
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.host_tier  # noqa: E402
+import comfy.model_patcher  # noqa: E402
+from comfy.weight_adapter import LoRAAdapter  # noqa: E402
+
+
+def make_model():
+    return torch.nn.Sequential(torch.nn.Linear(32, 32), torch.nn.Linear(32, 32))
+
+
+MODEL_BYTES = 2 * (32 * 32 + 32) * 4
+
+
+def test_least_recently_unloaded_released():
+    tier = comfy.host_tier.HostTier(int(MODEL_BYTES * 1.5))
+    a, b = make_model(), make_model()
+    tier.offload_module(a)
+    assert tier.total_bytes == MODEL_BYTES
+    tier.offload_module(b)
+    assert tier.get_stats()["models"] == 1
+    assert tier.total_bytes == MODEL_BYTES
+    # Unloading a again makes it the most recent one
+    tier.offload_module(a)
+    assert list(tier.owners.keys()) == [id(a)]
+
+
+def test_dead_models_not_counted():
+    tier = comfy.host_tier.HostTier(MODEL_BYTES * 4)
+    model = make_model()
+    tier.offload_module(model)
+    del model
+    assert tier.total_bytes == 0
+
+
+def test_running_total(monkeypatch):
+    tier = comfy.host_tier.HostTier(MODEL_BYTES * 4)
+    others = [make_model() for _ in range(3)]
+    for other in others:
+        tier.offload_module(other)
+    model = make_model()
+    walked = []
+    owner_bytes = tier.owner_bytes
+    monkeypatch.setattr(tier, "owner_bytes", lambda owner: walked.append(owner) or owner_bytes(owner))
+    # Like partially_unload: one call per module of the same model
+    for module in model:
+        tier.offload_module(module, owner=model)
+    assert walked == [model]
+    assert tier.total_bytes == MODEL_BYTES * 4
+    tier.load_modules([model[0]], torch.device("meta"), owner=model)
+    assert tier.total_bytes == MODEL_BYTES * 4 - MODEL_BYTES // 2
+
+
+@pytest.mark.skipif(torch.cuda.is_available(), reason="pinned memory allocation fails without a cuda device")
+def test_pinned_allocation_failure_falls_back():
+    tier = comfy.host_tier.HostTier(MODEL_BYTES * 4, pin_memory=True)
+    model = make_model()
+    weight = model[0].weight.detach().clone()
+    tier.offload_module(model)
+    assert torch.equal(model[0].weight, weight)
+    assert tier.total_bytes == 0
+
+
+def test_model_patcher_through_tier(monkeypatch):
+    tier = comfy.host_tier.HostTier(MODEL_BYTES * 4)
+    monkeypatch.setattr(comfy.host_tier, "get_tier", lambda: tier)
+    model = make_model()
+    original = {k: v.clone() for k, v in model.state_dict().items()}
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    patcher.add_patches({"0.weight": LoRAAdapter(set(), (torch.ones(32, 1), torch.ones(1, 32), None, None, None, None))}, 1.0)
+
+    patcher.patch_model()
+    assert torch.equal(model[0].weight, original["0.weight"] + 1)
+    patcher.unpatch_model(torch.device("cpu"))
+    for k, v in model.state_dict().items():
+        assert torch.equal(v, original[k])
+    assert id(model) in tier.owners
+    assert tier.total_bytes == MODEL_BYTES
+
+    patcher.patch_model()
+    patcher.partially_unload(torch.device("cpu"), memory_to_free=MODEL_BYTES)
+    assert torch.equal(model[1].weight, original["1.weight"])
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs cuda")
+def test_async_load():
+    tier = comfy.host_tier.HostTier(MODEL_BYTES * 4, pin_memory=True)
+    model = make_model().cuda()
+    x = torch.randn(4, 32, device="cuda")
+    expected = model(x)
+    tier.offload_module(model)
+    assert model[0].weight.is_pinned()
+    tier.load_modules([model[0], model[1]], torch.device("cuda"))
+    assert torch.equal(model(x), expected)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs cuda")
+def test_weights_complete_after_load():
+    tier = comfy.host_tier.HostTier(1024 ** 3, pin_memory=True)
+    model = torch.nn.Sequential(*[torch.nn.Linear(2048, 2048) for _ in range(8)]).cuda()
+    expected = model[-1].weight.detach().clone()
+    tier.offload_module(model)
+    tier.load_modules(list(model), torch.device("cuda"))
+    # Read directly, not through a forward of the module
+    assert torch.equal(model[-1].weight + 0, expected)
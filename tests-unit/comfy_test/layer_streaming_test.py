@@ -0,0 +1,80 @@
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.model_patcher  # noqa: E402
+import comfy.ops  # noqa: E402
+from comfy.weight_adapter import LoRAAdapter  # noqa: E402
+
+ops = comfy.ops.disable_weight_init
+
+
+class Blocks(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.layers = torch.nn.ModuleList([ops.Linear(16, 16) for _ in range(4)])
+        for layer in self.layers:
+            torch.nn.init.normal_(layer.weight)
+            torch.nn.init.normal_(layer.bias)
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = torch.tanh(layer(x))
+        return x
+
+
+def make_patcher():
+    torch.manual_seed(0)
+    patcher = comfy.model_patcher.ModelPatcher(Blocks(), torch.device("cpu"), torch.device("cpu"))
+    generator = torch.Generator().manual_seed(1)
+    patcher.add_patches({"layers.1.weight": LoRAAdapter(set(), (torch.randn(16, 2, generator=generator), torch.randn(2, 16, generator=generator), None, None, None, None))}, 1.0)
+    return patcher
+
+
+def run(patcher, x, steps=3):
+    # Tiny budget: every layer is lowvram and casts its weights (with its LoRA) on the fly
+    patcher.patch_model(device_to=torch.device("cpu"), lowvram_model_memory=1)
+    outputs = [patcher.model(x) for _ in range(steps)]
+    streamers = set(layer.comfy_layer_streamer for layer in patcher.model.layers)
+    patcher.unpatch_model(torch.device("cpu"))
+    return outputs, streamers
+
+
+def test_streamed_matches_regular(monkeypatch):
+    x = torch.randn(3, 16)
+    expected, streamers = run(make_patcher(), x)
+    assert streamers == {None}
+
+    monkeypatch.setattr(args, "lowvram_stream_layers", 1)
+    patcher = make_patcher()
+    outputs, streamers = run(patcher, x)
+    assert len(streamers) == 1
+    streamer = streamers.pop()
+    assert streamer.order == list(patcher.model.layers)
+    # The first pass records the order, after that every layer but the very first one was prefetched
+    assert streamer.hits == 4 * 2 - 1
+    assert streamer.misses == 1
+    for e, o in zip(expected, outputs):
+        torch.testing.assert_close(o, e)
+    # Unpatching detaches the streamer
+    assert all(layer.comfy_layer_streamer is None for layer in patcher.model.layers)
+
+
+def test_changed_weights_not_used(monkeypatch):
+    monkeypatch.setattr(args, "lowvram_stream_layers", 2)
+    patcher = make_patcher()
+    x = torch.randn(3, 16)
+    patcher.patch_model(device_to=torch.device("cpu"), lowvram_model_memory=1)
+    patcher.model(x)
+    patcher.model(x)
+    streamer = patcher.model.layers[0].comfy_layer_streamer
+    assert len(streamer.buffer) <= 2
+    with torch.no_grad():
+        for layer in patcher.model.layers:
+            layer.weight += 1
+    misses = streamer.misses
+    out = patcher.model(x)
+    assert streamer.misses > misses
+    patcher.unpatch_model(torch.device("cpu"))
+    assert out.shape == (3, 16)
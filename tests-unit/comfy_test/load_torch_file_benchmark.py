@@ -0,0 +1,108 @@
+"""
+Measures the read throughput of the safetensors loaders in comfy.utils.load_torch_file:
+
+    python tests-unit/comfy_test/load_torch_file_benchmark.py --size-gb 4 --threads 4 8 16
+
+A synthetic checkpoint is written to --directory (or --file is used as is). Unless the OS page cache
+is dropped between runs (echo 3 > /proc/sys/vm/drop_caches as root, see --drop-caches) every run
+after the first one reads from RAM instead of the disk.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import safetensors  # noqa: E402
+import safetensors.torch  # noqa: E402
+import torch  # noqa: E402
+
+import comfy.utils  # noqa: E402
+
+
+def write_checkpoint(path, size_gb):
+    # Mix of large and small tensors, roughly like a diffusion model checkpoint
+    sd = {}
+    total = 0
+    i = 0
+    target = int(size_gb * (1024 ** 3))
+    while total < target:
+        shape = (3072, 3072) if i % 4 != 3 else (3072,)
+        sd["blocks.{}.weight".format(i)] = torch.randn(shape, dtype=torch.float32)
+        total += sd["blocks.{}.weight".format(i)].nbytes
+        i += 1
+    safetensors.torch.save_file(sd, path)
+
+
+def drop_caches():
+    try:
+        os.sync()
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3\n")
+    except OSError as e:
+        logging.warning("Could not drop the page cache, results will be cached reads: {}".format(e))
+
+
+def load_eager(path):
+    with safetensors.safe_open(path, framework="pt", device="cpu") as f:
+        return {k: f.get_tensor(k) for k in f.keys()}
+
+
+def load_mmap(path):
+    with safetensors.safe_open(path, framework="pt", device="cpu") as f:
+        return comfy.utils.safetensors_mmap_tensors(path, f)
+
+
+def load_parallel(path, threads, dtype=None):
+    with safetensors.safe_open(path, framework="pt", device="cpu") as f:
+        return comfy.utils.safetensors_parallel_tensors(path, f, threads, dtype=dtype)
+
+
+def run(name, loader, path, size, args):
+    if args.drop_caches:
+        drop_caches()
+    start = time.perf_counter()
+    sd = loader(path)
+    # Memory mapped tensors are only read when used, the time to use every weight once is what matters
+    for v in sd.values():
+        v.max()
+    elapsed = time.perf_counter() - start
+    logging.info("{:>24}: {:6.2f} s {:6.2f} GB/s".format(name, elapsed, size / elapsed / (1024 ** 3)))
+    del sd
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", type=str, default=None, help="Existing safetensors file to read.")
+    parser.add_argument("--directory", type=str, default=None, help="Where to write the synthetic checkpoint.")
+    parser.add_argument("--size-gb", type=float, default=2.0)
+    parser.add_argument("--threads", type=int, nargs="+", default=[2, 4, 8, 16])
+    parser.add_argument("--drop-caches", action="store_true", help="Drop the page cache before each run (needs root).")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s", force=True)
+
+    path = args.file
+    tmp = None
+    if path is None:
+        tmp = tempfile.TemporaryDirectory(dir=args.directory)
+        path = os.path.join(tmp.name, "synthetic.safetensors")
+        logging.info("Writing a {} GB checkpoint to {}".format(args.size_gb, path))
+        write_checkpoint(path, args.size_gb)
+    size = os.path.getsize(path)
+
+    try:
+        run("eager (safe_open)", load_eager, path, size, args)
+        run("mmap", load_mmap, path, size, args)
+        for threads in args.threads:
+            run("parallel {} threads".format(threads), lambda p: load_parallel(p, threads), path, size, args)
+            run("parallel {} threads fp16".format(threads), lambda p: load_parallel(p, threads, dtype=torch.float16), path, size, args)
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import os
+
+import psutil
+import pytest
+import safetensors.torch
+import torch
+
+import comfy.utils
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    sd = {
+        "model.diffusion_model.weight": torch.randn(16, 8),
+        "model.diffusion_model.bias": torch.randn(16).half(),
+        "cond_stage_model.embedding": torch.randn(4, 4).bfloat16(),
+        "cond_stage_model.position_ids": torch.arange(7, dtype=torch.int64),
+        "first_stage_model.flag": torch.tensor([True, False]),
+        "first_stage_model.empty": torch.empty(0, 3),
+    }
+    path = os.path.join(tmp_path, "model.safetensors")
+    safetensors.torch.save_file(sd, path, metadata={"format": "pt"})
+    return path, sd
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_load_matches_file(checkpoint, monkeypatch, mmap):
+    monkeypatch.setattr(comfy.utils, "MMAP_SAFETENSORS", mmap)
+    path, sd = checkpoint
+    out, metadata = comfy.utils.load_torch_file(path, return_metadata=True)
+    assert metadata == {"format": "pt"}
+    assert set(out.keys()) == set(sd.keys())
+    for k in sd:
+        assert out[k].dtype == sd[k].dtype
+        assert torch.equal(out[k], sd[k])
+
+
+def test_mmap_tensors_are_copy_on_write(checkpoint):
+    path, sd = checkpoint
+    out = comfy.utils.load_torch_file(path)
+    out["model.diffusion_model.weight"] += 1
+    reloaded = comfy.utils.load_torch_file(path)
+    assert torch.equal(reloaded["model.diffusion_model.weight"], sd["model.diffusion_model.weight"])
+
+
+def test_prefix_replace_keeps_tensors(checkpoint):
+    path, _ = checkpoint
+    out = comfy.utils.load_torch_file(path)
+    tensor = out["cond_stage_model.embedding"]
+    clip_sd = comfy.utils.state_dict_prefix_replace(out, {"cond_stage_model.": ""}, filter_keys=True)
+    assert clip_sd["embedding"] is tensor
+    assert "cond_stage_model.embedding" not in out
+
+
+def test_load_does_not_read_weights(tmp_path):
+    path = os.path.join(tmp_path, "big.safetensors")
+    safetensors.torch.save_file({"w{}".format(i): torch.zeros(1024, 1024) for i in range(64)}, path)
+    process = psutil.Process()
+    before = process.memory_info().rss
+    sd = comfy.utils.load_torch_file(path)
+    shapes = [sd[k].shape for k in sd]
+    after = process.memory_info().rss
+    assert len(shapes) == 64
+    # 256MB of weights, none of them touched yet
+    assert after - before < 32 * 1024 * 1024
+
+
+@pytest.mark.parametrize("chunk_size", [8, 1000, comfy.utils.PARALLEL_LOAD_CHUNK_SIZE])
+def test_parallel_load(checkpoint, monkeypatch, chunk_size):
+    monkeypatch.setattr(comfy.utils, "PARALLEL_LOAD_CHUNK_SIZE", chunk_size)
+    path, sd = checkpoint
+    with safetensors.safe_open(path, framework="pt", device="cpu") as f:
+        out = comfy.utils.safetensors_parallel_tensors(path, f, 4, chunk_size=chunk_size)
+        converted = comfy.utils.safetensors_parallel_tensors(path, f, 4, dtype=torch.float16, chunk_size=chunk_size)
+    assert set(out.keys()) == set(sd.keys())
+    for k in sd:
+        assert out[k].dtype == sd[k].dtype
+        assert torch.equal(out[k], sd[k])
+        assert torch.equal(converted[k], comfy.utils.load_cast(sd[k], torch.float16))
+    assert converted["model.diffusion_model.weight"].dtype == torch.float16
+    assert converted["cond_stage_model.embedding"].dtype == torch.bfloat16
+
+
+def test_load_threads_option(checkpoint, monkeypatch):
+    monkeypatch.setattr(comfy.utils.args, "load_threads", 3)
+    path, sd = checkpoint
+    out = comfy.utils.load_torch_file(path)
+    for k in sd:
+        assert torch.equal(out[k], sd[k])
+
+
+def test_load_cast():
+    assert comfy.utils.load_cast(torch.randn(4), torch.float16).dtype == torch.float16
+    assert comfy.utils.load_cast(torch.randn(4).half(), torch.float32).dtype == torch.float16
+    assert comfy.utils.load_cast(torch.tensor([0.5]), torch.float16).dtype == torch.float32
+    assert comfy.utils.load_cast(torch.arange(4), torch.float16).dtype == torch.int64
+    assert comfy.utils.load_cast(torch.randn(4), None).dtype == torch.float32
+
+
+@pytest.mark.parametrize("load_threads", [1, 3])
+def test_load_with_dtype(checkpoint, monkeypatch, load_threads):
+    monkeypatch.setattr(comfy.utils.args, "load_threads", load_threads)
+    path, sd = checkpoint
+    out = comfy.utils.load_torch_file(path, dtype=torch.float16)
+    for k in sd:
+        assert torch.equal(out[k], comfy.utils.load_cast(sd[k], torch.float16))
+    assert out["model.diffusion_model.weight"].dtype == torch.float16
@@ -0,0 +1,70 @@
+import json
+import os
+
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.load_trace  # noqa: E402
+import comfy.model_management  # noqa: E402
+import comfy.model_patcher  # noqa: E402
+import comfy.utils  # noqa: E402
+from comfy.weight_adapter import LoRAAdapter  # noqa: E402
+
+
+def test_spans_recorded_per_prompt():
+    with comfy.load_trace.span("outside"):
+        pass
+    with comfy.load_trace.prompt_trace("p1") as trace:
+        with comfy.load_trace.span("outer", bytes=10):
+            with comfy.load_trace.span("inner", bytes=5):
+                pass
+            comfy.load_trace.annotate(extra=1)
+        with comfy.load_trace.span("inner", bytes=7):
+            pass
+    assert comfy.load_trace.get_trace("p1") is trace
+    assert trace.summary()["inner"]["count"] == 2
+    assert trace.summary()["inner"]["bytes"] == 12
+    assert "outside" not in trace.summary()
+    out = json.loads(json.dumps(trace.chrome_trace()))
+    outer = [e for e in out["traceEvents"] if e["name"] == "outer"][0]
+    assert outer["ph"] == "X" and outer["args"] == {"bytes": 10, "extra": 1}
+    assert out["otherData"]["prompt_id"] == "p1"
+
+
+def test_bounded_number_of_traces(monkeypatch):
+    monkeypatch.setattr(comfy.load_trace, "MAX_TRACES", 2)
+    for i in range(3):
+        with comfy.load_trace.prompt_trace("bounded{}".format(i)):
+            pass
+    assert comfy.load_trace.get_trace("bounded0") is None
+    assert comfy.load_trace.get_trace("bounded2") is not None
+
+
+def test_model_load_phases():
+    model = torch.nn.Sequential(torch.nn.Linear(16, 16), torch.nn.Linear(16, 16))
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    patcher.add_patches({"0.weight": LoRAAdapter(set(), (torch.ones(16, 1), torch.ones(1, 16), None, None, None, None))}, 1.0)
+    with comfy.load_trace.prompt_trace("load") as trace:
+        comfy.model_management.load_models_gpu([patcher])
+    comfy.model_management.unload_all_models()
+    summary = trace.summary()
+    for phase in ("model_load", "ModelPatcher.load", "cast_to_float32", "lora_patch", "cast_to_weight_dtype", "move_to_device"):
+        assert phase in summary, phase
+    assert summary["lora_patch"]["bytes"] == 16 * 16 * 4
+    assert summary["ModelPatcher.load"]["bytes"] == 2 * (16 * 16 + 16) * 4
+
+
+def test_load_torch_file_bytes_read(tmp_path, monkeypatch):
+    import safetensors.torch
+    path = os.path.join(tmp_path, "model.safetensors")
+    safetensors.torch.save_file({"weight": torch.ones(16, 16)}, path)
+    monkeypatch.setattr(args, "load_threads", 1)
+    for mmap, read in ((True, None), (False, 16 * 16 * 4)):
+        monkeypatch.setattr(comfy.utils, "MMAP_SAFETENSORS", mmap)
+        with comfy.load_trace.prompt_trace("file_mmap{}".format(mmap)) as trace:
+            comfy.utils.load_torch_file(path)
+        span = [e for e in trace.chrome_trace()["traceEvents"] if e["name"] == "load_torch_file"][0]
+        assert span["args"]["file_size"] == os.path.getsize(path)
+        assert span["args"].get("bytes", None) == read
@@ -0,0 +1,96 @@
+import pytest
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.lora  # noqa: E402
+import comfy.model_patcher  # noqa: E402
+from comfy.weight_adapter import LoRAAdapter, LoHaAdapter, LoKrAdapter  # noqa: E402
+
+
+def make_adapter(kind, generator, rows=24, columns=16, rank=4, alpha=None):
+    def randn(*shape):
+        return torch.randn(*shape, generator=generator)
+    if kind == "lora":
+        return LoRAAdapter(set(), (randn(rows, rank), randn(rank, columns), alpha, None, None, None))
+    if kind == "loha":
+        return LoHaAdapter(set(), (randn(rows, rank), randn(rank, columns), alpha, randn(rows, rank), randn(rank, columns), None, None, None))
+    if kind == "lokr":
+        # w1 given as a full matrix, w2 as a low rank product
+        return LoKrAdapter(set(), (randn(4, 2), None, alpha, None, None, randn(rows // 4, rank), randn(rank, columns // 2), None, None))
+    if kind == "lokr_full":
+        return LoKrAdapter(set(), (randn(4, 2), randn(rows // 4, columns // 2), alpha, None, None, None, None, None, None))
+
+
+@pytest.mark.parametrize("kind", ["lora", "loha", "lokr", "lokr_full"])
+def test_batched_matches_per_key(kind):
+    generator = torch.Generator().manual_seed(0)
+    items = []
+    for i in range(5):
+        weight = torch.randn(24, 16, generator=generator)
+        patches = [(0.7, make_adapter(kind, generator, alpha=2.0), 1.0, None, None),
+                   (0.3, make_adapter(kind, generator), 0.9, None, None)]
+        items.append((patches, weight, "k{}".format(i)))
+
+    signatures = set(comfy.lora.batched_patch_signature(patches, weight) for patches, weight, _ in items)
+    assert len(signatures) == 1 and None not in signatures
+
+    expected = [comfy.lora.calculate_weight(patches, weight.clone(), key) for patches, weight, key in items]
+    batched = comfy.lora.calculate_weights_batched([(patches, weight.clone(), key) for patches, weight, key in items])
+    for e, b in zip(expected, batched):
+        torch.testing.assert_close(b, e)
+
+
+def test_unbatchable_patches():
+    generator = torch.Generator().manual_seed(0)
+    weight = torch.zeros(24, 16)
+    lora = make_adapter("lora", generator)
+    assert comfy.lora.batched_patch_signature([(1.0, lora, 1.0, None, None)], weight) is not None
+    assert comfy.lora.batched_patch_signature([(1.0, lora, 1.0, None, lambda a: a)], weight) is None
+    assert comfy.lora.batched_patch_signature([(1.0, lora, 1.0, (0, 0, 12), None)], weight) is None
+    assert comfy.lora.batched_patch_signature([(1.0, (torch.ones(24, 16),), 1.0, None, None)], weight) is None
+    dora = LoRAAdapter(set(), lora.weights[:4] + (torch.ones(24, 1), None))
+    assert comfy.lora.batched_patch_signature([(1.0, dora, 1.0, None, None)], weight) is None
+    # Shape mismatches are left to calculate_weight, which logs them
+    assert comfy.lora.batched_patch_signature([(1.0, lora, 1.0, None, None)], torch.zeros(16, 16)) is None
+
+
+class Blocks(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.blocks = torch.nn.ModuleList([torch.nn.Linear(16, 24) for _ in range(6)])
+        self.out = torch.nn.Linear(24, 8)
+
+
+def test_model_patcher_batched_load(monkeypatch):
+    torch.manual_seed(0)
+    generator = torch.Generator().manual_seed(1)
+    patcher = comfy.model_patcher.ModelPatcher(Blocks(), torch.device("cpu"), torch.device("cpu"))
+    original = {k: v.clone() for k, v in patcher.model.state_dict().items()}
+    lora = {"blocks.{}.weight".format(i): make_adapter("lora", generator) for i in range(6)}
+    lora["out.weight"] = make_adapter("lora", generator, rows=8, columns=24)
+    lora["out.bias"] = (torch.ones(8),)
+    patcher.add_patches(lora, 0.5)
+
+    batches = []
+    calculate_weights_batched = comfy.lora.calculate_weights_batched
+
+    def counting(items, *args, **kwargs):
+        batches.append(len(items))
+        return calculate_weights_batched(items, *args, **kwargs)
+    monkeypatch.setattr(comfy.lora, "calculate_weights_batched", counting)
+    # Small enough that the blocks are patched in two batches
+    monkeypatch.setattr(comfy.lora, "BATCHED_PATCH_MAX_BYTES", 3 * 24 * 16 * 4)
+
+    patcher.patch_model()
+    assert sorted(batches) == [3, 3]
+    patched = {k: v.clone() for k, v in patcher.model.state_dict().items()}
+    patcher.unpatch_model()
+
+    for k, v in patcher.model.state_dict().items():
+        assert torch.equal(v, original[k])
+        expected = original[k]
+        if k in lora:
+            expected = comfy.lora.calculate_weight([(0.5, lora[k], 1.0, None, None)], original[k].clone(), k)
+        torch.testing.assert_close(patched[k], expected)
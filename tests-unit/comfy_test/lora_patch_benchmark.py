@@ -0,0 +1,87 @@
+"""
+Compares patching a model with a LoRA one key at a time (ModelPatcher.patch_weight_to_device) with the
+batched path (ModelPatcher.patch_weights_to_device) on the CPU:
+
+    python tests-unit/comfy_test/lora_patch_benchmark.py --blocks 64 --dim 1280 --rank 32
+
+The synthetic model is a stack of square linear layers, like the attention projections of a diffusion
+model, with one LoRA (or --adapter loha/lokr) patch on every weight.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import torch  # noqa: E402
+
+from comfy.cli_args import args as comfy_args  # noqa: E402
+comfy_args.cpu = True
+
+import comfy.model_patcher  # noqa: E402
+from comfy.weight_adapter import LoRAAdapter, LoHaAdapter, LoKrAdapter  # noqa: E402
+
+
+def make_patches(model, adapter, rank):
+    patches = {}
+    for k, v in model.state_dict().items():
+        if not k.endswith(".weight"):
+            continue
+        rows, columns = v.shape
+        if adapter == "lora":
+            patches[k] = LoRAAdapter(set(), (torch.randn(rows, rank), torch.randn(rank, columns), float(rank), None, None, None))
+        elif adapter == "loha":
+            patches[k] = LoHaAdapter(set(), (torch.randn(rows, rank), torch.randn(rank, columns), float(rank),
+                                             torch.randn(rows, rank), torch.randn(rank, columns), None, None, None))
+        else:
+            patches[k] = LoKrAdapter(set(), (torch.randn(8, 8), None, float(rank), None, None,
+                                             torch.randn(rows // 8, rank), torch.randn(rank, columns // 8), None, None))
+    return patches
+
+
+def run(name, patcher, patch, repeats):
+    keys = list(patcher.patches.keys())
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        patch(patcher, keys)
+        elapsed = time.perf_counter() - start
+        patcher.unpatch_model()
+        best = elapsed if best is None else min(best, elapsed)
+    logging.info("{:>10}: {:7.3f} s ({} keys)".format(name, best, len(keys)))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blocks", type=int, default=32)
+    parser.add_argument("--dim", type=int, default=1280)
+    parser.add_argument("--rank", type=int, default=32)
+    parser.add_argument("--adapter", choices=["lora", "loha", "lokr"], default="lora")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None, help="torch.set_num_threads")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s", force=True)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    model = torch.nn.Sequential(*[torch.nn.Linear(args.dim, args.dim) for _ in range(args.blocks)])
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+    patcher.add_patches(make_patches(model, args.adapter, args.rank), 1.0)
+
+    def per_key(p, keys):
+        for k in keys:
+            p.patch_weight_to_device(k)
+
+    def batched(p, keys):
+        p.patch_weights_to_device(keys)
+
+    per_key_time = run("per key", patcher, per_key, args.repeats)
+    batched_time = run("batched", patcher, batched, args.repeats)
+    logging.info("speedup: {:.2f}x".format(per_key_time / batched_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.memory_model  # noqa: E402
+import comfy.samplers  # noqa: E402
+from comfy.memory_model import MemoryModel, batch_fits  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def test_estimate():
+    memory_model = MemoryModel()
+    assert memory_model.estimate([2, 4, 64, 64]) is None
+    assert memory_model.needs_measure([2, 4, 64, 64])
+    memory_model.record([2, 4, 64, 64], 200 * MB)
+    assert not memory_model.needs_measure([2, 4, 64, 64])
+    assert memory_model.estimate([2, 4, 64, 64]) == 200 * MB
+    assert memory_model.estimate([4, 4, 64, 64]) == 400 * MB
+    memory_model.record([4, 4, 64, 64], 300 * MB)
+    # Fitted on the fixed part + per batch part
+    assert memory_model.estimate([6, 4, 64, 64]) == 400 * MB
+    assert memory_model.estimate([3, 4, 64, 64]) == 250 * MB
+    # Other shapes aren't extrapolated
+    assert memory_model.estimate([2, 4, 32, 32]) is None
+    assert memory_model.estimate([2, 4, 64, 64], variant="control") is None
+
+
+def test_batch_fits():
+    class Model:
+        memory_model = MemoryModel()
+
+        def memory_required(self, input_shape):
+            return 100 * MB * input_shape[0]
+
+    model = Model()
+    assert not batch_fits(model, [4, 4, 64, 64], 500 * MB)
+    model.memory_model.record([4, 4, 64, 64], 400 * MB)
+    assert batch_fits(model, [4, 4, 64, 64], 500 * MB)
+    # Shapes that were never measured keep the static estimate and margin
+    assert not batch_fits(model, [4, 4, 128, 128], 500 * MB)
+    model.memory_model = None
+    assert not batch_fits(model, [4, 4, 64, 64], 500 * MB)
+
+
+def test_batch_decisions_are_reused():
+    memory_model = MemoryModel()
+    key = ((1, 4, 64, 64), 2, None)
+    assert memory_model.cached_batch(key) is None
+    memory_model.cache_batch(key, 2)
+    for _ in range(comfy.memory_model.DECISION_STEPS):
+        assert memory_model.cached_batch(key) == 2
+    assert memory_model.cached_batch(key) is None
+    memory_model.cache_batch(key, 2)
+    memory_model.record([2, 4, 64, 64], 100 * MB)
+    assert memory_model.cached_batch(key) is None
+
+
+class FakePatcher:
+    def prepare_state(self, timestep):
+        pass
+
+    def apply_hooks(self, hooks):
+        return {}
+
+
+class FakeModel:
+    def __init__(self):
+        self.current_patcher = FakePatcher()
+        self.memory_model = MemoryModel()
+        self.batches = []
+
+    def memory_required(self, input_shape):
+        return 0
+
+    def apply_model(self, x, t, **kwargs):
+        self.batches.append(x.shape[0])
+        return x * 2
+
+
+def test_calc_cond_batch_reuses_decisions():
+    model = FakeModel()
+    x = torch.ones(1, 4, 8, 8)
+    conds = [[{"model_conds": {}, "uuid": "a"}], [{"model_conds": {}, "uuid": "b"}]]
+    for _ in range(3):
+        out = comfy.samplers.calc_cond_batch(model, conds, x, torch.ones(1), {})
+        assert torch.allclose(out[0], x * 2)
+    assert model.batches == [2, 2, 2]
+    assert model.memory_model.decisions_reused == 2
@@ -0,0 +1,96 @@
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.lora  # noqa: E402
+import comfy.model_patcher  # noqa: E402
+from comfy.weight_adapter.lora import LoRAAdapter  # noqa: E402
+
+
+class TinyModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.a = torch.nn.Linear(16, 16)
+        self.b = torch.nn.Linear(16, 16)
+
+
+def make_lora(seed, names=("a.weight", "b.weight"), rank=4):
+    generator = torch.Generator().manual_seed(seed)
+    patches = {}
+    for name in names:
+        up = torch.randn(16, rank, generator=generator)
+        down = torch.randn(rank, 16, generator=generator)
+        patches[name] = LoRAAdapter(set(), (up, down, None, None, None, None))
+    return patches
+
+
+def reference_weights(base, lora):
+    patcher = base.clone()
+    patcher.add_patches(lora, 1.0)
+    patcher.patch_model()
+    weights = {k: v.detach().clone() for k, v in patcher.model.state_dict().items()}
+    patcher.unpatch_model()
+    return weights
+
+
+def test_switch_between_variants(monkeypatch):
+    torch.manual_seed(0)
+    device = torch.device("cpu")
+    base = comfy.model_patcher.ModelPatcher(TinyModel(), device, device)
+    original = {k: v.clone() for k, v in base.model.state_dict().items()}
+    lora_a, lora_b = make_lora(1), make_lora(2, names=("a.weight",))
+    expected_a, expected_b = reference_weights(base, lora_a), reference_weights(base, lora_b)
+
+    monkeypatch.setattr(args, "patched_variants", 2)
+    calls = []
+    original_calculate, original_batched = comfy.lora.calculate_weight, comfy.lora.calculate_weights_batched
+
+    def counting(patches, weight, key, *args, **kwargs):
+        calls.append(key)
+        return original_calculate(patches, weight, key, *args, **kwargs)
+
+    def counting_batched(items, *args, **kwargs):
+        calls.extend(key for _, _, key in items)
+        return original_batched(items, *args, **kwargs)
+    monkeypatch.setattr(comfy.lora, "calculate_weight", counting)
+    monkeypatch.setattr(comfy.lora, "calculate_weights_batched", counting_batched)
+
+    patcher_a, patcher_b = base.clone(), base.clone()
+    patcher_a.add_patches(lora_a, 1.0)
+    patcher_b.add_patches(lora_b, 1.0)
+    patcher_a.patch_model(device)
+    unpatched_b = base.model.b.bias
+
+    patcher_b.partially_load(device)
+    for k, v in base.model.state_dict().items():
+        assert torch.equal(v, expected_b[k])
+    # Only the patched weight is duplicated
+    assert base.model.b.bias is unpatched_b
+    assert sorted(calls) == ["a.weight", "a.weight", "b.weight"]
+    assert len(base.model.patched_variants) == 1
+    calls.clear()
+
+    patcher_a.partially_load(device)
+    assert calls == []
+    for k, v in base.model.state_dict().items():
+        assert torch.equal(v, expected_a[k])
+    patcher_b.partially_load(device)
+    assert calls == []
+    for k, v in base.model.state_dict().items():
+        assert torch.equal(v, expected_b[k])
+
+    # The kept variant of lora_a patches both weights
+    assert patcher_b.patched_variants_size() == 2 * 16 * 16 * 4
+    assert patcher_b.free_patched_variants(1) == 2 * 16 * 16 * 4
+    assert patcher_b.patched_variants_size() == 0
+    for k, v in base.model.state_dict().items():
+        assert torch.equal(v, expected_b[k])
+
+    patcher_a.partially_load(device)
+    for k, v in base.model.state_dict().items():
+        assert torch.equal(v, expected_a[k])
+    patcher_b.unpatch_model(device)
+    assert len(base.model.patched_variants) == 0
+    for k, v in base.model.state_dict().items():
+        assert torch.equal(v, original[k])
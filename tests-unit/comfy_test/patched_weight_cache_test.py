@@ -0,0 +1,126 @@
+import pytest
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.lora  # noqa: E402
+import comfy.model_patcher  # noqa: E402
+import comfy.patched_weight_cache  # noqa: E402
+from comfy.weight_adapter.lora import LoRAAdapter  # noqa: E402
+
+
+class TinyModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.a = torch.nn.Linear(16, 16)
+        self.b = torch.nn.Linear(16, 16)
+
+
+def make_lora(seed, rank=4):
+    generator = torch.Generator().manual_seed(seed)
+    patches = {}
+    for name in ("a.weight", "b.weight"):
+        up = torch.randn(16, rank, generator=generator)
+        down = torch.randn(rank, 16, generator=generator)
+        patches[name] = LoRAAdapter(set(), (up, down, None, None, None, None))
+    return patches
+
+
+@pytest.fixture
+def weight_cache(monkeypatch):
+    cache = comfy.patched_weight_cache.PatchedWeightCache(1024 ** 3)
+    monkeypatch.setattr(comfy.patched_weight_cache, "get_cache", lambda: cache)
+    return cache
+
+
+@pytest.fixture
+def calculate_weight_calls(monkeypatch):
+    calls = []
+    original = comfy.lora.calculate_weight
+    original_batched = comfy.lora.calculate_weights_batched
+
+    def counting(patches, weight, key, *args, **kwargs):
+        calls.append(key)
+        return original(patches, weight, key, *args, **kwargs)
+
+    def counting_batched(items, *args, **kwargs):
+        calls.extend(key for _, _, key in items)
+        return original_batched(items, *args, **kwargs)
+    monkeypatch.setattr(comfy.lora, "calculate_weight", counting)
+    monkeypatch.setattr(comfy.lora, "calculate_weights_batched", counting_batched)
+    return calls
+
+
+def patched_weights(base, lora, strength):
+    patcher = base.clone()
+    patcher.add_patches(lora, strength)
+    patcher.patch_model()
+    weights = {k: v.detach().clone() for k, v in patcher.model.state_dict().items()}
+    patcher.unpatch_model()
+    return weights
+
+
+def test_cached_weights_match(weight_cache, calculate_weight_calls, monkeypatch):
+    torch.manual_seed(0)
+    base = comfy.model_patcher.ModelPatcher(TinyModel(), torch.device("cpu"), torch.device("cpu"))
+    original = {k: v.clone() for k, v in base.model.state_dict().items()}
+    lora_a, lora_b = make_lora(1), make_lora(2)
+
+    first = patched_weights(base, lora_a, 0.8)
+    assert len(calculate_weight_calls) == 2
+    patched_weights(base, lora_b, 0.8)
+    assert len(calculate_weight_calls) == 4
+
+    # Back to the first combination: merged weights come from the cache
+    again = patched_weights(base, lora_a, 0.8)
+    assert len(calculate_weight_calls) == 4
+    assert weight_cache.hits == 2
+    for k in first:
+        assert torch.equal(first[k], again[k])
+
+    # A different strength is a different merge
+    patched_weights(base, lora_a, 0.5)
+    assert len(calculate_weight_calls) == 6
+
+    # Unpatching restores the base weights
+    for k, v in base.model.state_dict().items():
+        assert torch.equal(v, original[k])
+
+    monkeypatch.setattr(comfy.patched_weight_cache, "get_cache", lambda: None)
+    uncached = patched_weights(base, lora_a, 0.8)
+    for k in first:
+        assert torch.equal(first[k], uncached[k])
+
+
+def test_lru_bound():
+    cache = comfy.patched_weight_cache.PatchedWeightCache(3 * 64 * 4)
+    for i in range(5):
+        cache.set(bytes([i]), torch.zeros(64))
+    assert cache.total_bytes <= 3 * 64 * 4
+    assert cache.get(bytes([0])) is None
+    assert cache.get(bytes([4])) is not None
+
+
+def test_disk_tier(tmp_path):
+    from comfy_execution.disk_cache import DiskCache
+    cache = comfy.patched_weight_cache.PatchedWeightCache(1024 ** 2, disk_cache=DiskCache(str(tmp_path), 1024 ** 2))
+    cache.set(b"key", torch.arange(10.0))
+    restarted = comfy.patched_weight_cache.PatchedWeightCache(1024 ** 2, disk_cache=DiskCache(str(tmp_path), 1024 ** 2))
+    assert torch.equal(restarted.get(b"key"), torch.arange(10.0))
+
+
+def test_uncacheable_patches():
+    digest = comfy.patched_weight_cache.tensor_digest(torch.zeros(4))
+    diff = (torch.ones(4),)
+    assert comfy.patched_weight_cache.patched_weight_key("w", digest, [(1.0, diff, 1.0, None, None)], torch.float32) is not None
+    assert comfy.patched_weight_cache.patched_weight_key("w", digest, [(1.0, diff, 1.0, None, lambda a: a)], torch.float32) is None
+    assert comfy.patched_weight_cache.patched_weight_key("w", digest, [(1.0, ("model_as_lora", diff), 1.0, None, None)], torch.float32) is None
+
+
+def test_tensor_digest_tracks_changes():
+    t = torch.zeros(8)
+    before = comfy.patched_weight_cache.tensor_digest(t)
+    t += 1
+    assert comfy.patched_weight_cache.tensor_digest(t) != before
+    assert comfy.patched_weight_cache.tensor_digest(torch.zeros(8)) == before
@@ -0,0 +1,100 @@
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.samplers  # noqa: E402
+import comfy.k_diffusion.sampling as k_diffusion_sampling  # noqa: E402
+from comfy.step_cache import StepCache, model_type_options  # noqa: E402
+
+
+class FakePatcher:
+    def prepare_state(self, timestep):
+        pass
+
+    def apply_hooks(self, hooks):
+        return {}
+
+
+class FakeSampling:
+    def percent_to_sigma(self, percent):
+        return 10.0 * (1.0 - percent)
+
+
+class WAN21:
+    model_sampling = FakeSampling()
+
+
+class FakeModel:
+    def __init__(self):
+        self.current_patcher = FakePatcher()
+        self.model_sampling = FakeSampling()
+        self.calls = 0
+        self.model_calls = 0
+
+    def memory_required(self, input_shape):
+        return 0
+
+    def apply_model(self, x, t, **kwargs):
+        self.calls += x.shape[0]
+        self.model_calls += 1
+        # The uncond prediction differs from the cond one by something that changes slowly with sigma
+        t = t.reshape(-1, 1, 1, 1)
+        uncond = torch.tensor([float(i) for i in kwargs["transformer_options"]["cond_or_uncond"]]).reshape(-1, 1, 1, 1)
+        return x / (1.0 + t) + 0.1 * t - uncond * 0.2 * (1.0 + 0.05 * t)
+
+
+def run(sampler, model, model_options):
+    conds = [{"model_conds": {}, "uuid": "positive"}]
+    unconds = [{"model_conds": {}, "uuid": "negative"}]
+
+    def denoise(x, sigma, **kwargs):
+        return comfy.samplers.sampling_function(model, x, sigma, unconds, conds, 4.0, model_options=model_options)
+
+    sigmas = torch.linspace(10.0, 0.0, 21)
+    x = torch.ones(1, 4, 8, 8) * 10.0
+    return sampler(denoise, x, sigmas, disable=True)
+
+
+def test_options_by_model_type():
+    assert model_type_options(WAN21())["start_percent"] == 0.3
+    assert model_type_options(FakeModel()) == comfy.step_cache.DEFAULT_OPTIONS
+    assert StepCache.from_options(FakeModel(), {}) is None
+    assert StepCache.from_options(FakeModel(), {"step_cache": {"threshold": 0.0, "start_percent": 0.5, "max_skipped_steps": 2}}) is None
+    cache = StepCache.from_options(WAN21(), {"step_cache": {"threshold": 0.1, "start_percent": 0.5, "max_skipped_steps": 2}})
+    assert cache.start_sigma == 5.0
+
+
+def test_skips_uncond_evaluations():
+    for sampler in (k_diffusion_sampling.sample_euler, k_diffusion_sampling.sample_heun, k_diffusion_sampling.sample_dpmpp_2m):
+        reference_model = FakeModel()
+        reference = run(sampler, reference_model, {})
+
+        model = FakeModel()
+        cache = StepCache(threshold=0.5, start_sigma=5.0, max_skipped_steps=2)
+        out = run(sampler, model, {"step_cache_state": cache})
+        assert cache.skipped > 0
+        assert cache.skipped <= cache.evaluations * 2 // 3 + 1
+        assert model.calls == reference_model.calls - cache.skipped
+        # One model call per step, skipped or not
+        assert model.model_calls == reference_model.model_calls
+        assert torch.allclose(out, reference, rtol=0.05, atol=1e-3)
+
+
+def test_threshold_limits_skips():
+    model = FakeModel()
+    cache = StepCache(threshold=1e-6, start_sigma=5.0, max_skipped_steps=2)
+    run(k_diffusion_sampling.sample_euler, model, {"step_cache_state": cache})
+    assert cache.skipped == 0
+    assert cache.evaluations == 20
+
+
+def test_rejected_skips_stay_batched():
+    reference_model = FakeModel()
+    run(k_diffusion_sampling.sample_euler, reference_model, {})
+    for threshold in (0.01, 0.03, 0.1, 0.3):
+        model = FakeModel()
+        cache = StepCache(threshold=threshold, start_sigma=10.0, max_skipped_steps=3)
+        run(k_diffusion_sampling.sample_euler, model, {"step_cache_state": cache})
+        assert model.model_calls == reference_model.model_calls
+        assert model.calls == reference_model.calls - cache.skipped
@@ -0,0 +1,88 @@
+"""
+Tokenization throughput of the tokenizers of each text encoder family, with the memoization of
+SDTokenizer (parsed weights, tokenized words, embeddings) cleared before every prompt ("cold") and
+kept ("warm", the same prompts coming back):
+
+    python tests-unit/comfy_test/tokenizer_benchmark.py --prompts 200 --families sd1 sdxl sd3 flux
+"""
+import argparse
+import importlib
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from comfy.cli_args import args as comfy_args  # noqa: E402
+comfy_args.cpu = True
+
+import comfy.sd1_clip  # noqa: E402
+
+FAMILIES = {
+    "sd1": ("comfy.sd1_clip", "SD1Tokenizer"),
+    "sdxl": ("comfy.sdxl_clip", "SDXLTokenizer"),
+    "sd3": ("comfy.text_encoders.sd3_clip", "SD3Tokenizer"),
+    "flux": ("comfy.text_encoders.flux", "FluxTokenizer"),
+    "hidream": ("comfy.text_encoders.hidream", "HiDreamTokenizer"),
+}
+
+WORDS = ["a", "photo", "of", "cat", "dog", "castle", "(masterpiece:1.2)", "best quality", "((detailed))", "sunset",
+         "cinematic lighting", "watercolor", "portrait", "forest", "in the style of", "[blurry]", "4k", "river"]
+
+
+def make_prompts(count, words_per_prompt, seed=0):
+    rng = random.Random(seed)
+    return [", ".join(rng.choice(WORDS) for _ in range(words_per_prompt)) for _ in range(count)]
+
+
+def sd_tokenizers(tokenizer):
+    out = []
+    for v in vars(tokenizer).values():
+        if isinstance(v, comfy.sd1_clip.SDTokenizer):
+            out.append(v)
+        elif hasattr(v, "tokenize_with_weights"):
+            out += sd_tokenizers(v)
+    return out
+
+
+def clear(tokenizer):
+    comfy.sd1_clip.parsed_token_weights.cache_clear()
+    for t in sd_tokenizers(tokenizer):
+        t.word_ids_cache.clear()
+
+
+def run(tokenizer, prompts, cold):
+    start = time.perf_counter()
+    for prompt in prompts:
+        if cold:
+            clear(tokenizer)
+        tokenizer.tokenize_with_weights(prompt)
+    return len(prompts) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompts", type=int, default=200)
+    parser.add_argument("--words", type=int, default=40, help="Words per prompt")
+    parser.add_argument("--families", nargs="+", choices=list(FAMILIES.keys()), default=list(FAMILIES.keys()))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s", force=True)
+
+    prompts = make_prompts(args.prompts, args.words)
+    for family in args.families:
+        module, name = FAMILIES[family]
+        try:
+            tokenizer = getattr(importlib.import_module(module), name)()
+        except Exception as e:
+            logging.info("{:>8}: skipped ({})".format(family, e))
+            continue
+        cold = run(tokenizer, prompts, cold=True)
+        run(tokenizer, prompts, cold=False)
+        warm = run(tokenizer, prompts, cold=False)
+        logging.info("{:>8}: cold {:8.1f} prompts/s, warm {:8.1f} prompts/s ({:.1f}x)".format(family, cold, warm, warm / cold))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import os
+
+import safetensors.torch
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.sd1_clip  # noqa: E402
+
+
+def test_batched_words_match_single_calls():
+    tokenizer = comfy.sd1_clip.SDTokenizer()
+    words = ["a photo of a cat", "masterpiece, best quality", "a photo of a cat", "水彩画"]
+    assert tokenizer.tokenize_words(words) == [tokenizer.tokenizer(w)["input_ids"] for w in words]
+    # Served from the memo the second time
+    assert tokenizer.tokenize_words(words[:1])[0] is tokenizer.word_ids_cache[words[0]]
+
+
+def test_tokenize_is_stable():
+    tokenizer = comfy.sd1_clip.SDTokenizer()
+    prompt = "a (photo:1.2) of a ((cat)), " * 20
+    first = tokenizer.tokenize_with_weights(prompt, return_word_ids=True)
+    assert tokenizer.tokenize_with_weights(prompt, return_word_ids=True) == first
+    assert len(first) > 1
+    assert comfy.sd1_clip.parsed_token_weights(comfy.sd1_clip.escape_important(prompt)) == tuple(comfy.sd1_clip.token_weights(comfy.sd1_clip.escape_important(prompt), 1.0))
+
+
+def test_embeddings_reload_when_changed(tmp_path):
+    path = os.path.join(str(tmp_path), "style.safetensors")
+    safetensors.torch.save_file({"clip_l": torch.ones(2, 768)}, path)
+    tokenizer = comfy.sd1_clip.SDTokenizer(embedding_directory=str(tmp_path))
+
+    tokens = tokenizer.tokenize_with_weights("a cat embedding:style")[0]
+    embeds = [t for t, _ in tokens if isinstance(t, torch.Tensor)]
+    assert len(embeds) == 2 and torch.equal(embeds[0], torch.ones(768))
+    again = [t for t, _ in tokenizer.tokenize_with_weights("a cat embedding:style")[0] if isinstance(t, torch.Tensor)]
+    assert again[0].data_ptr() == embeds[0].data_ptr()
+
+    safetensors.torch.save_file({"clip_l": torch.zeros(3, 768)}, path)
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 1000000000))
+    changed = [t for t, _ in tokenizer.tokenize_with_weights("a cat embedding:style")[0] if isinstance(t, torch.Tensor)]
+    assert len(changed) == 3 and torch.equal(changed[0], torch.zeros(768))
@@ -0,0 +1,169 @@
+import logging
+import time
+
+import pytest
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import nodes  # noqa: E402
+from comfy_execution.caching import CacheKeySetInputSignature, HierarchicalCache, RAMBudgetCache, Unhashable, estimate_size  # noqa: E402
+from comfy_execution.graph import DynamicPrompt  # noqa: E402
+
+
+class SourceNode:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"value": ("INT", {})}}
+
+class ChainNode:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"a": ("INT", {}), "b": ("INT", {})}}
+
+class NotIdempotentNode(ChainNode):
+    NOT_IDEMPOTENT = True
+
+
+class StaticIsChangedCache:
+    def __init__(self, values=None):
+        self.values = values or {}
+
+    def get(self, node_id):
+        return self.values.get(node_id, False)
+
+
+@pytest.fixture(autouse=True)
+def test_nodes(monkeypatch):
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TestSource", SourceNode)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TestChain", ChainNode)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TestNotIdempotent", NotIdempotentNode)
+
+
+def make_graph(num_nodes, seed=0):
+    """A layered graph where every node links to two earlier nodes."""
+    prompt = {"0": {"class_type": "TestSource", "inputs": {"value": seed}}}
+    for i in range(1, num_nodes):
+        prompt[str(i)] = {
+            "class_type": "TestChain",
+            "inputs": {"a": [str(i - 1), 0], "b": [str(i // 2), 0]},
+        }
+    return prompt
+
+
+def get_keys(prompt, is_changed=None):
+    key_set = CacheKeySetInputSignature(DynamicPrompt(prompt), prompt.keys(), StaticIsChangedCache(is_changed))
+    return {node_id: key_set.get_data_key(node_id) for node_id in prompt}
+
+
+def test_signature_is_independent_of_node_ids():
+    first = {
+        "1": {"class_type": "TestSource", "inputs": {"value": 1}},
+        "2": {"class_type": "TestChain", "inputs": {"a": ["1", 0], "b": 5}},
+    }
+    second = {
+        "10": {"class_type": "TestSource", "inputs": {"value": 1}},
+        "20": {"class_type": "TestChain", "inputs": {"a": ["10", 0], "b": 5}},
+    }
+    assert get_keys(first)["2"] == get_keys(second)["20"]
+    assert len(get_keys(first)["2"]) == 32
+
+
+def test_signature_changes_propagate_to_descendants():
+    keys = get_keys(make_graph(50))
+    changed = get_keys(make_graph(50, seed=1))
+    assert all(keys[node_id] != changed[node_id] for node_id in keys)
+
+
+def test_socket_index_is_part_of_signature():
+    prompt = {
+        "1": {"class_type": "TestSource", "inputs": {"value": 1}},
+        "2": {"class_type": "TestChain", "inputs": {"a": ["1", 0], "b": 5}},
+        "3": {"class_type": "TestChain", "inputs": {"a": ["1", 1], "b": 5}},
+    }
+    keys = get_keys(prompt)
+    assert keys["2"] != keys["3"]
+
+
+def test_not_idempotent_includes_node_id():
+    prompt = {
+        "1": {"class_type": "TestNotIdempotent", "inputs": {"a": 1, "b": 2}},
+        "2": {"class_type": "TestNotIdempotent", "inputs": {"a": 1, "b": 2}},
+    }
+    keys = get_keys(prompt)
+    assert keys["1"] != keys["2"]
+
+
+def test_nan_is_changed_is_never_cached():
+    prompt = make_graph(3)
+    keys = get_keys(prompt, is_changed={"0": float("NaN")})
+    assert all(isinstance(key, Unhashable) for key in keys.values())
+
+
+def test_missing_ancestor_is_never_cached():
+    prompt = {"1": {"class_type": "TestChain", "inputs": {"a": ["missing", 0], "b": 5}}}
+    assert isinstance(get_keys(prompt)["1"], Unhashable)
+
+
+def test_cache_hit_across_prompts():
+    cache = HierarchicalCache(CacheKeySetInputSignature)
+    prompt = make_graph(20)
+    cache.set_prompt(DynamicPrompt(prompt), prompt.keys(), StaticIsChangedCache())
+    cache.set("19", ("output",))
+
+    renumbered = {str(int(k) + 100): v for k, v in make_graph(20).items()}
+    for node in renumbered.values():
+        for key, value in node["inputs"].items():
+            if isinstance(value, list):
+                value[0] = str(int(value[0]) + 100)
+    cache.set_prompt(DynamicPrompt(renumbered), renumbered.keys(), StaticIsChangedCache())
+    assert cache.get("119") == ("output",)
+
+
+def test_signatures_are_shared_between_key_sets():
+    prompt = make_graph(10)
+    dynprompt = DynamicPrompt(prompt)
+    is_changed_cache = StaticIsChangedCache()
+    first = CacheKeySetInputSignature(dynprompt, prompt.keys(), is_changed_cache)
+    second = CacheKeySetInputSignature(dynprompt, prompt.keys(), is_changed_cache)
+    assert first.node_signatures is second.node_signatures
+
+
+@pytest.mark.parametrize("num_nodes", [100, 1000, 10000])
+def test_benchmark_key_generation(num_nodes):
+    prompt = make_graph(num_nodes)
+    start = time.perf_counter()
+    keys = get_keys(prompt)
+    elapsed = time.perf_counter() - start
+    logging.info(f"key generation for {num_nodes} nodes: {elapsed * 1000:.1f} ms")
+    assert len(set(keys.values())) == num_nodes
+
+
+def test_estimate_size_counts_nested_tensors():
+    latent = torch.zeros((1, 4, 8, 8), dtype=torch.float32)
+    image = torch.zeros((2, 16, 16, 3), dtype=torch.float16)
+    output = [[{"samples": latent}], [image, image], [42], ["text"]]
+    assert estimate_size(output) == latent.nbytes + image.nbytes
+
+
+def test_ram_budget_cache_evicts_old_large_entries_first():
+    cache = RAMBudgetCache(CacheKeySetInputSignature, max_bytes=1000, min_free_bytes=0)
+    prompt = {str(i): {"class_type": "TestSource", "inputs": {"value": i}} for i in range(3)}
+    cache.set_prompt(DynamicPrompt(prompt), prompt.keys(), StaticIsChangedCache())
+    cache.set("0", ([torch.zeros(100, dtype=torch.uint8)],))
+    cache.set("1", ([torch.zeros(600, dtype=torch.uint8)],))
+    cache.set("2", ([torch.zeros(200, dtype=torch.uint8)],))
+    # Everything belongs to the running prompt so nothing can be evicted yet
+    assert cache.total_bytes == 900
+
+    prompt2 = {"3": {"class_type": "TestSource", "inputs": {"value": 3}}}
+    cache.set_prompt(DynamicPrompt(prompt2), prompt2.keys(), StaticIsChangedCache())
+    cache.set("3", ([torch.zeros(500, dtype=torch.uint8)],))
+    assert cache.total_bytes == 800
+    assert len(cache.cache) == 3
+
+    cache.set_prompt(DynamicPrompt(prompt), prompt.keys(), StaticIsChangedCache())
+    assert cache.get("1") is None
+    assert cache.get("0") is not None
+    assert cache.get("2") is not None
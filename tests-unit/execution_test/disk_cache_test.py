@@ -0,0 +1,135 @@
+import os
+
+import pytest
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import folder_paths  # noqa: E402
+import nodes  # noqa: E402
+from comfy_execution.caching import CacheKeySetInputSignature, HierarchicalCache  # noqa: E402
+from comfy_execution.disk_cache import DiskCache, UnserializableOutput, serialize_output, deserialize_output  # noqa: E402
+from comfy_execution.graph import DynamicPrompt  # noqa: E402
+
+
+class EncodeNode:
+    DISK_CACHEABLE = True
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"text": ("STRING", {})}}
+
+class MemoryOnlyNode(EncodeNode):
+    DISK_CACHEABLE = False
+
+
+class LoaderNode:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"ckpt_name": (["model.safetensors"], {})}}
+
+
+class EncodeModelNode(EncodeNode):
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"text": ("STRING", {}), "model": ("MODEL", {})}}
+
+
+class StaticIsChangedCache:
+    def get(self, node_id):
+        return False
+
+
+@pytest.fixture(autouse=True)
+def test_nodes(monkeypatch):
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TestEncode", EncodeNode)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TestMemoryOnly", MemoryOnlyNode)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TestLoader", LoaderNode)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TestEncodeModel", EncodeModelNode)
+
+
+def make_cache(disk_cache, prompt):
+    cache = HierarchicalCache(CacheKeySetInputSignature, disk_cache=disk_cache)
+    cache.set_prompt(DynamicPrompt(prompt), prompt.keys(), StaticIsChangedCache())
+    return cache
+
+
+def test_round_trip_conditioning():
+    cond = torch.randn(1, 77, 768)
+    pooled = torch.randn(1, 768)
+    output = [[[[cond, {"pooled_output": pooled, "strength": 1.0}]]], [({"samples": cond},)]]
+    tensors, structure = serialize_output(output)
+    assert len(tensors) == 2
+    result = deserialize_output(tensors, structure)
+    assert torch.equal(result[0][0][0][0], cond)
+    assert torch.equal(result[0][0][0][1]["pooled_output"], pooled)
+    assert result[0][0][0][1]["strength"] == 1.0
+    assert isinstance(result[1][0], tuple)
+    assert torch.equal(result[1][0][0]["samples"], cond)
+
+
+def test_views_of_the_same_storage_are_saved_separately(tmp_path):
+    base = torch.randn(4, 8)
+    disk_cache = DiskCache(str(tmp_path), max_bytes=1024 ** 2)
+    disk_cache.set(b"\x01" * 32, [[base[:2], base[2:]]])
+    result = disk_cache.get(b"\x01" * 32)
+    assert torch.equal(result[0][0], base[:2])
+    assert torch.equal(result[0][1], base[2:])
+
+
+def test_unserializable_outputs_are_rejected():
+    with pytest.raises(UnserializableOutput):
+        serialize_output([[object()]])
+
+
+def test_outputs_survive_a_restart(tmp_path):
+    prompt = {
+        "1": {"class_type": "TestEncode", "inputs": {"text": "a cat"}},
+        "2": {"class_type": "TestMemoryOnly", "inputs": {"text": "a cat"}},
+    }
+    cond = torch.randn(1, 4)
+    cache = make_cache(DiskCache(str(tmp_path), max_bytes=1024 ** 2), prompt)
+    cache.set("1", [[cond]])
+    cache.set("2", [[cond]])
+
+    restarted = make_cache(DiskCache(str(tmp_path), max_bytes=1024 ** 2), prompt)
+    assert torch.equal(restarted.get("1")[0][0], cond)
+    assert restarted.get("2") is None
+
+
+def test_replaced_files_and_updated_nodes_miss(tmp_path, monkeypatch):
+    models = tmp_path / "checkpoints"
+    models.mkdir()
+    model_path = models / "model.safetensors"
+    model_path.write_bytes(b"a" * 16)
+    monkeypatch.setitem(folder_paths.folder_names_and_paths, "checkpoints", ([str(models)], {".safetensors"}))
+    prompt = {
+        "1": {"class_type": "TestLoader", "inputs": {"ckpt_name": "model.safetensors"}},
+        "2": {"class_type": "TestEncodeModel", "inputs": {"text": "a cat", "model": ["1", 0]}},
+    }
+    cond = torch.randn(1, 4)
+    disk_cache = DiskCache(str(tmp_path / "cache"), max_bytes=1024 ** 2)
+    make_cache(disk_cache, prompt).set("2", [[cond]])
+    assert torch.equal(make_cache(disk_cache, prompt).get("2")[0][0], cond)
+
+    # The same name for another file
+    model_path.write_bytes(b"b" * 32)
+    assert make_cache(disk_cache, prompt).get("2") is None
+    make_cache(disk_cache, prompt).set("2", [[cond]])
+    assert make_cache(disk_cache, prompt).get("2") is not None
+
+    monkeypatch.setattr(EncodeModelNode, "DISK_CACHE_VERSION", 2, raising=False)
+    assert make_cache(disk_cache, prompt).get("2") is None
+
+
+def test_size_cap_evicts_least_recently_used(tmp_path):
+    disk_cache = DiskCache(str(tmp_path), max_bytes=2048)
+    for i in range(3):
+        disk_cache.set(bytes([i]) * 32, [[torch.zeros(128)]])
+        os.utime(disk_cache._path((bytes([i]) * 32).hex()), (i, i))
+        disk_cache.entries[(bytes([i]) * 32).hex()] = (i, disk_cache.entries[(bytes([i]) * 32).hex()][1])
+    disk_cache.set(b"\x09" * 32, [[torch.zeros(256)]])
+    assert disk_cache.total_bytes <= 2048
+    assert bytes([0]) * 32 not in disk_cache
+    assert b"\x09" * 32 in disk_cache
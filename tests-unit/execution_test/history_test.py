@@ -0,0 +1,101 @@
+import time
+
+from comfy_execution.history import PromptHistory, summarize_entry
+
+
+def make_entry(number, prompt_id, filenames=(), status_str="success"):
+    return {
+        "prompt": (number, prompt_id, {"1": {"class_type": "SaveImage", "inputs": {}}}, {"client_id": "c"}, ["1"]),
+        "outputs": {"1": {"images": [{"filename": f, "subfolder": "", "type": "output"} for f in filenames]}},
+        "status": {
+            "status_str": status_str,
+            "completed": status_str == "success",
+            "messages": [("execution_start", {"prompt_id": prompt_id, "timestamp": 1000}),
+                         ("execution_success", {"prompt_id": prompt_id, "timestamp": 3500})],
+        },
+    }
+
+
+def fill(history, count):
+    for i in range(count):
+        history.add(str(i), make_entry(i, str(i)))
+
+
+def test_count_limit():
+    history = PromptHistory(max_items=5)
+    fill(history, 12)
+    assert len(history) == 5
+    assert list(history.items()) == ["7", "8", "9", "10", "11"]
+
+
+def test_byte_limit():
+    history = PromptHistory(max_items=1000, max_bytes=3000)
+    fill(history, 100)
+    assert 0 < history.total_bytes <= 3000
+    assert "99" in history
+    assert "0" not in history
+
+
+def test_offset_items():
+    history = PromptHistory()
+    fill(history, 10)
+    assert list(history.items(offset=-3)) == ["7", "8", "9"]
+    assert list(history.items(offset=2, max_items=2)) == ["2", "3"]
+
+
+def test_cursor_pages():
+    history = PromptHistory(max_items=50)
+    fill(history, 60)
+    history.remove("30")
+
+    seen = []
+    cursor = None
+    while True:
+        page, cursor = history.page(cursor=cursor, max_items=7)
+        seen += list(page)
+        if cursor is None:
+            break
+    assert seen == [str(i) for i in range(59, 9, -1) if i != 30]
+
+
+def test_cursor_stable_across_inserts():
+    history = PromptHistory()
+    fill(history, 10)
+    page, cursor = history.page(max_items=3)
+    assert list(page) == ["9", "8", "7"]
+    history.add("new", make_entry(10, "new"))
+    page, cursor = history.page(cursor=cursor, max_items=3)
+    assert list(page) == ["6", "5", "4"]
+
+
+def test_page_size_clamped():
+    history = PromptHistory()
+    fill(history, 3)
+    for max_items in (0, -2):
+        page, cursor = history.page(max_items=max_items)
+        assert list(page) == ["2"]
+        assert cursor is not None
+
+
+def test_summary():
+    summary = summarize_entry(make_entry(3, "a", filenames=["x.png", "y.png"]))
+    assert summary["number"] == 3
+    assert summary["status"] == "success"
+    assert summary["execution_time"] == 2.5
+    assert summary["client_id"] == "c"
+    assert [x["filename"] for x in summary["outputs"]] == ["x.png", "y.png"]
+
+    history = PromptHistory()
+    history.add("a", make_entry(3, "a", filenames=["x.png"]))
+    assert "prompt" not in history.items(summary=True)["a"]
+
+
+def test_page_cost_independent_of_size():
+    history = PromptHistory(max_items=100000)
+    fill(history, 100000)
+    start = time.perf_counter()
+    for _ in range(1000):
+        history.page(max_items=50)
+    elapsed = time.perf_counter() - start
+    # 1000 pages from a 100k entry history, iterating the whole history would take seconds
+    assert elapsed < 1.0
@@ -0,0 +1,217 @@
+import pytest
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.model_management  # noqa: E402
+import comfy.sample  # noqa: E402
+import nodes  # noqa: E402
+import execution  # noqa: E402
+from comfy_execution.microbatch import MicroBatch, batch_signature  # noqa: E402
+
+
+class FakeServer:
+    def __init__(self):
+        self.client_id = None
+        self.last_node_id = None
+        self.messages = []
+        self.sids = []
+
+    def send_sync(self, event, data, sid=None):
+        self.messages.append((event, data))
+        self.sids.append((event, data.get("prompt_id", None), sid))
+
+    def queue_updated(self):
+        pass
+
+
+class Calls:
+    loads = 0
+    batches = []
+
+
+class FakeLoader:
+    RETURN_TYPES = ("MODEL",)
+    FUNCTION = "load"
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"ckpt_name": ("STRING", {})}}
+
+    def load(self, ckpt_name):
+        Calls.loads += 1
+        return (object(),)
+
+
+class FakeEncode:
+    RETURN_TYPES = ("CONDITIONING",)
+    FUNCTION = "encode"
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"text": ("STRING", {})}}
+
+    def encode(self, text):
+        if text == "broken":
+            raise ValueError("broken prompt")
+        if text == "interrupted":
+            comfy.model_management.interrupt_prompt("prompt1")
+            comfy.model_management.throw_exception_if_processing_interrupted()
+        return (text,)
+
+
+class FakeSampler:
+    RETURN_TYPES = ("LATENT",)
+    FUNCTION = "sample"
+    MICROBATCH_FUNCTION = "sample_batched"
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"model": ("MODEL",), "positive": ("CONDITIONING",), "seed": ("INT", {}), "steps": ("INT", {})}}
+
+    def sample(self, model, positive, seed, steps):
+        return ("{}:{}".format(positive, seed),)
+
+    def sample_batched(self, jobs):
+        Calls.batches.append(len(jobs))
+        assert all(j["model"] is jobs[0]["model"] for j in jobs)
+        return [self.sample(**j) for j in jobs]
+
+
+class FakeOutput:
+    OUTPUT_NODE = True
+    RETURN_TYPES = ()
+    FUNCTION = "save"
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"samples": ("LATENT",)}}
+
+    def save(self, samples):
+        return {"ui": {"samples": [samples]}}
+
+
+@pytest.fixture(autouse=True)
+def test_nodes(monkeypatch):
+    for name, node in [("FakeLoader", FakeLoader), ("FakeEncode", FakeEncode), ("FakeSampler", FakeSampler), ("FakeOutput", FakeOutput)]:
+        monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, name, node)
+    Calls.loads = 0
+    Calls.batches = []
+
+
+def make_item(number, text, seed, steps=20, ckpt_name="model.safetensors", client_id="client"):
+    prompt = {
+        "1": {"class_type": "FakeLoader", "inputs": {"ckpt_name": ckpt_name}},
+        "2": {"class_type": "FakeEncode", "inputs": {"text": text}},
+        "3": {"class_type": "FakeSampler", "inputs": {"model": ["1", 0], "positive": ["2", 0], "seed": seed, "steps": steps}},
+        "4": {"class_type": "FakeOutput", "inputs": {"samples": ["3", 0]}},
+    }
+    return (number, "prompt{}".format(number), prompt, {"client_id": client_id}, ["4"])
+
+
+def test_batch_signature():
+    first = batch_signature(make_item(0, "a cat", 1))
+    assert first is not None
+    assert batch_signature(make_item(1, "a dog", 2)) == first
+    assert batch_signature(make_item(2, "a cat", 1, steps=30)) != first
+    assert batch_signature(make_item(3, "a cat", 1, ckpt_name="other.safetensors")) != first
+    assert batch_signature(make_item(5, "a cat", 1, client_id="other")) == first
+    no_sampler = make_item(4, "a cat", 1)
+    del no_sampler[2]["3"], no_sampler[2]["4"]
+    assert batch_signature(no_sampler) is None
+
+
+def test_queue_takes_compatible_prompts():
+    q = execution.PromptQueue(FakeServer())
+    for item in [make_item(0, "a cat", 1), make_item(1, "a dog", 2), make_item(2, "a bird", 3), make_item(3, "a cat", 1, steps=30), make_item(4, "a fish", 4)]:
+        q.put(item)
+    item, _ = q.get(timeout=0)
+    batch = q.get_microbatch(item, 1)
+    assert [i[1] for i, _ in batch] == ["prompt1"]
+    # prompt3 can't join the batch, prompt4 doesn't get to skip it
+    assert [i[1] for i, _ in q.get_microbatch(item, 4)] == ["prompt2"]
+    assert q.get_tasks_remaining() == 5
+    assert len(q.queue) == 2
+
+
+def test_microbatch_follows_the_scheduler():
+    q = execution.PromptQueue(FakeServer())
+    q.register_worker(0, "cuda:0")
+    q.set_scheduler_options(max_in_flight=2)
+    urgent = make_item(3, "a dog", 2, steps=30, client_id="other")
+    urgent[3]["priority"] = "high"
+    low = make_item(1, "a bird", 3)
+    low[3]["priority"] = "low"
+    for queued in [make_item(0, "a cat", 1), low, make_item(2, "a fish", 4), urgent]:
+        q.put(queued)
+    item, _ = q.get(timeout=0, worker_id=0)
+    assert item[1] == "prompt3"
+    item, _ = q.get(timeout=0, worker_id=0)
+    assert item[1] == "prompt0"
+    # prompt2 comes before the low priority prompt1, then the client reaches its in-flight limit
+    assert [i[1] for i, _ in q.get_microbatch(item, 4, worker_id=0)] == ["prompt2"]
+    assert [worker["prompt_id"] for worker in q.get_worker_states()] == ["prompt0"]
+
+
+def test_batched_execution():
+    server = FakeServer()
+    batch = MicroBatch([make_item(0, "a cat", 1), make_item(1, "a dog", 2), make_item(2, "a bird", 3)])
+    executor = execution.PromptExecutor(server)
+    results = executor.execute_microbatch(batch)
+    histories = [history for history, _, _ in results]
+    messages = [member for _, member, _ in results]
+    assert executor.success
+    assert all(success for _, _, success in results)
+    assert Calls.loads == 1
+    assert Calls.batches == [3]
+    assert [h["outputs"] for h in histories] == [{"4": {"samples": ["a cat:1"]}}, {"4": {"samples": ["a dog:2"]}}, {"4": {"samples": ["a bird:3"]}}]
+    assert histories[1]["meta"]["4"]["node_id"] == "4"
+    for index, member in enumerate(messages):
+        assert all(data["prompt_id"] == "prompt{}".format(index) for _, data in member)
+        assert "execution_success" in [event for event, _ in member]
+    executed = [(data["prompt_id"], data["node"]) for event, data in server.messages if event == "executed"]
+    assert ("prompt1", "4") in executed
+
+
+def test_messages_go_to_each_client():
+    server = FakeServer()
+    batch = MicroBatch([make_item(0, "a cat", 1, client_id="a"), make_item(1, "a dog", 2, client_id="b")])
+    executor = execution.PromptExecutor(server)
+    executor.execute_microbatch(batch)
+    sids = set((prompt_id, sid) for event, prompt_id, sid in server.sids if event == "executed")
+    assert sids == {("prompt0", "a"), ("prompt1", "b")}
+
+
+def test_failure_stays_in_its_prompt():
+    batch = MicroBatch([make_item(0, "a cat", 1), make_item(1, "broken", 2), make_item(2, "a bird", 3)])
+    executor = execution.PromptExecutor(FakeServer())
+    results = executor.execute_microbatch(batch)
+    assert not executor.success
+    assert [success for _, _, success in results] == [True, False, True]
+    assert results[0][0]["outputs"] == {"4": {"samples": ["a cat:1"]}}
+    assert results[2][0]["outputs"] == {"4": {"samples": ["a bird:3"]}}
+    assert "execution_error" in [event for event, _ in results[1][1]]
+    assert Calls.loads == 1
+
+
+def test_interrupt_stays_in_its_prompt():
+    batch = MicroBatch([make_item(0, "a cat", 1), make_item(1, "interrupted", 2), make_item(2, "a bird", 3)])
+    executor = execution.PromptExecutor(FakeServer())
+    results = executor.execute_microbatch(batch)
+    assert [success for _, _, success in results] == [True, False, True]
+    assert "execution_interrupted" in [event for event, _ in results[1][1]]
+    assert comfy.model_management.get_interrupted_prompts(["prompt0", "prompt1", "prompt2"]) == set()
+
+
+def test_batch_conditioning():
+    a = [[torch.ones(1, 77, 8), {"pooled_output": torch.ones(1, 4)}]]
+    b = [[torch.zeros(1, 77, 8), {"pooled_output": torch.zeros(1, 4)}]]
+    batched = comfy.sample.batch_conditioning([a, b], [2, 1])
+    assert batched[0][0].shape == (3, 77, 8)
+    assert batched[0][1]["pooled_output"].shape == (3, 4)
+    assert torch.equal(batched[0][0][2], torch.zeros(77, 8))
+    longer = [[torch.zeros(1, 154, 8), {"pooled_output": torch.zeros(1, 4)}]]
+    assert comfy.sample.batch_conditioning([a, longer], [1, 1]) is None
+    other_options = [[torch.zeros(1, 77, 8), {"pooled_output": torch.zeros(1, 4), "strength": 0.5}]]
+    assert comfy.sample.batch_conditioning([a, other_options], [1, 1]) is None
@@ -0,0 +1,241 @@
+import threading
+import time
+
+import pytest
+
+from comfy.cli_args import args
+args.cpu = True
+
+import torch  # noqa: E402
+
+import comfy.model_management  # noqa: E402
+import nodes  # noqa: E402
+import execution  # noqa: E402
+from comfy_execution.graph_utils import GraphBuilder  # noqa: E402
+
+
+class FakeServer:
+    def __init__(self):
+        self.client_id = None
+        self.last_node_id = None
+        self.messages = []
+
+    def send_sync(self, event, data, sid=None):
+        self.messages.append((event, data))
+
+
+class Tracker:
+    lock = threading.Lock()
+    running = {}
+    max_running = {}
+
+    @classmethod
+    def reset(cls):
+        cls.running = {"io": 0, "gpu": 0}
+        cls.max_running = {"io": 0, "gpu": 0}
+
+    @classmethod
+    def run(cls, resource, duration):
+        with cls.lock:
+            cls.running[resource] += 1
+            cls.max_running[resource] = max(cls.max_running[resource], cls.running[resource])
+        time.sleep(duration)
+        with cls.lock:
+            cls.running[resource] -= 1
+
+
+class SlowLoad:
+    EXECUTION_RESOURCE = "io"
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "load"
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"value": ("INT", {})}}
+
+    def load(self, value):
+        Tracker.run("io", 0.2)
+        return (value,)
+
+class SlowGpu:
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "compute"
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"value": ("INT", {})}}
+
+    def compute(self, value):
+        Tracker.run("gpu", 0.2)
+        return (value * 2,)
+
+class Failing:
+    EXECUTION_RESOURCE = "cpu"
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "fail"
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"value": ("INT", {})}}
+
+    def fail(self, value):
+        raise ValueError("failed on purpose")
+
+class FailAfterInterrupt(Failing):
+    def fail(self, value):
+        # A user interrupt of another prompt arriving while this one fails
+        nodes.interrupt_processing(True)
+        raise ValueError("failed on purpose")
+
+class WorkerState:
+    EXECUTION_RESOURCE = "cpu"
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "record"
+    seen = []
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"value": ("INT", {})}}
+
+    def record(self, value):
+        WorkerState.seen.append((threading.current_thread().name, comfy.model_management.get_torch_device(), execution.worker_context.server))
+        return (value,)
+
+class Expand:
+    EXECUTION_RESOURCE = "cpu"
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "expand"
+    prefixes = []
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"value": ("INT", {})}}
+
+    def expand(self, value):
+        # Let the other expanding node set its prefix in the meantime
+        time.sleep(0.2)
+        graph = GraphBuilder()
+        Expand.prefixes.append(graph.prefix)
+        node = graph.node("SlowGpu", value=value)
+        return {"result": (node.out(0),), "expand": graph.finalize()}
+
+class Sum:
+    OUTPUT_NODE = True
+    RETURN_TYPES = ()
+    FUNCTION = "sum"
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"a": ("INT", {}), "b": ("INT", {}), "c": ("INT", {})}}
+
+    def sum(self, a, b, c):
+        return {"ui": {"total": [a + b + c]}}
+
+
+@pytest.fixture(autouse=True)
+def test_nodes(monkeypatch):
+    for name, node in [("SlowLoad", SlowLoad), ("SlowGpu", SlowGpu), ("Failing", Failing), ("FailAfterInterrupt", FailAfterInterrupt), ("WorkerState", WorkerState), ("Expand", Expand), ("Sum", Sum)]:
+        monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, name, node)
+    Tracker.reset()
+
+
+def make_prompt(third="SlowLoad"):
+    return {
+        "1": {"class_type": "SlowLoad", "inputs": {"value": 1}},
+        "2": {"class_type": "SlowLoad", "inputs": {"value": 2}},
+        "3": {"class_type": third, "inputs": {"value": 3}},
+        "4": {"class_type": "SlowGpu", "inputs": {"value": ["1", 0]}},
+        "5": {"class_type": "SlowGpu", "inputs": {"value": ["2", 0]}},
+        "6": {"class_type": "Sum", "inputs": {"a": ["4", 0], "b": ["5", 0], "c": ["3", 0]}},
+    }
+
+
+def test_independent_branches_overlap():
+    executor = execution.PromptExecutor(FakeServer(), max_workers=4)
+    executor.execute(make_prompt(), "prompt", {}, ["6"])
+    assert executor.success
+    assert executor.history_result["outputs"]["6"]["total"] == [2 + 4 + 3]
+    assert Tracker.max_running["io"] > 1
+    # Nodes that didn't declare a resource are never executed at the same time
+    assert Tracker.max_running["gpu"] == 1
+
+
+def test_matches_serial_execution():
+    serial = execution.PromptExecutor(FakeServer())
+    serial.execute(make_prompt(), "prompt", {}, ["6"])
+    parallel = execution.PromptExecutor(FakeServer(), max_workers=4)
+    parallel.execute(make_prompt(), "prompt", {}, ["6"])
+    assert serial.history_result == parallel.history_result
+
+
+def test_failure_is_reported():
+    server = FakeServer()
+    executor = execution.PromptExecutor(server, max_workers=4)
+    executor.execute(make_prompt(third="Failing"), "prompt", {}, ["6"])
+    assert not executor.success
+    errors = [data for event, data in executor.status_messages if event == "execution_error"]
+    assert len(errors) == 1
+    assert errors[0]["node_id"] == "3"
+    assert "execution_success" not in [event for event, _ in executor.status_messages]
+
+
+def test_failure_leaves_global_interrupt_alone():
+    executor = execution.PromptExecutor(FakeServer(), max_workers=4)
+    try:
+        prompt = {
+            "1": {"class_type": "FailAfterInterrupt", "inputs": {"value": 1}},
+            "2": {"class_type": "Sum", "inputs": {"a": ["1", 0], "b": 0, "c": 0}},
+        }
+        executor.execute(prompt, "prompt", {}, ["2"])
+        assert not executor.success
+        assert comfy.model_management.processing_interrupted()
+    finally:
+        nodes.interrupt_processing(False)
+
+
+def test_concurrent_expansions_get_their_own_ids():
+    prompt = {
+        "1": {"class_type": "Expand", "inputs": {"value": 1}},
+        "2": {"class_type": "Expand", "inputs": {"value": 2}},
+        "3": {"class_type": "Sum", "inputs": {"a": ["1", 0], "b": ["2", 0], "c": 0}},
+    }
+    Expand.prefixes = []
+    executor = execution.PromptExecutor(FakeServer(), max_workers=4)
+    executor.execute(prompt, "prompt", {}, ["3"])
+    assert executor.success
+    assert executor.history_result["outputs"]["3"]["total"] == [2 + 4]
+    # Each expansion is prefixed by the id of the node that expanded
+    assert sorted(Expand.prefixes) == ["1.0.0.", "2.0.0."]
+
+
+def test_cycle_is_reported():
+    prompt = {
+        "1": {"class_type": "SlowGpu", "inputs": {"value": ["2", 0]}},
+        "2": {"class_type": "SlowGpu", "inputs": {"value": ["1", 0]}},
+        "3": {"class_type": "Sum", "inputs": {"a": ["1", 0], "b": 0, "c": 0}},
+    }
+    executor = execution.PromptExecutor(FakeServer(), max_workers=4)
+    executor.execute(prompt, "prompt", {}, ["3"])
+    errors = [data for event, data in executor.status_messages if event == "execution_error"]
+    assert len(errors) == 1
+    assert "cycle" in errors[0]["exception_message"]
+
+
+def test_pool_threads_inherit_worker_context():
+    server = FakeServer()
+    worker_view = FakeServer()
+    device = torch.device("cpu", 1)
+    prompt = make_prompt(third="WorkerState")
+    WorkerState.seen = []
+
+    def worker():
+        comfy.model_management.set_thread_torch_device(device)
+        execution.worker_context.server = worker_view
+        executor = execution.PromptExecutor(server, max_workers=4)
+        executor.execute(prompt, "prompt", {}, ["6"])
+        assert executor.success
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    assert [(name.startswith("node_worker"), seen_device, seen_server) for name, seen_device, seen_server in WorkerState.seen] == [(True, device, worker_view)]
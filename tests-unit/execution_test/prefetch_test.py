@@ -0,0 +1,141 @@
+import os
+import time
+
+import pytest
+import safetensors.torch
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.utils  # noqa: E402
+import execution  # noqa: E402
+import folder_paths  # noqa: E402
+import nodes  # noqa: E402
+from comfy_execution.prefetch import ModelPrefetcher, get_model_files  # noqa: E402
+
+
+@pytest.fixture
+def models(tmp_path, monkeypatch):
+    files = {}
+    for i, name in enumerate(["a.safetensors", "b.safetensors", "c.ckpt"]):
+        path = os.path.join(tmp_path, name)
+        sd = {"weight": torch.full((256, 256), float(i))}
+        safetensors.torch.save_file(sd, path)
+        files[name] = (path, sd)
+
+    def get_full_path(folder_name, filename):
+        path = os.path.join(tmp_path, filename)
+        return path if folder_name == "checkpoints" and os.path.exists(path) else None
+    listed = []
+    monkeypatch.setattr(folder_paths, "get_full_path", get_full_path)
+    monkeypatch.setattr(folder_paths, "get_filename_list", lambda folder_name: listed.append(folder_name) or [])
+    files["listed"] = listed
+    return files
+
+
+def item(number, *ckpt_names):
+    prompt = {str(i): {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": name}} for i, name in enumerate(ckpt_names)}
+    return (number, "prompt{}".format(number), prompt, {}, [])
+
+
+def wait_for(condition, timeout=10):
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def prefetcher():
+    p = ModelPrefetcher(1024 ** 3)
+    p.start()
+    yield p
+    p.stop()
+
+
+def test_model_files(models):
+    assert get_model_files(item(0, "a.safetensors", "c.ckpt", "missing.safetensors")) == [models["a.safetensors"][0]]
+
+
+def test_stages_next_prompt(models, prefetcher, monkeypatch):
+    path, sd = models["a.safetensors"]
+    prefetcher.queue_changed([], [item(1, "a.safetensors")])
+    wait_for(lambda: path in prefetcher.staged)
+    assert "checkpoints" in models["listed"]
+
+    monkeypatch.setattr(comfy.utils, "LOAD_TORCH_FILE_HOOK", prefetcher.take)
+    # The prompt starts running: what it needs stays staged
+    prefetcher.queue_changed([item(1, "a.safetensors")], [])
+    loaded = comfy.utils.load_torch_file(path)
+    assert torch.equal(loaded["weight"], sd["weight"])
+    assert prefetcher.get_stats()["hits"] == 1
+    assert prefetcher.staged_bytes == 0
+
+
+def test_dropped_when_queue_changes(models, prefetcher):
+    path = models["a.safetensors"][0]
+    prefetcher.queue_changed([], [item(1, "a.safetensors")])
+    wait_for(lambda: path in prefetcher.staged)
+    prefetcher.queue_changed([], [])
+    assert path not in prefetcher.staged
+    assert prefetcher.take(path) is None
+
+
+def test_ram_budget(models):
+    a, b = models["a.safetensors"][0], models["b.safetensors"][0]
+    prefetcher = ModelPrefetcher(int(os.path.getsize(a) * 1.5), lookahead=2)
+    prefetcher.start()
+    try:
+        prefetcher.queue_changed([], [item(1, "a.safetensors"), item(2, "b.safetensors")])
+        wait_for(lambda: a in prefetcher.staged)
+        time.sleep(0.1)
+        assert b not in prefetcher.staged
+        # Using the first file makes room for the second one
+        assert prefetcher.take(a) is not None
+        wait_for(lambda: b in prefetcher.staged)
+    finally:
+        prefetcher.stop()
+
+
+def test_modified_file_not_used(models, prefetcher):
+    path = models["a.safetensors"][0]
+    prefetcher.queue_changed([], [item(1, "a.safetensors")])
+    wait_for(lambda: path in prefetcher.staged)
+    safetensors.torch.save_file({"weight": torch.zeros(4)}, path)
+    os.utime(path, ns=(0, 0))
+    assert prefetcher.take(path) is None
+
+
+class FakeLoader:
+    RETURN_TYPES = ("MODEL",)
+    FUNCTION = "load"
+    OUTPUT_NODE = True
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"ckpt_name": ("STRING", {})}}
+
+    def load(self, ckpt_name):
+        return (ckpt_name,)
+
+
+class FakeServer:
+    client_id = None
+    last_node_id = None
+
+    def send_sync(self, event, data, sid=None):
+        pass
+
+
+def test_cached_loaders_are_skipped(models, monkeypatch):
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "CheckpointLoaderSimple", FakeLoader)
+    executor = execution.PromptExecutor(FakeServer())
+    executed = item(0, "a.safetensors")
+    executor.execute(executed[2], executed[1], {}, ["0"])
+    assert executor.success
+
+    upcoming = item(1, "b.safetensors", "a.safetensors")
+    assert executor.is_output_cached(upcoming[2], "1")
+    assert not executor.is_output_cached(upcoming[2], "0")
+    assert get_model_files(upcoming, executor.is_output_cached) == [models["b.safetensors"][0]]
@@ -0,0 +1,139 @@
+import threading
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.model_management  # noqa: E402
+import execution  # noqa: E402
+
+
+class FakeServer:
+    def __init__(self):
+        self.updates = 0
+
+    def queue_updated(self):
+        self.updates += 1
+
+
+def make_item(number, prompt_id):
+    return (number, prompt_id, {}, {}, [])
+
+
+def test_single_worker_unchanged():
+    q = execution.PromptQueue(FakeServer())
+    q.put(make_item(0, "a"))
+    item, item_id = q.get(timeout=0)
+    assert item[1] == "a"
+    assert q.get_worker_states() == []
+    q.set_flag("free_memory", True)
+    assert q.get_flags() == {"free_memory": True}
+    assert q.get_flags() == {}
+    q.task_done(item_id, {}, None)
+    assert "a" in q.get_history()
+
+
+def test_worker_states():
+    q = execution.PromptQueue(FakeServer())
+    q.register_worker(0, "cuda:0")
+    q.register_worker(1, "cuda:1")
+    q.put(make_item(0, "a"))
+    q.put(make_item(1, "b"))
+
+    _, id_a = q.get(timeout=0, worker_id=0)
+    _, id_b = q.get(timeout=0, worker_id=1)
+    states = {w["worker"]: w for w in q.get_worker_states()}
+    assert states[0]["prompt_id"] == "a"
+    assert states[0]["device"] == "cuda:0"
+    assert states[1]["prompt_id"] == "b"
+    assert len(q.get_current_queue()[0]) == 2
+
+    q.task_done(id_a, {}, None)
+    states = {w["worker"]: w for w in q.get_worker_states()}
+    assert states[0]["prompt_id"] is None
+    assert states[0]["started"] is None
+    assert states[1]["prompt_id"] == "b"
+
+
+def test_flags_reach_every_worker():
+    q = execution.PromptQueue(FakeServer())
+    q.register_worker(0)
+    q.register_worker(1)
+    q.set_flag("unload_models", True)
+    assert q.get_flags(worker_id=0) == {"unload_models": True}
+    assert q.get_flags(worker_id=0) == {}
+    assert q.get_flags(worker_id=1) == {"unload_models": True}
+
+
+def test_workers_share_queue():
+    q = execution.PromptQueue(FakeServer())
+    for worker_id in range(4):
+        q.register_worker(worker_id)
+    for i in range(100):
+        q.put(make_item(i, str(i)))
+
+    taken = []
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        while True:
+            queue_item = q.get(timeout=0, worker_id=worker_id)
+            if queue_item is None:
+                return
+            item, item_id = queue_item
+            with lock:
+                taken.append(item[1])
+            q.task_done(item_id, {}, None)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(taken, key=int) == [str(i) for i in range(100)]
+    assert q.get_tasks_remaining() == 0
+    assert len(q.get_history()) == 100
+
+
+def test_device_busy():
+    q = execution.PromptQueue(FakeServer())
+    q.register_worker(0, "cuda:0")
+    q.register_worker(1, "cuda:0")
+    q.register_worker(2, "cuda:1")
+    q.put(make_item(0, "a"))
+    _, item_id = q.get(timeout=0, worker_id=1)
+    assert q.device_busy(0)
+    assert not q.device_busy(1)
+    assert not q.device_busy(2)
+    q.task_done(item_id, {}, None)
+    assert not q.device_busy(0)
+
+
+def test_interrupts_stop_only_their_prompt():
+    q = execution.PromptQueue(FakeServer())
+    q.register_worker(0)
+    q.register_worker(1)
+    q.put(make_item(0, "a"))
+    q.put(make_item(1, "b"))
+    q.get(timeout=0, worker_id=0)
+    q.get(timeout=0, worker_id=1)
+    assert sorted(q.get_running_prompt_ids()) == ["a", "b"]
+
+    comfy.model_management.interrupt_prompt("b")
+    stopped = {}
+
+    def worker(prompt_id):
+        with execution.prompt_interrupt_scope([prompt_id]):
+            try:
+                comfy.model_management.throw_exception_if_processing_interrupted()
+                stopped[prompt_id] = False
+            except comfy.model_management.InterruptProcessingException:
+                stopped[prompt_id] = True
+
+    threads = [threading.Thread(target=worker, args=(prompt_id,)) for prompt_id in ("a", "b")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert stopped == {"a": False, "b": True}
+    assert comfy.model_management.get_interrupted_prompts(["b"]) == set()
@@ -0,0 +1,154 @@
+import time
+
+from comfy.cli_args import args
+args.cpu = True
+
+import execution  # noqa: E402
+import comfy_execution.queue_store  # noqa: E402
+from comfy_execution.queue_store import SQLiteQueueStore  # noqa: E402
+
+
+class FakeServer:
+    def __init__(self):
+        self.number = 0
+
+    def queue_updated(self):
+        pass
+
+
+def make_item(number, prompt_id, client_id="c"):
+    return (number, prompt_id, {"1": {"class_type": "SaveImage", "inputs": {"x": 1.5}}}, {"client_id": client_id}, ["1"])
+
+
+def finish(q, timestamp, status_str="success"):
+    item, item_id = q.get(timeout=0)
+    messages = [("execution_start", {"prompt_id": item[1], "timestamp": timestamp}),
+                ("execution_success" if status_str == "success" else "execution_error", {"prompt_id": item[1], "timestamp": timestamp + 10})]
+    status = execution.PromptQueue.ExecutionStatus(status_str=status_str, completed=status_str == "success", messages=messages)
+    q.task_done(item_id, {"outputs": {"1": {"images": [{"filename": item[1] + ".png", "subfolder": "", "type": "output"}]}}}, status=status)
+
+
+def test_restore_queue_and_history(tmp_path):
+    path = str(tmp_path / "queue.db")
+    store = SQLiteQueueStore(path)
+    q = execution.PromptQueue(FakeServer(), store=store)
+    for i in range(5):
+        q.put(make_item(i, "p{}".format(i)))
+    finish(q, 1000)
+    finish(q, 2000, status_str="error")
+    q.get(timeout=0)  # Running when the server goes down, must be queued again
+    q.delete_queue_item(lambda x: x[1] == "p4")
+    store.close()
+
+    server = FakeServer()
+    q = execution.PromptQueue(server, store=SQLiteQueueStore(path))
+    assert [x[1] for x in sorted(q.queue)] == ["p2", "p3"]
+    assert list(q.get_history()) == ["p0", "p1"]
+    entry = q.get_history(prompt_id="p0")["p0"]
+    assert entry["prompt"] == make_item(0, "p0")
+    assert entry["status"]["messages"][0] == ("execution_start", {"prompt_id": "p0", "timestamp": 1000})
+    assert server.number == 4
+
+
+def test_query_history(tmp_path):
+    store = SQLiteQueueStore(str(tmp_path / "queue.db"))
+    q_store = execution.PromptQueue(FakeServer(), store=store)
+    q_memory = execution.PromptQueue(FakeServer())
+    for q in (q_store, q_memory):
+        for i in range(10):
+            q.put(make_item(i, "p{}".format(i), client_id="a" if i % 2 == 0 else "b"))
+        for i in range(10):
+            finish(q, 1000 * i, status_str="success" if i < 8 else "error")
+    store.flush()
+
+    for q in (q_store, q_memory):
+        assert list(q.query_history(client_id="a")) == ["p8", "p6", "p4", "p2", "p0"]
+        assert list(q.query_history(status="error")) == ["p9", "p8"]
+        assert list(q.query_history(since=3000, until=6000)) == ["p5", "p4", "p3"]
+        assert list(q.query_history(client_id="b", max_items=2)) == ["p9", "p7"]
+        summary = q.query_history(status="error", client_id="b", summary=True)
+        assert summary["p9"]["outputs"][0]["filename"] == "p9.png"
+
+
+def test_query_sees_pending_writes(tmp_path, monkeypatch):
+    store = SQLiteQueueStore(str(tmp_path / "queue.db"), batch_interval=1.0)
+    q = execution.PromptQueue(FakeServer(), store=store)
+    for i in range(3):
+        q.put(make_item(i, "p{}".format(i)))
+        finish(q, 1000 * i)
+    q.delete_history_item("p1")
+    assert list(q.query_history()) == ["p2", "p0"]
+
+    def decode_entry(entry):
+        raise AssertionError("summaries are read from their own column")
+    monkeypatch.setattr(comfy_execution.queue_store, "decode_entry", decode_entry)
+    assert q.query_history(summary=True)["p2"]["outputs"][0]["filename"] == "p2.png"
+
+
+def test_history_limit_and_wipe(tmp_path):
+    path = str(tmp_path / "queue.db")
+    store = SQLiteQueueStore(path, max_history_items=3)
+    q = execution.PromptQueue(FakeServer(), max_history_items=3, store=store)
+    for i in range(6):
+        q.put(make_item(i, "p{}".format(i)))
+        finish(q, i)
+    store.flush()
+    assert [x[0] for x in store.load_history()] == ["p3", "p4", "p5"]
+
+    q.delete_history_item("p4")
+    q.put(make_item(6, "p6"))
+    q.wipe_queue()
+    store.flush()
+    assert [x[0] for x in store.load_history()] == ["p3", "p5"]
+    assert store.load_queue() == []
+
+    q.wipe_history()
+    store.close()
+    assert SQLiteQueueStore(path).load_history() == []
+
+
+def test_writes_off_the_hot_path(tmp_path):
+    store = SQLiteQueueStore(str(tmp_path / "queue.db"))
+    q = execution.PromptQueue(FakeServer(), store=store)
+    start = time.perf_counter()
+    for i in range(2000):
+        q.put(make_item(i, "p{}".format(i)))
+    elapsed = time.perf_counter() - start
+    store.flush()
+    assert len(store.load_queue()) == 2000
+    # One commit per put would take seconds
+    assert elapsed < 1.0
+
+
+def test_api_tokens_not_persisted(tmp_path):
+    path = str(tmp_path / "queue.db")
+    store = SQLiteQueueStore(path)
+    q = execution.PromptQueue(FakeServer(), store=store)
+    for i in range(2):
+        item = make_item(i, "p{}".format(i))
+        item[3]["auth_token_comfy_org"] = "secret"
+        q.put(item)
+    finish(q, 1000)
+    # The running prompt still has its token
+    assert q.get(timeout=0)[0][3]["auth_token_comfy_org"] == "secret"
+    store.close()
+    with open(path, "rb") as f:
+        assert b"secret" not in f.read()
+    store = SQLiteQueueStore(path)
+    assert store.load_queue()[0][3] == {"client_id": "c"}
+    assert store.load_history()[0][1]["prompt"][3] == {"client_id": "c"}
+
+
+def test_database_without_summaries(tmp_path):
+    import sqlite3
+    path = str(tmp_path / "queue.db")
+    connection = sqlite3.connect(path)
+    connection.executescript(comfy_execution.queue_store.SCHEMA.replace(",\n    summary TEXT", ""))
+    connection.close()
+    store = SQLiteQueueStore(path)
+    q = execution.PromptQueue(FakeServer(), store=store)
+    q.put(make_item(0, "p0"))
+    finish(q, 1000)
+    with store.lock:
+        store.connection.execute("UPDATE history SET summary = NULL")
+    assert q.query_history(summary=True)["p0"]["outputs"][0]["filename"] == "p0.png"
@@ -0,0 +1,142 @@
+from comfy.cli_args import args
+args.cpu = True
+
+import execution  # noqa: E402
+from comfy_execution.scheduling import QueueScheduler, parse_scheduler_options  # noqa: E402
+
+
+class FakeServer:
+    def queue_updated(self):
+        pass
+
+
+def make_item(number, prompt_id, client_id, priority=None):
+    extra_data = {"client_id": client_id}
+    if priority is not None:
+        extra_data["priority"] = priority
+    return (number, prompt_id, {}, extra_data, [])
+
+
+def drain(q):
+    out = []
+    while True:
+        queue_item = q.get(timeout=0)
+        if queue_item is None:
+            return out
+        item, item_id = queue_item
+        out.append(item[1])
+        q.task_done(item_id, {}, None)
+
+
+def test_default_order_unchanged():
+    q = execution.PromptQueue(FakeServer())
+    for i, number in enumerate([3, 1, -5, 2]):
+        q.put(make_item(number, "p{}".format(i), "a"))
+    assert drain(q) == ["p2", "p1", "p3", "p0"]
+
+
+def test_priority_classes():
+    q = execution.PromptQueue(FakeServer())
+    q.put(make_item(0, "low", "a", "low"))
+    q.put(make_item(1, "normal", "a"))
+    q.put(make_item(2, "high", "a", "high"))
+    q.put(make_item(3, "bogus", "a", "bogus"))
+    assert drain(q) == ["high", "normal", "bogus", "low"]
+    stats = q.get_scheduler_stats()["wait_times"]
+    assert stats["high"]["count"] == 1
+    assert stats["normal"]["count"] == 2
+    assert stats["low"]["p95"] is not None
+
+
+def test_fair_share():
+    q = execution.PromptQueue(FakeServer(), scheduler=QueueScheduler(fair_share=True))
+    for i in range(5):
+        q.put(make_item(i, "batch{}".format(i), "batch"))
+    q.put(make_item(5, "ui0", "ui"))
+    q.put(make_item(6, "ui1", "ui"))
+    order = drain(q)
+    assert order[:4] == ["batch0", "ui0", "batch1", "ui1"]
+    assert order[4:] == ["batch2", "batch3", "batch4"]
+
+
+def test_upcoming_follows_selection():
+    scheduler = QueueScheduler(fair_share=True)
+    q = execution.PromptQueue(FakeServer(), scheduler=scheduler)
+    for i in range(3):
+        q.put(make_item(i, "batch{}".format(i), "batch"))
+    q.put(make_item(3, "ui0", "ui"))
+    q.put(make_item(4, "urgent", "ui", "high"))
+    upcoming = [item[1] for item in scheduler.upcoming(q.queue, 3)]
+    assert upcoming == ["urgent", "batch0", "ui0"]
+    # No side effects
+    assert drain(q)[:3] == upcoming
+
+
+def test_max_in_flight():
+    q = execution.PromptQueue(FakeServer(), scheduler=QueueScheduler(max_in_flight=1))
+    q.put(make_item(0, "a0", "a"))
+    q.put(make_item(1, "a1", "a"))
+    q.put(make_item(2, "b0", "b"))
+
+    first, first_id = q.get(timeout=0)
+    second, second_id = q.get(timeout=0)
+    assert (first[1], second[1]) == ("a0", "b0")
+    # a already has a prompt running
+    assert q.get(timeout=0) is None
+
+    q.task_done(first_id, {}, None)
+    third, _ = q.get(timeout=0)
+    assert third[1] == "a1"
+
+
+def test_set_scheduler_options():
+    q = execution.PromptQueue(FakeServer())
+    q.set_scheduler_options(fair_share=True, max_in_flight=2)
+    stats = q.get_scheduler_stats()
+    assert stats["fair_share"] is True
+    assert stats["max_in_flight_per_client"] == 2
+
+
+def make_model_item(number, prompt_id, ckpt_name, lora_name=None):
+    prompt = {"1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": ckpt_name}}}
+    if lora_name is not None:
+        prompt["2"] = {"class_type": "LoraLoader", "inputs": {"lora_name": lora_name, "model": ["1", 0], "strength_model": 1.0}}
+    return (number, prompt_id, prompt, {"client_id": "a"}, [])
+
+
+def test_model_affinity():
+    q = execution.PromptQueue(FakeServer(), scheduler=QueueScheduler(model_affinity_window=4))
+    for i, ckpt_name in enumerate(["a", "b", "a", "b", "a", "b"]):
+        q.put(make_model_item(i, "p{}".format(i), ckpt_name))
+    assert drain(q) == ["p0", "p2", "p4", "p1", "p3", "p5"]
+    stats = q.get_scheduler_stats()["model_affinity"]
+    assert stats["reordered"] == 2
+    assert stats["model_loads_saved"] == 2
+
+
+def test_model_affinity_bounded():
+    window = 3
+    q = execution.PromptQueue(FakeServer(), scheduler=QueueScheduler(model_affinity_window=window))
+    q.put(make_model_item(0, "first", "a"))
+    q.put(make_model_item(1, "other", "b"))
+    for i in range(20):
+        q.put(make_model_item(i + 2, "a{}".format(i), "a"))
+    order = drain(q)
+    assert order.index("other") <= window + 1
+
+
+def test_model_affinity_default_off():
+    q = execution.PromptQueue(FakeServer())
+    for i, ckpt_name in enumerate(["a", "b", "a"]):
+        q.put(make_model_item(i, "p{}".format(i), ckpt_name))
+    assert drain(q) == ["p0", "p1", "p2"]
+
+
+def test_parse_scheduler_options():
+    assert parse_scheduler_options({"fair_share": True, "max_in_flight_per_client": 2, "model_affinity_window": 0}) == (
+        {"fair_share": True, "max_in_flight": 2, "model_affinity_window": 0}, [])
+    options, invalid = parse_scheduler_options({"fair_share": "yes", "max_in_flight_per_client": -1, "model_affinity_window": 4})
+    assert options == {"model_affinity_window": 4}
+    assert invalid == ["fair_share", "max_in_flight_per_client"]
+    assert parse_scheduler_options({"max_in_flight_per_client": True}) == ({}, ["max_in_flight_per_client"])
+    assert parse_scheduler_options("fair") == ({}, ["scheduler"])
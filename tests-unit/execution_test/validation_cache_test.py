@@ -0,0 +1,177 @@
+import pytest
+
+from comfy.cli_args import args
+args.cpu = True
+
+import nodes  # noqa: E402
+import execution  # noqa: E402
+
+
+class Counter:
+    input_types_calls = 0
+    validate_calls = 0
+
+
+class Source:
+    RETURN_TYPES = ("INT",)
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        Counter.input_types_calls += 1
+        return {"required": {"value": ("INT", {"min": 0, "max": 100})}}
+
+
+class Checked(Source):
+    valid = True
+
+    @classmethod
+    def VALIDATE_INPUTS(cls, value):
+        Counter.validate_calls += 1
+        return cls.valid
+
+
+class Add:
+    RETURN_TYPES = ("INT",)
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        Counter.input_types_calls += 1
+        return {"required": {"a": ("INT", {}), "b": ("INT", {})}}
+
+
+class Output:
+    RETURN_TYPES = ()
+    OUTPUT_NODE = True
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        Counter.input_types_calls += 1
+        return {"required": {"value": ("INT", {})}}
+
+
+@pytest.fixture(autouse=True)
+def test_nodes(monkeypatch):
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TestSource", Source)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TestChecked", Checked)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TestAdd", Add)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TestOutput", Output)
+    Counter.input_types_calls = 0
+    Counter.validate_calls = 0
+    Checked.valid = True
+
+
+def make_prompt(value=1, chain=10):
+    prompt = {"0": {"class_type": "TestSource", "inputs": {"value": value}}}
+    for i in range(1, chain):
+        prompt[str(i)] = {"class_type": "TestAdd", "inputs": {"a": [str(i - 1), 0], "b": [str(i - 1), 0]}}
+    prompt["out"] = {"class_type": "TestOutput", "inputs": {"value": [str(chain - 1), 0]}}
+    return prompt
+
+
+def test_only_changed_nodes_revalidated():
+    cache = execution.ValidationCache()
+    assert execution.validate_prompt(make_prompt(), cache)[0] is True
+    assert Counter.input_types_calls == 11
+
+    Counter.input_types_calls = 0
+    assert execution.validate_prompt(make_prompt(), cache)[0] is True
+    assert Counter.input_types_calls == 0
+
+    # Changing the source invalidates everything downstream of it
+    prompt = make_prompt(value="7")
+    assert execution.validate_prompt(prompt, cache)[0] is True
+    assert Counter.input_types_calls == 11
+    assert prompt["0"]["inputs"]["value"] == 7
+
+
+def test_inputs_converted_on_hit():
+    cache = execution.ValidationCache()
+    execution.validate_prompt(make_prompt(value="5"), cache)
+    prompt = make_prompt(value="5")
+    execution.validate_prompt(prompt, cache)
+    assert prompt["0"]["inputs"]["value"] == 5
+    assert cache.hits > 0
+
+
+def test_failures_not_cached():
+    cache = execution.ValidationCache()
+    assert execution.validate_prompt(make_prompt(value=1000), cache)[0] is False
+    result = execution.validate_prompt(make_prompt(value=1000), cache)
+    assert result[0] is False
+    assert "0" in result[3]
+
+
+def test_validate_inputs_always_runs():
+    cache = execution.ValidationCache()
+    prompt = make_prompt()
+    prompt["0"]["class_type"] = "TestChecked"
+    assert execution.validate_prompt(prompt, cache)[0] is True
+
+    Checked.valid = False
+    prompt = make_prompt()
+    prompt["0"]["class_type"] = "TestChecked"
+    result = execution.validate_prompt(prompt, cache)
+    assert result[0] is False
+    assert Counter.validate_calls == 2
+
+
+def test_apply_prompt_delta():
+    base = make_prompt(chain=3)
+    prompt = execution.apply_prompt_delta(base, {
+        "0": {"inputs": {"value": 9}},
+        "2": None,
+        "out": {"inputs": {"value": ["1", 0]}},
+        "extra": {"class_type": "TestSource", "inputs": {"value": 1}},
+    })
+    assert base["0"]["inputs"]["value"] == 1
+    assert prompt["0"] == {"class_type": "TestSource", "inputs": {"value": 9}}
+    assert "2" not in prompt
+    assert prompt["out"]["inputs"]["value"] == ["1", 0]
+    assert prompt["extra"]["class_type"] == "TestSource"
+
+
+def test_invalid_prompt_delta():
+    base = make_prompt(chain=3)
+    for delta in (["0"], {"0": "TestSource"}, {"0": [1, 2]}, {"0": {"inputs": ["value", 9]}}):
+        with pytest.raises(ValueError):
+            execution.apply_prompt_delta(base, delta)
+
+
+class Loader:
+    RETURN_TYPES = ("MODEL",)
+    files = ["a.safetensors", "b.safetensors"]
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        Counter.input_types_calls += 1
+        return {"required": {"ckpt_name": (list(cls.files),)}}
+
+
+def test_combo_checked_again_on_hit(monkeypatch):
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "TestLoader", Loader)
+    monkeypatch.setattr(Loader, "files", ["a.safetensors", "b.safetensors"])
+    cache = execution.ValidationCache()
+    prompt = {"0": {"class_type": "TestLoader", "inputs": {"ckpt_name": "b.safetensors"}},
+              "out": {"class_type": "TestOutput", "inputs": {"value": ["0", 0]}}}
+    monkeypatch.setattr(Output, "INPUT_TYPES", classmethod(lambda cls: {"required": {"value": ("MODEL", {})}}))
+    assert execution.validate_prompt(prompt, cache)[0] is True
+
+    Loader.files = ["a.safetensors"]
+    result = execution.validate_prompt(prompt, cache)
+    assert result[0] is False
+    assert result[3]["0"]["errors"][0]["type"] == "value_not_in_list"
+
+
+def test_get_prompt():
+    class FakeServer:
+        def queue_updated(self):
+            pass
+
+    q = execution.PromptQueue(FakeServer())
+    q.put((0, "queued", make_prompt(value=3), {}, ["out"]))
+    assert q.get_prompt("queued")["0"]["inputs"]["value"] == 3
+    item, item_id = q.get(timeout=0)
+    assert q.get_prompt("queued") is not None
+    q.task_done(item_id, {}, None)
+    assert q.get_prompt("queued")["0"]["inputs"]["value"] == 3
+    assert q.get_prompt("missing") is None
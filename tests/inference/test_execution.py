@@ -117,10 +117,11 @@ class TestExecution:
     # Initialize server and client
     #
     @fixture(scope="class", autouse=True, params=[
-        # (use_lru, lru_size)
-        (False, 0),
-        (True, 0),
-        (True, 100),
+        # (use_lru, lru_size, execution_threads)
+        (False, 0, 1),
+        (True, 0, 1),
+        (True, 100, 1),
+        (False, 0, 4),
     ])
     def _server(self, args_pytest, request):
         # Start server
@@ -131,9 +132,11 @@ class TestExecution:
             '--port', str(args_pytest["port"]),
             '--extra-model-paths-config', 'tests/inference/extra_model_paths.yaml',
         ]
-        use_lru, lru_size = request.param
+        use_lru, lru_size, execution_threads = request.param
         if use_lru:
             pargs += ['--cache-lru', str(lru_size)]
+        if execution_threads > 1:
+            pargs += ['--execution-threads', str(execution_threads)]
         print("Running server with args:", pargs)  # noqa: T201
         p = subprocess.Popen(pargs)
         yield